@@ -5,12 +5,18 @@ from kivy.clock import Clock, mainthread
 from kivy.properties import StringProperty
 from kivy.uix.image import Image
 from kivy.core.image import Image as CoreImage
+from kivy.graphics.texture import Texture
 from kivy.logger import Logger, LOG_LEVELS
 import io
-import urllib.request
 import threading
 import time
 
+try:
+    from PIL import Image as PILImage
+    pil_available = True
+except Exception:
+    pil_available = False
+
 Builder.load_string('''
 <MjpegViewer>:
 
@@ -30,67 +36,79 @@ Builder.load_string('''
 
 
 class MjpegViewer(Image):
+    """ shows the frames from the shared camera relay, so it does not need its own connection to the camera
+
+    Frames are decoded to rgb in the reader thread and copied into one texture that is kept while the size does not
+    change. At most max_fps frames a second are shown, and while a frame is waiting to be shown any new ones are
+    dropped, so a busy UI never has a backlog of frames.
+    """
 
     def start(self):
         app = App.get_running_app()
-        self.url = app.camera_url
-        self.realm = app.config.get('Web', 'camera_realm', fallback=None)
-        self.user = app.config.get('Web', 'camera_user', fallback=None)
-        self.pw = app.config.get('Web', 'camera_password', fallback=None)
-        self.singleshot = app.config.getboolean('Web', 'camera_singleshot', fallback=False)
+        self.relay = app.camera_relay
         self.flipy = app.config.getboolean('Web', 'camera_flip_y', fallback=False)
         self.flipx = app.config.getboolean('Web', 'camera_flip_x', fallback=False)
+        max_fps = app.config.getfloat('Web', 'camera_max_fps', fallback=10)
+        self.frame_interval = 1.0 / max_fps if max_fps > 0 else 0
         self.quit = False
+        # frames bigger than this are decoded at a reduced resolution
+        self.decode_size = (int(self.width), int(self.height))
+        self.frame_shown = threading.Event()  # set when the UI is ready for another frame
+        self.frame_shown.set()
+        self.tex = None
+        self.relay.subscribe()
         self.t = threading.Thread(target=self._read_stream)
         self.t.start()
 
     def stop(self):
         self.quit = True
+        self.frame_shown.set()
         self.t.join()
+        self.relay.unsubscribe()
 
     def _read_stream(self):
         Logger.info("MjpegViewer: started thread")
 
-        try:
-            if self.realm and self.user and self.pw:
-                auth_handler = urllib.request.HTTPBasicAuthHandler()
-                auth_handler.add_password(realm=self.realm, uri=self.url, user=self.user, passwd=self.pw)
-                opener = urllib.request.build_opener(auth_handler)
-                urllib.request.install_opener(opener)
-
-            with urllib.request.urlopen(self.url) as stream:
-
-                bytes = b''
-                while not self.quit:
-                    # read in stream until we get the entire frame
-                    bytes += stream.read(1024)
-                    a = bytes.find(b'\xff\xd8')
-                    b = bytes.find(b'\xff\xd9')
-                    if a != -1 and b != -1:
-                        jpg = bytes[a:b + 2]
-                        bytes = bytes[b + 2:]
-
-                        data = io.BytesIO(jpg)
-                        im = CoreImage(data, ext="jpeg", nocache=True)
-                        self.update_image(im)
-
-                        if self.singleshot:
-                            # camera only supplies a snapshot not a stream
-                            time.sleep(0.2)
-                            stream = urllib.request.urlopen(self.url)
-                            bytes = b''
-
-        except Exception as err:
-            if hasattr(err, 'code') and err.code == 401:
-                Logger.error("MjpegViewer: url: {} - requires authentication: {}".format(self.url, err.headers['www-authenticate']))
-
-            self.quit = True
-            Logger.error("MjpegViewer: Failed to open url: {} - error: {}".format(self.url, err))
+        seq = 0
+        next_frame = time.monotonic()
+        while not self.quit:
+            # wait until the UI has shown the last frame and it is time for the next one
+            if not self.frame_shown.wait(0.5):
+                continue
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            # we get the latest frame, any we were too slow for are skipped
+            n, jpg = self.relay.wait_frame(seq, 0.5)
+            if n == seq or jpg is None:
+                continue
+            seq = n
+            next_frame = max(next_frame + self.frame_interval, time.monotonic())
+
+            try:
+                data = io.BytesIO(jpg)
+                if pil_available:
+                    im = PILImage.open(data)
+                    w, h = self.decode_size
+                    if w < im.width and h < im.height:
+                        # jpeg can be decoded at 1/2, 1/4 or 1/8 scale for a lot less work
+                        im.draft('RGB', (w, h))
+                    im = im.convert('RGB')
+                    self.frame_shown.clear()
+                    self.update_frame(im.size, im.tobytes())
+                else:
+                    im = CoreImage(data, ext="jpeg", nocache=True)
+                    self.frame_shown.clear()
+                    self.update_image(im)
+            except Exception as err:
+                Logger.warning("MjpegViewer: Failed to decode frame: {}".format(err))
 
         Logger.info("MjpegViewer: ending thread")
 
     @mainthread
     def update_image(self, im):
+        self.frame_shown.set()
         if self.quit:
             return
 
@@ -102,6 +120,27 @@ class MjpegViewer(Image):
             if self.flipx:
                 self.texture.flip_horizontal()
 
+    @mainthread
+    def update_frame(self, size, data):
+        ''' show a frame already decoded to rgb '''
+        self.frame_shown.set()
+        if self.quit:
+            return
+
+        self.decode_size = (int(self.width), int(self.height))
+        if self.tex is None or self.tex.size != size:
+            self.tex = Texture.create(size=size, colorfmt='rgb')
+            # the rows are top down but the texture is bottom up, flipping just changes the texture coordinates
+            if not self.flipy:
+                self.tex.flip_vertical()
+            if self.flipx:
+                self.tex.flip_horizontal()
+            self.texture = self.tex
+            self.texture_size = size
+
+        self.tex.blit_buffer(data, colorfmt='rgb', bufferfmt='ubyte')
+        self.canvas.ask_update()
+
 
 class CameraScreen(Screen):
     def start(self):
@@ -1,6 +1,5 @@
 import threading
 import asyncio
-import aiofiles
 import logging
 import functools
 import sys
@@ -8,9 +7,13 @@ import re
 import os
 import traceback
 import serial.tools.list_ports
-import subprocess
 import socket
 import time
+import collections
+
+from status_report import StatusReport
+from metrics import Metrics, FAST_BUCKETS
+from gcode_preflight import get_preflight, Eta
 from notify import Notify
 
 # my version
@@ -18,6 +21,39 @@ import libs.serial_asyncio.serial_asyncio
 
 async_main_loop = None
 
+# flags set by the GcodeReader on each line it classifies
+LINE_COUNTED = 0x01  # line starts with G, M, X or Y
+LINE_TOOL = 0x02  # Tn
+LINE_M6 = 0x04
+LINE_M0 = 0x08
+LINE_M3 = 0x10
+LINE_MSG = 0x20  # (MSG ...) to display
+LINE_NOTIFY = 0x40  # (NOTIFY ...) to email
+
+# adaptive status polling
+FAST_REPORT_STATES = ('Run', 'Jog', 'Home')  # poll at the fast rate when in these states
+IDLE_BACKOFF_AFTER = 30.0  # seconds with no UI interaction while idle before polling is backed off
+IDLE_REPORT_RATE_MAX = 5.0  # slowest we will poll when backed off
+V1_STREAM_REPORT_RATE = 1.0  # fastest we will poll a v1 over USB while streaming
+V1_BUSY_QUERY_RATE = 5.0  # fastest we send the DRO and macro queries to a busy v1
+
+STREAM_READ_SIZE = 65536  # size of each block read from the gcode file
+STREAM_READ_AHEAD = 8  # number of classified blocks that can be queued ahead of the sender
+UPLOAD_ACK_TIMEOUT = 30.0  # longest we wait for the oks to catch up at the end of an upload
+UPLOAD_VERIFY_TIMEOUT = 10.0  # longest we wait for the file to show up in the sd listing
+LOOP_LAG_INTERVAL = 0.5  # how often the event loop lag is sampled
+
+# reconnecting when the connection is lost
+RECONNECT_DELAY = 0.25  # delay before the second attempt, the first is immediate, doubles each failure
+MAX_RECONNECT_DELAY = 10.0
+PENDING_WRITE_MAX = 100  # UI commands kept while reconnecting
+PENDING_WRITE_MAX_AGE = 10.0  # UI commands older than this are not sent after reconnecting
+REALTIME_COMMANDS = ('?', '!', '~', '\x18', '\x19')  # single character commands that act immediately
+NET_KEEPALIVE_IDLE = 2  # secs idle before TCP keep alives are sent on a net connection
+NET_KEEPALIVE_INTERVAL = 1
+NET_KEEPALIVE_COUNT = 3
+NET_USER_TIMEOUT = 5000  # ms unacknowledged data can wait before the connection is considered dead
+
 
 class SerialConnection(asyncio.Protocol):
     def __init__(self, cb, f, is_net=False):
@@ -32,9 +68,13 @@ class SerialConnection(asyncio.Protocol):
         self._drain_waiter = None
         self._connection_lost = False
         self.transport = None
+        # the serial transport calls connection_made with call_soon, so it may not have run when the connect returns
+        self.made = asyncio.get_event_loop().create_future()
 
     def connection_made(self, transport):
         self.transport = transport
+        if not self.made.done():
+            self.made.set_result(True)
         self.log.debug(f'SerialConnection: port opened: {transport}')
         if self.is_net:
             # we don't want to buffer the entire file on the host
@@ -44,6 +84,7 @@ class SerialConnection(asyncio.Protocol):
             # this also gives us more progress more often
             transport.set_write_buffer_limits(high=1024, low=256)
             self.log.info(f'SerialConnection: Buffer limits: {transport._high_water} - {transport._low_water}')
+            self._set_keepalive(transport.get_extra_info('socket'))
         else:
             transport.set_write_buffer_limits(high=1024, low=64)
             self.log.info(f'SerialConnection: Buffer limits: {transport._high_water} - {transport._low_water}')
@@ -56,28 +97,62 @@ class SerialConnection(asyncio.Protocol):
                 self.log.warning(f"Failed to set low latency mode: {e}")
             # print(transport.serial)
 
+    def _set_keepalive(self, sock):
+        ''' so a dead network connection is noticed in a few seconds rather than many minutes '''
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, NET_KEEPALIVE_IDLE)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, NET_KEEPALIVE_INTERVAL)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, NET_KEEPALIVE_COUNT)
+            if hasattr(socket, 'TCP_USER_TIMEOUT'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, NET_USER_TIMEOUT)
+        except OSError as e:
+            self.log.warning(f"SerialConnection: Failed to set keep alive: {e}")
+
     def flush_queue(self):
         if not self.is_net and self.transport:
             self.transport.flush()
 
-    def send_message(self, data, hipri=False):
+    def send_message(self, data):
         """ Feed a message to the sender coroutine. """
         self.log.debug(f'SerialConnection: send_message: {data.strip()}')
-        self.transport.write(data.encode('latin1'))
+        data = data.encode('latin1')
+        self.cb.m_tx_bytes.inc(len(data))
+        self.transport.write(data)
         # print(self.transport.get_write_buffer_size())
 
+    def send_data(self, data):
+        """ Write already encoded data, used when streaming so there is no logging """
+        self.cb.m_tx_bytes.inc(len(data))
+        self.transport.write(data)
+
+    def send_realtime(self, data, t=None):
+        """ Write a realtime command ahead of anything already queued, t is when it was requested """
+        self.log.debug(f'SerialConnection: send_realtime: {data!r}')
+        data = data.encode('latin1')
+        self.cb.m_tx_bytes.inc(len(data))
+        if t is None:
+            written = None
+        else:
+            def written():
+                self.cb.m_realtime_latency.observe(time.monotonic() - t)
+
+        if hasattr(self.transport, 'write_priority'):
+            self.transport.write_priority(data, written)
+        else:
+            # the socket transport cannot jump the queue, but it tries to send straight away if nothing is queued
+            self.transport.write(data)
+            if written:
+                written()
+
     def data_received(self, data):
         # print('data received', repr(data))
-        str = ''
-        try:
-            str = data.decode(encoding='latin1', errors='ignore')
-        except Exception as err:
-            self.log.error(f"SerialConnection: Got decode error on data {repr(data)}: {err}")
-            # send it upstream anyway
-            self.cb.incoming_data(repr(data), True)
-            return
-
-        self.cb.incoming_data(str)
+        # passed upstream as bytes, lines are only decoded when they need to be
+        self.cb.m_rx_bytes.inc(len(data))
+        t = time.perf_counter()
+        self.cb.incoming_data(data)
+        self.cb.m_incoming_time.observe(time.perf_counter() - t)
 
     def connection_lost(self, exc):
         self.log.info('SerialConnection: port closed')
@@ -109,7 +184,12 @@ class SerialConnection(asyncio.Protocol):
         assert waiter is None or waiter.cancelled()
         waiter = asyncio.Future()
         self._drain_waiter = waiter
-        await waiter
+        self.cb.m_drains.inc()
+        t = time.monotonic()
+        try:
+            await waiter
+        finally:
+            self.cb.m_drain_wait.observe(time.monotonic() - t)
 
     def pause_writing(self):
         self.log.debug(f'SerialConnection: pause writing: {self.transport.get_write_buffer_size()}')
@@ -118,6 +198,7 @@ class SerialConnection(asyncio.Protocol):
         # we only do this pause stream stuff for net
         assert not self._paused
         self._paused = True
+        self.cb.m_pauses.inc()
 
     def resume_writing(self):
         self.log.debug(f'SerialConnection: resume writing: {self.transport.get_write_buffer_size()}')
@@ -133,20 +214,124 @@ class SerialConnection(asyncio.Protocol):
                 waiter.set_result(None)
 
 
+class GcodeReader():
+    """ Reads a gcode file in large blocks and returns lists of classified lines ready to send.
+
+    read_batch() blocks so it is run in a worker thread, the sender then only has to write and wait for acks.
+    """
+
+    def __init__(self, fn, manual_tool_change=False):
+        self.f = open(fn, 'rb')
+        self.lineno = 0
+        self.manual_tool_change = manual_tool_change
+        self._rest = b''
+        self._held = None
+        self._eof = False
+
+    def close(self):
+        self.f.close()
+
+    @staticmethod
+    def classify(ln):
+        ''' returns the LINE_ flags for a stripped gcode line '''
+        c = ln[0]
+        flags = LINE_COUNTED if c in b'GMXY' else 0
+        if c == 0x54:  # T
+            flags |= LINE_TOOL
+        if b'M' in ln:
+            # NOTE M6 must be on a line by itself or followed by a space or at the end of the line
+            if ln == b"M6" or ln == b"M06" or b"M6 " in ln or b"M06 " in ln or ln.endswith(b"M6"):
+                flags |= LINE_M6
+            elif ln == b"M0" or ln == b"M00":
+                flags |= LINE_M0
+            if ln.startswith(b"M3 "):
+                flags |= LINE_M3
+        return flags
+
+    def read_batch(self):
+        ''' read the next block, returns a list of (file line number, flags, data) or None at EOF '''
+        if self._eof:
+            return None
+
+        blk = self.f.read(STREAM_READ_SIZE)
+        if blk:
+            lines = (self._rest + blk).split(b'\n')
+            self._rest = lines.pop()  # partial last line
+        else:
+            self._eof = True
+            lines = [self._rest] if self._rest else []
+            self._rest = b''
+
+        batch = []
+        if self._held:
+            batch.append(self._held)
+            self._held = None
+
+        lineno = self.lineno
+        for ln in lines:
+            lineno += 1
+            ln = ln.strip()
+            if not ln or ln[0] == 0x3b:  # ;
+                continue
+
+            if ln[0] == 0x28:  # (
+                if ln.startswith(b'(MSG'):
+                    tok = (lineno, LINE_MSG, ln)
+                    if self.manual_tool_change and batch and batch[-1][1] & LINE_M6:
+                        # a (MSG following a tool change needs to be shown before we suspend
+                        batch.insert(len(batch) - 1, tok)
+                    else:
+                        batch.append(tok)
+
+                elif ln.startswith(b'(NOTIFY'):
+                    batch.append((lineno, LINE_NOTIFY, ln))
+
+                continue
+
+            batch.append((lineno, self.classify(ln), ln + b'\n'))
+
+        self.lineno = lineno
+
+        if not self._eof and batch and batch[-1][1] & LINE_M6:
+            # hold back a trailing tool change so we can see if a (MSG follows it in the next block
+            self._held = batch.pop()
+
+        return batch
+
+
 class Comms():
     def __init__(self, app, reportrate=1):
         self.app = app
         self.proto = None
         self.timer = None
-        self._fragment = None
+        self._rxbuf = bytearray()  # incoming data not yet framed into lines
+        self.status_report = StatusReport()  # the last status report, updated in place
+        self._old_status_warned = False
         self.abort_stream = False
         self.pause_stream = False  # asyncio.Event()
         self.okcnt = None
         self.actual_line = 0
         self.ping_pong = True  # ping pong protocol for streaming
         self.fast_stream = False
+        self.stream_window = 0  # if > 0 use character counting streaming keeping upto this many bytes unacknowledged
+        self._inflight = None  # (length, time sent, counted) of each line awaiting an ok when character counting
+        self._inflight_bytes = 0
+        self._acked_lines = 0  # the counted lines ok'd when character counting, the same lines the preflight counts
+        self._window_ev = None
+        self._window_need = 0  # the length of the line waiting for room in the window, 0 if none is waiting
+        self._oks_ev = None  # set when the oks have caught up with the lines sent at the end of a stream
+        self._oks_wanted = 0
+        self.stream_stats = {}
+        self.upload_window = 0  # if > 0 upload keeping upto this many lines waiting for their ok
+        self.upload_verify = False  # check the size of the uploaded file in the sd listing
+        self.upload_stats = {}
         self.file_streamer = None
         self.report_rate = reportrate
+        self.fast_report_rate = 0.1  # poll rate when running or jogging, 0 disables adaptive polling
+        self._report_interval = reportrate
+        self._last_activity = time.monotonic()
+        self._last_busy_query = 0
+        self.poll_stats = {}
         self._reroute_incoming_data_to = None
         self.ok_notify_cb = None
         self._restart_timer = False
@@ -156,8 +341,50 @@ class Comms():
         self.is_suspend = False
         self.m0 = None
         self.net_connection = False
+        # first byte of an incoming line to the handler for it
+        self._rx_dispatch = {
+            ord('o'): self._rx_ok,
+            ord('<'): self._rx_status,
+            ord('['): self._rx_bracket,
+            ord('!'): self._rx_alarm,
+            ord('A'): self._rx_alarm,
+            ord('e'): self._rx_alarm,
+            ord('E'): self._rx_error,
+            ord('/'): self._rx_comment,
+            ord('s'): self._rx_switch,
+            ord('d'): self._rx_done
+        }
         self.log = logging.getLogger()  # .getChild('Comms')
         logging.getLogger().setLevel(logging.INFO)
+        self._lag_timer = None
+        self._poll_sent = None
+        self.auto_reconnect = False  # reconnect if the connection is lost, rather than only when told to disconnect
+        self._closing = False
+        self._closing_ev = None
+        self._pending_writes = collections.deque(maxlen=PENDING_WRITE_MAX)
+        self._setup_metrics()
+
+    def _setup_metrics(self):
+        ''' the metrics are kept across connections, they are reset from the diagnostics screen '''
+        self.metrics = m = Metrics()
+        self.m_lines_sent = m.counter('lines_sent_total', 'Gcode lines sent by the streamer and uploader')
+        self.m_tx_bytes = m.counter('tx_bytes_total', 'Bytes written to the connection')
+        self.m_rx_bytes = m.counter('rx_bytes_total', 'Bytes received from the connection')
+        self.m_oks = m.counter('oks_total', 'ok replies received')
+        self.m_errors = m.counter('errors_total', 'error replies received')
+        self.m_alarms = m.counter('alarms_total', 'Alarms and halts received')
+        self.m_pauses = m.counter('write_pauses_total', 'Times the transport paused writing because its buffer was full')
+        self.m_drains = m.counter('drains_total', 'Times the sender had to wait for the transport buffer to drain')
+        self.m_connects = m.counter('connects_total', 'Successful connections')
+        self.m_reconnects = m.counter('reconnects_total', 'Connections automatically restored after being lost')
+        self.m_connected = m.gauge('connected', '1 when connected')
+        self.m_ok_rtt = m.histogram('ok_rtt_seconds', 'Time from sending a streamed line to receiving its ok')
+        self.m_drain_wait = m.histogram('drain_wait_seconds', 'Time spent waiting for the transport buffer to drain')
+        self.m_loop_lag = m.histogram('loop_lag_seconds', 'How late the comms event loop ran a timer')
+        self.m_incoming_time = m.histogram('incoming_data_seconds', 'Time spent handling each block of incoming data', FAST_BUCKETS)
+        self.m_poll_rtt = m.histogram('poll_rtt_seconds', 'Time from sending a status query to receiving the report')
+        self.m_reconnect_time = m.histogram('reconnect_seconds', 'Time from losing the connection to it being restored')
+        self.m_realtime_latency = m.histogram('realtime_latency_seconds', 'Time from a realtime command being requested to it being written')
 
     def connect(self, port):
         ''' called from UI to connect to given port, runs the asyncio mainloop in a separate thread '''
@@ -168,45 +395,164 @@ class Comms():
         return self.comms_thread
 
     def disconnect(self):
-        ''' called by ui thread to disconnect '''
+        ''' called by ui thread to disconnect, this also stops any reconnecting '''
+        if async_main_loop:
+            async_main_loop.call_soon_threadsafe(self._disconnect)
+
+    def _disconnect(self):
+        self._closing = True
+        self._closing_ev.set()
         if self.proto:
-            async_main_loop.call_soon_threadsafe(self.proto.transport.close)
+            self.proto.transport.close()
 
     def write(self, data):
         ''' Write to serial port, called from UI thread '''
-        if self.proto and async_main_loop:
-            async_main_loop.call_soon_threadsafe(self._write, data)
+        if async_main_loop and not self._closing:
+            # if we are reconnecting it is queued until we are connected again
+            if data in REALTIME_COMMANDS:
+                async_main_loop.call_soon_threadsafe(self._write_realtime, data, time.monotonic())
+            else:
+                async_main_loop.call_soon_threadsafe(self._write_ui, data)
+            self.ui_activity()
             # asyncio.run_coroutine_threadsafe(self.proto.send_message, async_main_loop)
         else:
             self.log.warning(f'Comms: Cannot write to closed connection: {data}')
             # self.app.main_window.async_display("<<< {}".format(data))
 
+    def _write_ui(self, data):
+        if self.proto:
+            self.proto.send_message(data)
+
+        elif data.startswith('$J'):
+            # a jog would be stale by the time we reconnect
+            self.log.info(f'Comms: Not connected, dropped: {data.strip()}')
+
+        else:
+            self.log.info(f'Comms: Not connected, queued until reconnected: {data.strip()}')
+            self._pending_writes.append((time.monotonic(), data))
+
+    def _write_realtime(self, data, t=None):
+        ''' realtime commands go ahead of any streamed data waiting to be written '''
+        if self.proto:
+            self.proto.send_realtime(data, t)
+        else:
+            # it would be stale by the time we reconnect
+            self.log.info(f'Comms: Not connected, dropped: {data!r}')
+
+    def _send_pending_writes(self):
+        ''' send the UI commands queued while we were reconnecting, unless they are too old '''
+        now = time.monotonic()
+        while self._pending_writes:
+            t, data = self._pending_writes.popleft()
+            if now - t > PENDING_WRITE_MAX_AGE:
+                self.log.info(f'Comms: Dropped stale command: {data.strip()}')
+                continue
+            self._write(data)
+
     def _write(self, data):
         # calls the send_message in Serial Connection proto
         # print('Comms: _write {}'.format(data))
         if self.proto:
             self.proto.send_message(data)
 
+    def _write_data(self, data):
+        # write already encoded data
+        if self.proto:
+            self.proto.send_data(data)
+
     def _get_reports(self):
         if self._restart_timer:
             return
 
-        queries = self.app.main_window.get_queries()
+        # the DRO and macro queries are only sent occasionally to a busy v1
+        now = time.monotonic()
+        busy_ok = now - self._last_busy_query >= V1_BUSY_QUERY_RATE
+        queries = self.app.main_window.get_queries(busy_ok)
         if queries:
             self._write(queries)
-
-        self._write('?')
+            self._last_busy_query = now
+            self.poll_stats['tx_bytes'] += len(queries)
+
+        self._write_realtime('?')
+        self._poll_sent = now
+        self.poll_stats['polls'] += 1
+        self.poll_stats['tx_bytes'] += 1
+
+    def _next_report_interval(self):
+        ''' adapt the status poll rate to what the machine is doing '''
+        rate = self.report_rate
+        if self.fast_report_rate <= 0:
+            return rate
+
+        if self.is_streaming and not self.app.is_v2 and not self.net_connection:
+            # v1 USB is a single channel shared with the stream, so poll slowly rather than not at all
+            return max(rate, V1_STREAM_REPORT_RATE)
+
+        if self.status_report.state in FAST_REPORT_STATES or self.app.cont_jog:
+            return min(rate, self.fast_report_rate)
+
+        if time.monotonic() - self._last_activity > IDLE_BACKOFF_AFTER:
+            # nobody is using the UI so gradually back off
+            return min(max(rate, self._report_interval * 2), max(rate, IDLE_REPORT_RATE_MAX))
+
+        return rate
+
+    def _schedule_report(self):
+        interval = self._next_report_interval()
+        if interval != self._report_interval:
+            self.log.debug(f"Comms: status poll interval now {interval} secs")
+            self._report_interval = interval
+            self.poll_stats['interval'] = interval
+        self.timer = async_main_loop.call_later(interval, self._get_reports)
+
+    def ui_activity(self):
+        ''' called from the UI thread when the user does something, ends any polling back off '''
+        self._last_activity = time.monotonic()
+        if self._report_interval > self.report_rate and async_main_loop:
+            async_main_loop.call_soon_threadsafe(self._poll_soon)
+
+    def _poll_soon(self):
+        # only if the next poll is still waiting on the timer, otherwise a report is already on its way
+        if self.timer and self.timer.when() > async_main_loop.time():
+            self.timer.cancel()
+            self._report_interval = self.report_rate
+            self.poll_stats['interval'] = self.report_rate
+            # call_later rather than call_soon so timer is always a TimerHandle with when()
+            self.timer = async_main_loop.call_later(0, self._get_reports)
+
+    def _sample_loop_lag(self, expected):
+        ''' a timer that should run at expected, how late it actually runs is the loop lag '''
+        now = async_main_loop.time()
+        self.m_loop_lag.observe(max(0.0, now - expected))
+        self._lag_timer = async_main_loop.call_at(now + LOOP_LAG_INTERVAL, self._sample_loop_lag, now + LOOP_LAG_INTERVAL)
+
+    def get_poll_stats(self):
+        ''' returns the machine state, current status poll interval and the serial bandwidth used by polling '''
+        st = dict(self.poll_stats)
+        if st:
+            elapsed = time.monotonic() - st['start']
+            st['state'] = self.status_report.state
+            st['tx_bps'] = st['tx_bytes'] / elapsed if elapsed > 0 else 0.0
+            st['rx_bps'] = st['rx_bytes'] / elapsed if elapsed > 0 else 0.0
+        return st
+
+    def get_write_stats(self):
+        ''' returns the write calls and bytes written by the serial transport for this connection, None if there are none '''
+        transport = self.proto.transport if self.proto else None
+        if transport is None or not hasattr(transport, 'get_write_stats'):
+            return None
+        return transport.get_write_stats()
 
     def stop(self):
         ''' called by ui thread when it is exiting '''
-        if self.proto:
+        if async_main_loop:
             # abort any streaming immediately
             self._stream_pause(False, True)
             if self.file_streamer:
                 self.file_streamer.cancel()
 
             # we need to close the transport, this will cause mainloop to stop and thread to exit as well
-            async_main_loop.call_soon_threadsafe(self.proto.transport.close)
+            self.disconnect()
             self.comms_thread.join()
 
         # else:
@@ -217,7 +563,7 @@ class Comms():
         return [port for port in serial.tools.list_ports.comports()]
 
     def run_async_loop(self):
-        ''' called by connect in a new thread to setup and start the asyncio loop '''
+        ''' called by connect in a new thread to setup and start the asyncio loop, it runs until told to disconnect '''
         global async_main_loop
 
         if async_main_loop:
@@ -229,12 +575,13 @@ class Comms():
         asyncio.set_event_loop(newloop)
         loop = asyncio.get_event_loop()
         async_main_loop = loop
-        f = asyncio.Future()
+        self._closing = False
+        self._closing_ev = asyncio.Event()
+        self._pending_writes.clear()
 
         # if tcp connection port will be net://ipaddress[:port]
         # otherwise it will be serial:///dev/ttyACM0 or serial://COM2:
         if self.port.startswith('net://'):
-            sc_factory = functools.partial(SerialConnection, cb=self, f=f, is_net=True)  # uses partial so we can pass a parameter
             self.net_connection = True
             ip = self.port[6:]
             ip = ip.split(':')
@@ -245,17 +592,13 @@ class Comms():
 
             self.ipaddress = ip[0]
             self.log.info(f'Comms: Connecting to Network at {self.ipaddress} port {self.port}')
-            serial_conn = loop.create_connection(sc_factory, self.ipaddress, self.port)
             # TODO should we set self.ping_pong to False here? (Only if V1)
 
         elif self.port.startswith('serial://'):
-            sc_factory = functools.partial(SerialConnection, cb=self, f=f)  # uses partial so we can pass a parameter
             self.net_connection = False
             self.port = self.port[9:]
-            serial_conn = libs.serial_asyncio.serial_asyncio.create_serial_connection(loop, sc_factory, self.port, baudrate=115200)
 
         else:
-            loop.close()
             self.log.error(f'Comms: Not a valid connection port: {self.port}')
             self.app.main_window.async_display(f'>>> Connect failed: unknown connection type {self.port}, use "serial://" or "net://"')
             self.app.main_window.disconnected()
@@ -264,46 +607,13 @@ class Comms():
             return
 
         try:
-            transport, self.proto = loop.run_until_complete(serial_conn)  # sets up connection returning transport and protocol handler
-            self.log.debug('Comms: serial connection task completed')
-
-            # this is when we are really setup and ready to go, notify upstream
-            self.app.main_window.connected()
-
-            # issue a M115 command to get things started
-            self._write('\n')
-            self._write('M115\n')
-
-            if self.report_rate > 0:
-                # start a timer to get the reports
-                self.timer = loop.call_later(self.report_rate, self._get_reports)
-
-            # wait until we are disconnected
-            self.log.debug('Comms: waiting until disconnection')
-            loop.run_until_complete(f)
-
-            # clean up and notify upstream we have been disconnected
-            self.proto = None  # no proto now
-            self._stream_pause(False, True)  # abort the stream if one is running
-            if self.timer:  # stop the timer if we have one
-                self.timer.cancel()
-                self.timer = None
-
-            self.app.main_window.disconnected()  # tell upstream we disconnected
-
-            # we wait until all tasks are complete
-            pending = asyncio.all_tasks(loop)
-            self.log.debug(f'Comms: waiting for all tasks to complete: {pending}')
-            loop.run_until_complete(asyncio.gather(*pending))
-            # loop.run_forever()
+            loop.run_until_complete(self._supervise())
 
         except asyncio.CancelledError:
             pass
 
         except Exception as err:
-            # self.log.error('Comms: {}'.format(traceback.format_exc()))
-            self.log.error(f"Comms: Got serial error opening port: {err}")
-            self.app.main_window.async_display(f">>> Connect failed: {err}")
+            self.log.error(f"Comms: Exception in comms loop: {err}")
             self.app.main_window.disconnected()
 
         finally:
@@ -311,6 +621,110 @@ class Comms():
             async_main_loop = None
             self.log.info('Comms: comms thread Exiting...')
 
+    def _create_connection(self, f):
+        ''' returns the coroutine that opens the connection, f gets a result when the connection is lost '''
+        if self.net_connection:
+            sc_factory = functools.partial(SerialConnection, cb=self, f=f, is_net=True)  # uses partial so we can pass a parameter
+            return async_main_loop.create_connection(sc_factory, self.ipaddress, self.port)
+
+        sc_factory = functools.partial(SerialConnection, cb=self, f=f)  # uses partial so we can pass a parameter
+        return libs.serial_asyncio.serial_asyncio.create_serial_connection(async_main_loop, sc_factory, self.port, baudrate=115200)
+
+    async def _supervise(self):
+        ''' connect, and if the connection is lost keep reconnecting with a back off until told to disconnect '''
+        lost = None  # when the connection was lost
+        delay = 0
+        while not self._closing:
+            f = async_main_loop.create_future()
+            try:
+                transport, self.proto = await self._create_connection(f)  # sets up connection returning transport and protocol handler
+                await self.proto.made  # the protocol can not be used until it has its transport
+
+            except Exception as err:
+                if lost is None:
+                    # the first connect failed so there is nothing to get back to
+                    self.log.error(f"Comms: Got serial error opening port: {err}")
+                    self.app.main_window.async_display(f">>> Connect failed: {err}")
+                    break
+
+                delay = min(max(delay * 2, RECONNECT_DELAY), MAX_RECONNECT_DELAY)
+                self.log.info(f'Comms: Reconnect failed: {err}, retrying in {delay} secs')
+                try:
+                    await asyncio.wait_for(self._closing_ev.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.log.debug('Comms: serial connection task completed')
+            if lost is not None:
+                t = time.monotonic() - lost
+                self.m_reconnects.inc()
+                self.m_reconnect_time.observe(t)
+                self.log.info(f'Comms: Reconnected after {t:.2f} secs')
+                self.app.main_window.async_display(f'>>> Reconnected after {t:.1f} secs')
+                delay = 0
+
+            self._connection_made(lost is not None)
+
+            # wait until we are disconnected
+            self.log.debug('Comms: waiting until disconnection')
+            await f
+
+            self._connection_ended()
+            if self._closing or not self.auto_reconnect:
+                break
+
+            lost = time.monotonic()
+            self.log.warning('Comms: Connection lost, reconnecting')
+            self.app.main_window.async_display('>>> Connection lost, reconnecting...')
+            self.app.main_window.update_status('Reconnecting', None)
+
+        self.app.main_window.disconnected()  # tell upstream we disconnected
+
+        # we wait until all tasks are complete
+        pending = asyncio.all_tasks() - {asyncio.current_task()}
+        self.log.debug(f'Comms: waiting for all tasks to complete: {pending}')
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def _connection_made(self, reconnected):
+        self._rxbuf.clear()
+        self.status_report.clear()  # so the first report always updates the UI
+        self._old_status_warned = False
+        self._report_interval = self.report_rate
+        self._poll_sent = None
+        self.poll_stats = {'start': time.monotonic(), 'interval': self.report_rate, 'polls': 0, 'reports': 0, 'tx_bytes': 0, 'rx_bytes': 0}
+
+        # this is when we are really setup and ready to go, notify upstream
+        self.app.main_window.connected()
+
+        # issue a M115 command to get things started
+        self._write('\n')
+        self._write('M115\n')
+
+        # anything the UI sent while we were reconnecting
+        self._send_pending_writes()
+
+        if self.report_rate > 0:
+            # start a timer to get the reports, straight away if we have reconnected
+            self.timer = async_main_loop.call_later(0.1 if reconnected else self.report_rate, self._get_reports)
+
+        self.m_connects.inc()
+        self.m_connected.set(1)
+        t = async_main_loop.time() + LOOP_LAG_INTERVAL
+        self._lag_timer = async_main_loop.call_at(t, self._sample_loop_lag, t)
+
+    def _connection_ended(self):
+        # clean up after the connection was closed or lost
+        self.proto = None  # no proto now
+        self.m_connected.set(0)
+        self._stream_pause(False, True)  # abort the stream if one is running
+        if self.timer:  # stop the timer if we have one
+            self.timer.cancel()
+            self.timer = None
+        if self._lag_timer:
+            self._lag_timer.cancel()
+            self._lag_timer = None
+
     def _parse_m115(self, s):
         # split fields
         ll = s.split(',')
@@ -412,127 +826,173 @@ class Comms():
 
     # Handle incoming data, see if it is a report and parse it otherwise just display it on the console log
     # Note the data could be a line fragment and we need to only process complete lines terminated with \n
-    def incoming_data(self, data, error=False):
-        ''' called by Serial connection when incoming data is received '''
-        if error:
-            self.app.main_window.async_display(f"WARNING: got bad incoming data: {data}")
+    def incoming_data(self, data):
+        ''' called by Serial connection when incoming data (bytes) is received '''
+        self.log.debug('Comms: incoming_data: %r', data)
+
+        # the partial line left from the last call is still at the start of the buffer
+        buf = self._rxbuf
+        buf += data
+        start = 0
+        with memoryview(buf) as mv:
+            while True:
+                end = buf.find(b'\n', start)
+                if end < 0:
+                    break
 
-        ll = data.splitlines(1)
+                # strip the end of the line in place, no copy is made until we know we need one
+                s, e = start, end
+                start = end + 1
+                while e > s and buf[e - 1] <= 0x20:
+                    e -= 1
 
-        self.log.debug(f'Comms: incoming_data: {ll}')
+                if s == e:
+                    continue
 
-        # process incoming data
-        for s in ll:
-            if self._fragment:
-                # handle line fragment
-                s = ''.join((self._fragment, s))
-                self._fragment = None
+                # send the line to the requested destination for processing
+                if self._reroute_incoming_data_to is not None:
+                    self._reroute_incoming_data_to(str(mv[s:e], 'latin1'))
+                    continue
 
-            if not s.endswith('\n'):
-                # this is the last line and is a fragment
-                self._fragment = s
-                break
+                c = buf[s]
+                if c == 0x6f and e - s == 2 and buf[s + 1] == 0x6b:
+                    # a plain ok is by far the most common line so handle it without copying
+                    self._handle_ok()
+                    continue
 
-            s = s.rstrip()  # strip off \n
+                # dispatch on the first character of the line
+                self._rx_dispatch.get(c, self._rx_other)(bytes(mv[s:e]))
 
-            if len(s) == 0:
-                continue
+        # keep any trailing fragment for next time
+        del buf[:start]
 
-            # send the line to the requested destination for processing
-            if self._reroute_incoming_data_to is not None:
-                self._reroute_incoming_data_to(s)
-                continue
+    def _handle_ok(self):
+        self.m_oks.inc()
+        if self.okcnt is not None:
+            if self.ping_pong:
+                self.okcnt.set()
+            else:
+                self.okcnt += 1
+                if self._inflight:
+                    self._ack_line()
+                if self._oks_ev is not None and self.okcnt >= self._oks_wanted:
+                    self._oks_ev.set()
+        if self.ok_notify_cb:
+            self.ok_notify_cb(True)
+            self.ok_notify_cb = None
+
+    def _rx_ok(self, s):
+        if not s.startswith(b'ok'):
+            self._rx_other(s)
+            return
 
-            # process a complete line
-            if s.startswith('ok'):
-                if self.okcnt is not None:
-                    if self.ping_pong:
-                        self.okcnt.set()
-                    else:
-                        self.okcnt += 1
-                if self.ok_notify_cb:
-                    self.ok_notify_cb(True)
-                    self.ok_notify_cb = None
+        self._handle_ok()
 
-                # if there is anything after the ok display it
-                if len(s) > 2:
-                    self.app.main_window.async_display(f'ok {s[3:]}')
+        # if there is anything after the ok display it
+        if len(s) > 2:
+            self.app.main_window.async_display(f"ok {s[3:].decode('latin1')}")
 
-            elif s.startswith('<'):
-                try:
-                    self.handle_status(s)
-                except Exception:
-                    self.log.error(f"Comms: error parsing status - {s}")
-
-            elif s.startswith('[PRB:'):
-                # Handle PRB reply
-                self.handle_probe(s)
-
-            elif s.startswith('[GC:'):
-                self.handle_state(s)
-
-            elif s.startswith("!!") or s.startswith("error:Alarm lock") or s.startswith("ALARM:"):
-                if self.ok_notify_cb:
-                    self.ok_notify_cb(False)
-                    self.ok_notify_cb = None
-                self.handle_alarm(s, True)
-                # we should now be paused
-                if self.okcnt is not None and self.ping_pong:
-                    # we need to unblock waiting for ok if we get this
-                    self.okcnt.set()
-
-            elif s.startswith("ERROR") or s.startswith('error:'):
-                if self.ok_notify_cb:
-                    self.ok_notify_cb(False)
-                    self.ok_notify_cb = None
-                self.handle_alarm(s, False)
-
-            elif s.startswith('//'):
-                # ignore comments but display them
-                # handle // action:pause etc
-                pos = s.find('action:')
-                if pos >= 0:
-                    act = s[pos + 7:].strip()  # extract action command
-                    if act in 'pause':
-                        self.app.main_window.async_display('>>> Smoothie requested Pause')
-                        self.is_suspend = True  # this currently only happens if we suspend (M600)
-                        self._stream_pause(True, False)
-                    elif act in 'resume':
-                        self.app.main_window.async_display('>>> Smoothie requested Resume')
-                        self._stream_pause(False, False)
-                    elif act in 'feedhold':
-                        self.app.main_window.async_display('>>> Smoothie requested Feed Hold')
-                        self._stream_pause(True, False)
-                    elif act in 'feedresume':
-                        self.app.main_window.async_display('>>> Smoothie requested Feed Resume')
-                        self._stream_pause(False, False)
-                    elif act in 'disconnect':
-                        self.app.main_window.async_display('>>> Smoothie requested Disconnect')
-                        self.disconnect()
-                    else:
-                        self.log.warning(f'Comms: unknown action command: {act}')
+    def _rx_status(self, s):
+        try:
+            self.handle_status(s)
+        except Exception:
+            self.log.error(f"Comms: error parsing status - {s}")
+
+    def _rx_bracket(self, s):
+        if s.startswith(b'[PRB:'):
+            # Handle PRB reply
+            self.handle_probe(s.decode('latin1'))
+        elif s.startswith(b'[GC:'):
+            self.handle_state(s.decode('latin1'))
+        else:
+            self._rx_other(s)
 
-                else:
-                    self.app.main_window.async_display(f'{s}')
+    def _rx_alarm(self, s):
+        if not (s.startswith(b"!!") or s.startswith(b"error:Alarm lock") or s.startswith(b"ALARM:")):
+            self._rx_error(s)
+            return
 
-            elif "FIRMWARE_NAME:" in s:
-                # process the response to M115
-                self._parse_m115(s)
+        if self.ok_notify_cb:
+            self.ok_notify_cb(False)
+            self.ok_notify_cb = None
+        self.m_alarms.inc()
+        self.handle_alarm(s.decode('latin1'), True)
+        # we should now be paused
+        if self.okcnt is not None and self.ping_pong:
+            # we need to unblock waiting for ok if we get this
+            self.okcnt.set()
+        if self._window_ev is not None:
+            self._window_ev.set()
+
+    def _rx_error(self, s):
+        if not (s.startswith(b"ERROR") or s.startswith(b'error:')):
+            self._rx_other(s)
+            return
 
-            elif s.startswith("switch "):
-                # switch fan is 0
-                n, x, v = s[7:].split(' ')
-                self.app.main_window.ids.macros.switch_response(n, v)
+        if self.ok_notify_cb:
+            self.ok_notify_cb(False)
+            self.ok_notify_cb = None
+        self.m_errors.inc()
+        self.handle_alarm(s.decode('latin1'), False)
 
-            elif s.startswith("done"):
-                # ignore these sent after a command on V2
-                pass
+    def _rx_comment(self, s):
+        if not s.startswith(b'//'):
+            self._rx_other(s)
+            return
 
+        s = s.decode('latin1')
+        # ignore comments but display them
+        # handle // action:pause etc
+        pos = s.find('action:')
+        if pos >= 0:
+            act = s[pos + 7:].strip()  # extract action command
+            if act in 'pause':
+                self.app.main_window.async_display('>>> Smoothie requested Pause')
+                self.is_suspend = True  # this currently only happens if we suspend (M600)
+                self._stream_pause(True, False)
+            elif act in 'resume':
+                self.app.main_window.async_display('>>> Smoothie requested Resume')
+                self._stream_pause(False, False)
+            elif act in 'feedhold':
+                self.app.main_window.async_display('>>> Smoothie requested Feed Hold')
+                self._stream_pause(True, False)
+            elif act in 'feedresume':
+                self.app.main_window.async_display('>>> Smoothie requested Feed Resume')
+                self._stream_pause(False, False)
+            elif act in 'disconnect':
+                self.app.main_window.async_display('>>> Smoothie requested Disconnect')
+                self.disconnect()
             else:
-                self.app.main_window.async_display(f'{s}')
+                self.log.warning(f'Comms: unknown action command: {act}')
+
+        else:
+            self.app.main_window.async_display(s)
+
+    def _rx_switch(self, s):
+        if not s.startswith(b"switch "):
+            self._rx_other(s)
+            return
+
+        # switch fan is 0
+        n, x, v = s[7:].decode('latin1').split(' ')
+        self.app.main_window.ids.macros.switch_response(n, v)
+
+    def _rx_done(self, s):
+        if not s.startswith(b"done"):
+            self._rx_other(s)
+        # otherwise ignore these sent after a command on V2
+
+    def _rx_other(self, s):
+        s = s.decode('latin1')
+        if "FIRMWARE_NAME:" in s:
+            # process the response to M115
+            self._parse_m115(s)
+        else:
+            self.app.main_window.async_display(s)
 
     def handle_state(self, s):
         # [GC:G0 G55 G17 G21 G90 G94 M0 M5 M9 T1 F4000.0000 S0.8000]
+        self.poll_stats['rx_bytes'] += len(s) + 1  # reply to the $I query
         s = s[4:-1]  # strip off [GC: .. ]
 
         # split fields
@@ -548,28 +1008,31 @@ class Comms():
     def handle_status(self, s):
         # <Idle|MPos:68.9980,-49.9240,40.0000,12.3456|WPos:68.9980,-49.9240,40.0000|F:12345.12|S:1.2>
         # if temp readings are enabled then also returns T:25.0,0.0|B:25.2,0.0
-        s = s[1:-1]  # strip off < .. >
+        # s is the raw bytes of the report, it is parsed in place into self.status_report
+        if self._poll_sent is not None:
+            self.m_poll_rtt.observe(time.monotonic() - self._poll_sent)
+            self._poll_sent = None
 
-        # split fields
-        ll = s.split('|')
-        self.log.debug(f"Comms: Got status: {ll}")
-        if len(ll) < 3:
+        changed = self.status_report.parse(s)
+        if changed is None:
             self.log.warning('Comms: old status report - set new_status_format')
-            self.app.main_window.update_status("ERROR", "set new_status_format true")
+            if not self._old_status_warned:
+                # only tell them once a connection, not on every report
+                self._old_status_warned = True
+                self.app.main_window.async_display("WARNING: Smoothie is sending the old status report format, please set new_status_format true in the Smoothie config")
+            self.app.main_window.update_status("ERROR", None)
             return
 
-        # strip off status
-        status = ll[0]
+        # only bother the UI if something it displays has changed
+        if changed:
+            self.log.debug(f'Comms: got status:{self.status_report.state} - {s}')
+            self.app.main_window.update_status(self.status_report.state, self.status_report.copy())
 
-        # strip of rest into a dict of name: [values,...,]
-        d = {a: [float(y) for y in b.split(',')] for a, b in [x.split(':') for x in ll[1:]]}
-
-        self.log.debug(f'Comms: got status:{status} - rest: {d}')
-
-        self.app.main_window.update_status(status, d)
+        self.poll_stats['reports'] += 1
+        self.poll_stats['rx_bytes'] += len(s) + 1
 
         # schedule next report
-        self.timer = async_main_loop.call_later(self.report_rate, self._get_reports)
+        self._schedule_report()
 
     def handle_probe(self, s):
         # [PRB:1.000,80.137,10.000:0]
@@ -634,6 +1097,10 @@ class Comms():
                 self.pause_stream = False
                 if self.ping_pong and self.okcnt is not None:
                     self.okcnt.set()  # release it in case it is waiting for ok so it can abort
+                if self._window_ev is not None:
+                    self._window_ev.set()  # release it in case it is waiting for the window to open
+                if self._oks_ev is not None:
+                    self._oks_ev.set()  # release it in case it is waiting for the last oks
                 self.log.info('Comms: Aborting Stream')
 
             elif pause:
@@ -648,6 +1115,79 @@ class Comms():
                 self.app.main_window.action_paused(False)
                 self.log.info('Comms: Resuming Stream')
 
+    def _ack_line(self):
+        # an ok arrived for the oldest line still in the controllers receive buffer
+        n, t, counted = self._inflight.popleft()
+        self._inflight_bytes -= n
+        if counted:
+            self._acked_lines += 1
+        rtt = time.monotonic() - t
+        self.m_ok_rtt.observe(rtt)
+        st = self.stream_stats
+        st['acked'] += 1
+        st['rtt_avg'] = rtt if st['acked'] == 1 else st['rtt_avg'] + (rtt - st['rtt_avg']) / 8.0
+        if rtt > st['rtt_max']:
+            st['rtt_max'] = rtt
+        # only wake the sender once there is room for the line it is waiting to send, not on every ok
+        need = self._window_need
+        if need and (not self._inflight or self._inflight_bytes + need <= self.stream_window):
+            self._window_need = 0
+            self._window_ev.set()
+
+    async def _wait_for_window(self, n):
+        ''' character counting, wait until the controller has room for another n bytes '''
+        # if nothing is in flight we always send, even if the line is bigger than the window
+        while self._inflight and self._inflight_bytes + n > self.stream_window:
+            self._window_need = n
+            self._window_ev.clear()
+            await self._window_ev.wait()
+            if self.abort_stream:
+                break
+        self._window_need = 0
+
+    def get_stream_stats(self):
+        ''' returns the measured lines/sec and ok round trip times of the current or last character counted stream '''
+        st = dict(self.stream_stats)
+        if st:
+            elapsed = (st['end'] if st['end'] else time.monotonic()) - st['start']
+            st['lps'] = st['acked'] / elapsed if elapsed > 0 else 0.0
+        return st
+
+    async def _read_gcode(self, reader, q):
+        ''' producer for stream_file, reads ahead in a worker thread and queues the classified blocks '''
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                fut = loop.run_in_executor(None, reader.read_batch)
+                try:
+                    batch = await asyncio.shield(fut)
+                except asyncio.CancelledError:
+                    # the read in the worker thread can not be stopped, so it has to finish before the file is closed
+                    await asyncio.wait([fut])
+                    if not fut.cancelled():
+                        fut.exception()  # we are stopping so any error does not matter
+                    raise
+                await q.put(batch)
+                if batch is None:
+                    break
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as err:
+            self.log.error(f"Comms: gcode reader exception: {err}")
+            await q.put(err)
+
+    async def _stop_reader(self, producer, reader):
+        ''' stops the read ahead task, and closes the file once it is no longer being read '''
+        try:
+            if producer:
+                producer.cancel()
+                await asyncio.wait([producer])
+        finally:
+            if reader:
+                reader.close()
+
     async def stream_file(self, fn):
         self.log.info(f'Comms: Streaming file {fn} to port')
         self.is_streaming = True
@@ -656,9 +1196,15 @@ class Comms():
         self.last_tool = None
 
         # optional do not use ping pong
+        windowed = False
         if self.fast_stream:
             self.ping_pong = False
             self.log.info("Comms: using fast stream")
+        elif self.stream_window > 0:
+            # character counting, keep the controllers receive buffer full but do not overflow it
+            self.ping_pong = False
+            windowed = True
+            self.log.info(f"Comms: using character counting stream with a window of {self.stream_window} bytes")
         else:
             self.ping_pong = True
 
@@ -667,14 +1213,29 @@ class Comms():
         else:
             self.okcnt = 0
 
-        f = None
+        if windowed:
+            self._inflight = collections.deque()
+            self._inflight_bytes = 0
+            self._acked_lines = 0
+            self._window_ev = asyncio.Event()
+            self.stream_stats = {'window': self.stream_window, 'start': time.monotonic(), 'end': None, 'sent': 0, 'acked': 0, 'rtt_avg': 0.0, 'rtt_max': 0.0}
+
+        reader = None
+        producer = None
         success = False
         linecnt = 0
         self.actual_line = 0
         tool_change_state = 0
+        batch = []
+        pos = 0
+        flags = 0
 
         try:
-            f = await aiofiles.open(fn, mode='r')
+            # the file is read and classified ahead of us in a worker thread, so here we only send and wait for acks
+            reader = GcodeReader(fn, self.app.manual_tool_change)
+            q = asyncio.Queue(maxsize=STREAM_READ_AHEAD)
+            producer = asyncio.ensure_future(self._read_gcode(reader, q))
+
             while True:
 
                 if tool_change_state == 0:
@@ -691,7 +1252,7 @@ class Comms():
                         while self.pause_stream:
                             await asyncio.sleep(1)
                             if self.progress:
-                                self.progress(linecnt)
+                                self.progress(self._acked_lines if windowed else linecnt)
                             if self.abort_stream:
                                 break
 
@@ -699,53 +1260,45 @@ class Comms():
                         if self.ping_pong:
                             self.okcnt = asyncio.Event()
 
-                    # read next line
-                    line = await f.readline()
-                    self.actual_line += 1
-                    if not line:
-                        # EOF
+                    # get next line from the reader
+                    while pos >= len(batch):
+                        batch = await q.get()
+                        pos = 0
+                        if batch is None:
+                            # EOF
+                            break
+                        if isinstance(batch, Exception):
+                            raise batch
+
+                    if batch is None:
                         break
 
+                    self.actual_line, flags, data = batch[pos]
+                    pos += 1
+
                     if self.abort_stream:
                         break
 
-                    line = line.strip()
-                    if len(line) == 0 or line.startswith(';'):
-                        continue
-
-                    if line.startswith('(MSG'):
-                        self.app.main_window.async_display(line)
-                        continue
-
-                    if line.startswith('(NOTIFY'):
-                        notify = Notify()
-                        notify.send(line)
-                        continue
+                    if flags:
+                        if flags & LINE_MSG:
+                            self.app.main_window.async_display(data.decode('latin1'))
+                            continue
 
-                    if line.startswith('('):
-                        continue
+                        if flags & LINE_NOTIFY:
+                            notify = Notify()
+                            notify.send(data.decode('latin1'))
+                            continue
 
-                    if line.startswith('T'):
-                        self.last_tool = line
+                        if flags & LINE_TOOL:
+                            self.last_tool = data.decode('latin1').rstrip()
 
-                    if self.app.manual_tool_change:
-                        # handle tool change M6 or M06
-                        if line == "M6" or line == "M06" or "M6 " in line or "M06 " in line or line.endswith("M6"):
+                        if self.app.manual_tool_change and flags & LINE_M6:
+                            # handle tool change M6 or M06, the reader has already moved any following (MSG to before this line
                             tool_change_state = 1
                             if self.last_tool is None:
-                                self.last_tool = line
-
-                            # look ahead for possible (MSG...
-                            pos = await f.tell()  # remember where we are
-                            nxtline = await f.readline()
-                            if nxtline.startswith('(MSG'):
-                                self.app.main_window.async_display(nxtline)
-                            else:
-                                await f.seek(pos)  # set back to start of next line
-
-                    if self.app.wait_on_m0:
-                        # handle M0 if required
-                        if line == "M0" or line == "M00":
+                                self.last_tool = data.decode('latin1').rstrip()
+
+                        if self.app.wait_on_m0 and flags & LINE_M0:
                             # we basically wait for the continue dialog to be dismissed
                             self.app.main_window.m0_dlg()
                             self.m0 = asyncio.Event()
@@ -760,12 +1313,14 @@ class Comms():
                 if self.app.manual_tool_change and tool_change_state > 0:
                     if tool_change_state == 1:
                         # we insert an M400 so we can wait for last command to actually execute and complete
-                        line = "M400"
+                        data = b"M400\n"
+                        flags = LINE_COUNTED
                         tool_change_state = 2
 
                     elif tool_change_state == 2:
                         # we got the M400 so queue is empty so we send a suspend and tell upstream
-                        line = "M600"
+                        data = b"M600\n"
+                        flags = LINE_COUNTED
                         # we need to pause the stream here immediately, but the real _stream_pause will be called by suspend
                         self.pause_stream = True  # we don't normally set this directly
                         self.app.main_window.tool_change_prompt(f"{self.last_tool}")
@@ -773,13 +1328,15 @@ class Comms():
                         tool_change_state = 0
 
                 # Handle potential translation and scaling of Spindle on command
-                if self.app.spindle_handler is not None and line.startswith("M3 "):
+                if self.app.spindle_handler is not None and flags & LINE_M3:
+                    line = data.decode('latin1').rstrip()
                     rpm = line.split(' ')
                     if len(rpm) > 1 and rpm[1].startswith('S'):
                         try:
                             rpm = float(rpm[1][1:])
                             (pwm, belt) = self.app.spindle_handler.lookup(rpm)
                             line = f"{self.app.spindle_handler.translate} S{pwm}"
+                            data = f"{line}\n".encode('latin1')
                             self.log.debug(f'Comms: Translated M3 to {line}')
                             self.app.main_window.async_display(f'// {line} use belt {belt}\n')
                             if belt:
@@ -799,13 +1356,26 @@ class Comms():
                     # clear the event, which will be set by an incoming ok
                     self.okcnt.clear()
 
-                # sending stripped line so add \n
-                self._write(f"{line}\n")
+                if windowed:
+                    # wait until there is room in the controllers receive buffer for this line
+                    n = len(data)
+                    await self._wait_for_window(n)
+                    if self.abort_stream:
+                        break
+                    self._inflight.append((n, time.monotonic(), flags & LINE_COUNTED))
+                    self._inflight_bytes += n
+                    self.stream_stats['sent'] += 1
+
+                # the line is already terminated and encoded by the reader
+                sent_time = time.monotonic()
+                self._write_data(data)
+                self.m_lines_sent.inc()
 
                 # wait for ok from that command (I'd prefer to interleave with the file read but it is too complex)
                 if self.ping_pong and self.okcnt is not None:
                     try:
                         await self.okcnt.wait()
+                        self.m_ok_rtt.observe(time.monotonic() - sent_time)
                         # e = time.time()
                         # print("{} ({}ms) ok".format(e, (e - s) * 1000))
                     except Exception:
@@ -832,7 +1402,7 @@ class Comms():
 
                 if self.ping_pong:
                     # we only count lines that start with GMXY
-                    if line[0] in "GMXY":
+                    if flags & LINE_COUNTED:
                         linecnt += 1
                 else:
                     linecnt += 1
@@ -841,6 +1411,9 @@ class Comms():
                     if self.ping_pong:
                         # number of lines sent
                         self.progress(linecnt)
+                    elif windowed:
+                        # number of GMXY lines ok'd, so it matches the preflight count and ETA profile
+                        self.progress(self._acked_lines)
                     else:
                         # number of lines ok'd
                         self.progress(self.okcnt)
@@ -852,8 +1425,7 @@ class Comms():
             # print('Exception: {}'.format(traceback.format_exc()))
 
         finally:
-            if f:
-                await f.close()
+            await self._stop_reader(producer, reader)
 
             if self.abort_stream:
                 if self.proto:
@@ -863,23 +1435,38 @@ class Comms():
 
             if success and not self.ping_pong:
                 self.log.debug(f'Comms: Waiting for okcnt to catch up: {self.okcnt} vs {linecnt}')
-                # we have to wait for all lines to be ack'd
+                # we have to wait for all lines to be ack'd, the last ok wakes us so the next stream is not held up
                 tmo = 0
+                self._oks_wanted = linecnt
+                self._oks_ev = asyncio.Event()
                 while self.okcnt < linecnt:
                     if self.progress:
-                        self.progress(self.okcnt)
+                        self.progress(self._acked_lines if windowed else self.okcnt)
                     if self.abort_stream:
                         success = False
                         break
 
-                    await asyncio.sleep(1)
-                    tmo += 1
-                    if tmo >= 30:  # waited 30 seconds we need to give up
-                        self.log.warning("Comms: timed out waiting for backed up oks")
-                        break
+                    try:
+                        await asyncio.wait_for(self._oks_ev.wait(), 1)
+                    except asyncio.TimeoutError:
+                        tmo += 1
+                        if tmo >= 30:  # waited 30 seconds we need to give up
+                            self.log.warning("Comms: timed out waiting for backed up oks")
+                            break
+                self._oks_ev = None
                 # update final progress display
                 if self.progress:
-                    self.progress(self.okcnt)
+                    self.progress(self._acked_lines if windowed else self.okcnt)
+
+            if windowed:
+                self.stream_stats['end'] = time.monotonic()
+                st = self.get_stream_stats()
+                self.log.info(f"Comms: stream stats: {st['acked']} lines at {st['lps']:1.1f} lines/sec, ok latency avg {st['rtt_avg'] * 1000:1.1f} ms, max {st['rtt_max'] * 1000:1.1f} ms")
+                self.app.main_window.async_display(f">>> Streamed {st['lps']:1.1f} lines/sec, ok latency avg {st['rtt_avg'] * 1000:1.1f} ms, max {st['rtt_max'] * 1000:1.1f} ms")
+                self._inflight = None
+                self._inflight_bytes = 0
+                self._window_ev = None
+                self._window_need = 0
 
             self.file_streamer = None
             self.progress = None
@@ -923,126 +1510,147 @@ class Comms():
         else:
             self.log.warning(f'Comms: unknown response: {ll}')
 
+    def get_upload_stats(self):
+        ''' returns the lines and bytes sent and the bytes/sec of the current or last upload '''
+        st = dict(self.upload_stats)
+        if st:
+            elapsed = (st['end'] if st['end'] else time.monotonic()) - st['start']
+            st['bps'] = st['bytes'] / elapsed if elapsed > 0 else 0.0
+        return st
+
     async def _stream_upload_gcode(self, fn, donecb):
         self.log.info(f'Comms: Upload gcode file {fn}')
 
         self.upload_error = False
         self.abort_stream = False
-        f = None
+        reader = None
+        producer = None
         success = False
-        linecnt = 0
+        sent = 0
         okev = asyncio.Event()
+        name = os.path.basename(fn).lower()
 
-        # use the simple ping pong one line per ok or fast stream
         self._redirect_incoming(lambda x: self._rcv_upload_gcode_line(x, okev))
 
         try:
             self.okcnt = 0
             okev.clear()
-            self._write(f"M28 {os.path.basename(fn).lower()}\n")
+            self._write(f"M28 {name}\n")
             await okev.wait()
 
             if self.upload_error:
-                self.log.error(f'Comms: M28 failed for file /sd/{os.path.basename(fn)}')
+                self.log.error(f'Comms: M28 failed for file /sd/{name}')
                 self.app.main_window.async_display("error: M28 failed to open file")
                 return
 
+            # the number of lines that can be waiting for their ok, None is no limit
             self.okcnt = 0
             if self.fast_stream:
-                self.ping_pong = False
+                window = None
                 self.log.info("Comms: using fast stream upload")
+            elif self.upload_window > 0:
+                window = self.upload_window
+                self.log.info(f"Comms: using windowed upload with {window} lines in flight")
             else:
-                self.ping_pong = True
+                # ping pong
+                window = 1
 
-            f = await aiofiles.open(fn, mode='r')
+            self.upload_stats = {'window': window, 'start': time.monotonic(), 'end': None, 'lines': 0, 'bytes': 0}
+            st = self.upload_stats
 
-            while True:
-                # read next line
-                line = await f.readline()
+            # the file is read in large blocks ahead of us in a worker thread
+            reader = GcodeReader(fn)
+            q = asyncio.Queue(maxsize=STREAM_READ_AHEAD)
+            producer = asyncio.ensure_future(self._read_gcode(reader, q))
+            last_progress = 0
 
-                if not line:
+            while True:
+                batch = await q.get()
+                if batch is None:
                     # EOF
                     break
+                if isinstance(batch, Exception):
+                    raise batch
+
+                # (MSG and (NOTIFY are not uploaded
+                lines = [data for lineno, flags, data in batch if not flags & (LINE_MSG | LINE_NOTIFY)]
+                pos = 0
+                while pos < len(lines):
+                    # wait until there is room for more lines
+                    n = len(lines) - pos
+                    if window is not None:
+                        while sent - self.okcnt >= window and not (self.upload_error or self.abort_stream):
+                            okev.clear()
+                            await okev.wait()
+                        n = min(n, window - (sent - self.okcnt))
+
+                    if self.upload_error:
+                        self.log.error(f'Comms: Upload failed for file /sd/{name}')
+                        self.app.main_window.async_display("error: upload failed during transfer")
+                        return
+
+                    if self.abort_stream or n <= 0:
+                        break
 
-                ln = line.strip()
-                if len(ln) == 0 or ln.startswith(';') or ln.startswith('('):
-                    continue
-
-                # clear the event, which will be set by an incoming ok
-                if self.ping_pong:
-                    okev.clear()
-                self._write(f"{ln}\n")
+                    # as many lines as there is room for go in one write
+                    data = b''.join(lines[pos:pos + n])
+                    pos += n
+                    sent += n
+                    self._write_data(data)
+                    self.m_lines_sent.inc(n)
+                    st['lines'] = sent
+                    st['bytes'] += len(data)
 
-                if self.ping_pong:
-                    # wait for ok from that line
-                    await okev.wait()
+                    # when streaming we need to yield until the flow control is dealt with
+                    if self.proto and self.proto._connection_lost:
+                        await asyncio.sleep(0)
 
-                if self.upload_error:
-                    self.log.error(f'Comms: Upload failed for file /sd/{os.path.basename(fn)}')
-                    self.app.main_window.async_display("error: upload failed during transfer")
-                    return
+                    # if the buffers are full then wait until we can send some more
+                    await self.proto._drain_helper()
 
-                # when streaming we need to yield until the flow control is dealt with
-                if self.proto and self.proto._connection_lost:
-                    await asyncio.sleep(0)
-
-                if self.abort_stream:
-                    break
-
-                # if the buffers are full then wait until we can send some more
-                await self.proto._drain_helper()
+                    if self.progress and sent - last_progress >= 100:  # update every 100 lines
+                        last_progress = sent
+                        self.progress(self.okcnt)
 
                 if self.abort_stream:
                     break
 
-                if self.ping_pong:
-                    if ln[0] in "GMXY":
-                        # we only count lines that start with GMXY
-                        linecnt += 1
-                else:
-                    # we count all lines sent
-                    linecnt += 1
-
-                if self.progress and linecnt % 100 == 0:  # update every 100 lines
-                    if self.ping_pong:
-                        # number of lines sent
-                        self.progress(linecnt)
-                    else:
-                        # number of lines ok'd
-                        self.progress(self.okcnt)
+            # we have to wait for all lines to be ack'd
+            self.log.debug(f'Comms: Waiting for okcnt to catch up: {self.okcnt} vs {sent}')
+            try:
+                while self.okcnt < sent and not (self.upload_error or self.abort_stream):
+                    okev.clear()
+                    await asyncio.wait_for(okev.wait(), UPLOAD_ACK_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.log.warning("Comms: timed out waiting for backed up oks")
 
-            success = not self.abort_stream
+            st['end'] = time.monotonic()
+            success = not (self.abort_stream or self.upload_error)
 
         except Exception as err:
             self.log.error(f"Comms: Upload GCode file exception: {err}")
 
         finally:
-            if not self.ping_pong:
-                # wait for oks to catch up
-                self.log.debug(f'Comms: Waiting for okcnt to catch up: {self.okcnt} vs {linecnt}')
-                # we have to wait for all lines to be ack'd
-                tmo = 0
-                while self.okcnt < linecnt:
-                    if self.progress:
-                        self.progress(self.okcnt)
+            await self._stop_reader(producer, reader)
 
-                    await asyncio.sleep(1)
-                    tmo += 1
-                    if tmo >= 30:  # waited 30 seconds we need to give up
-                        self.log.warning("Comms: timed out waiting for backed up oks")
-                        break
-
-                # update final progress display
-                if self.progress:
-                    self.progress(self.okcnt)
+            # update final progress display
+            if self.progress and self.okcnt:
+                self.progress(self.okcnt)
 
             okev.clear()
             self._write("M29\n")
-            await okev.wait()
+            try:
+                await asyncio.wait_for(okev.wait(), UPLOAD_VERIFY_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.log.warning("Comms: timed out waiting for M29 ok")
+
+            if success:
+                st = self.get_upload_stats()
+                self.app.main_window.async_display(f">>> Uploaded {st['lines']} lines, {st['bytes']} bytes at {st['bps'] / 1024:.1f} KB/sec")
+                if self.upload_verify:
+                    success = await self._verify_upload(name, st['bytes'])
 
             self._redirect_incoming(None)
-            if f:
-                await f.close()
             self.progress = None
             self.file_streamer = None
             self.okcnt = None
@@ -1051,30 +1659,36 @@ class Comms():
 
         return success
 
+    async def _verify_upload(self, name, size):
+        ''' check the size of the file in the sd listing is what we sent '''
+        f = async_main_loop.create_future()
+
+        def rcv(ll):
+            # lines are name size
+            p = ll.split()
+            if len(p) >= 2 and p[0].lower() == name and not f.done():
+                f.set_result(p[-1])
+
+        # we are already redirected so just change where the lines go
+        self._reroute_incoming_data_to = rcv
+        self._write("ls -s /sd\n")
+        try:
+            actual = int(await asyncio.wait_for(f, UPLOAD_VERIFY_TIMEOUT))
+        except (asyncio.TimeoutError, ValueError):
+            actual = None
+
+        if actual == size:
+            self.app.main_window.async_display(f">>> Verified /sd/{name} is {size} bytes")
+            return True
+
+        self.log.error(f'Comms: Upload verify failed for /sd/{name}: expected {size} bytes, got {actual}')
+        self.app.main_window.async_display(f"error: upload verify failed, /sd/{name} is {'missing' if actual is None else f'{actual} bytes'}, expected {size} bytes")
+        return False
+
     def release_m0(self):
         if self.m0:
             self.m0.set()
 
-    @staticmethod
-    def file_len(fname, all=False):
-        # TODO if windows use a slow python method
-        if not all:
-            # use external process to quickly find total number of G/M lines in file
-            # NOTE some laser raster formats have lines that start with X and no G/M
-            # and some CAM programs just output X or Y lines
-            p = subprocess.Popen(['grep', '-c', "^[GMXY]", fname], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            result, err = p.communicate()
-            if p.returncode != 0:
-                raise IOError(err)
-            return int(result.strip().split()[0])
-        else:
-            # count all lines
-            p = subprocess.Popen(['wc', fname], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            result, err = p.communicate()
-            if p.returncode != 0:
-                raise IOError(err)
-            return int(result.strip().split()[0])
-
 
 if __name__ == "__main__":
 
@@ -1130,7 +1744,7 @@ if __name__ == "__main__":
         def action_paused(self, flag, suspend=False):
             print("paused: {}, suspended: {}", flag, suspend)
 
-        def get_queries(self):
+        def get_queries(self, busy_ok=False):
             return ""
 
         def wait_on_m0(self, ll):
@@ -1138,35 +1752,40 @@ if __name__ == "__main__":
 
     start = None
     nlines = None
+    eta_model = None
     app = CommsApp()
     quiet = False
 
     def display_progress(n):
-        global start, nlines, quiet, app
+        global start, nlines, quiet, app, eta_model
 
         if nlines:
             if quiet:
                 print(f"progress: {n},{nlines}")
             else:
                 now = datetime.datetime.now()
-                d = (now - start).seconds
-                if n > 10 and d > 10:
-                    # we have to wait a bit to get reasonable estimates
-                    lps = n / d
-                    eta = (nlines - n) / lps
+                if eta_model is not None:
+                    eta, done = eta_model.update(n, (now - start).total_seconds())
                 else:
-                    eta = 0
+                    d = (now - start).seconds
+                    if n > 10 and d > 10:
+                        # we have to wait a bit to get reasonable estimates
+                        lps = n / d
+                        eta = (nlines - n) / lps
+                    else:
+                        eta = 0
+                    done = n / nlines
                 et = datetime.timedelta(seconds=int(eta))
-                print(f"ETA: {et} {n}/{nlines} {n / nlines:.1%}")
+                print(f"ETA: {et} {n}/{nlines} {done:.1%}")
 
     def upload_done(x):
         app.ok = x
         app.end_event.set()
 
     def main():
-        global start, nlines, app, quiet
+        global start, nlines, app, quiet, eta_model
         if len(sys.argv) < 3:
-            print(f"Usage: {sys.argv[0]} port file [-u] [-f] [-q] [-d]")
+            print(f"Usage: {sys.argv[0]} port file [-u] [-f] [-wN] [-q] [-d]")
             exit(1)
 
         upload = False
@@ -1182,6 +1801,10 @@ if __name__ == "__main__":
                 app.fast_stream = True
                 comms.fast_stream = True
                 print('Fast Stream')
+            elif a.startswith('-w'):
+                # character counting with a window of N bytes (default 128)
+                comms.stream_window = int(a[2:]) if len(a) > 2 else 128
+                print(f'Character counting stream, window: {comms.stream_window}')
             elif a == '-d':
                 loglevel = logging.DEBUG
             elif a == '-q':
@@ -1192,8 +1815,11 @@ if __name__ == "__main__":
         logging.basicConfig(format='%(levelname)s:%(message)s', level=loglevel)
 
         try:
-            nlines = Comms.file_len(sys.argv[2], app.fast_stream)  # get number of lines so we can do progress and ETA
-            print(f'number of lines: {nlines}')
+            pf = get_preflight(sys.argv[2])  # get number of lines so we can do progress and ETA
+            nlines = pf.lines if app.fast_stream else pf.gcode_lines
+            if not (upload or app.fast_stream):
+                eta_model = Eta(pf)
+            print(f'number of lines: {nlines}, {pf.summary()}')
         except Exception:
             print(f'Exception: {traceback.format_exc()}')
             nlines = None
@@ -0,0 +1,119 @@
+# bounded model of the lines shown in the console
+#
+# The last `capacity` lines are kept in a ring buffer, lines that fall off the end are spilled to a rotating
+# log file so they can still be searched. Lines added since the view was last updated are collected so the
+# view can be updated once per frame with a single extend (and an occasional trim) instead of once per line.
+
+import collections
+import logging
+import os
+
+CONSOLE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'smoopi', 'console')
+SPILL_SIZE = 1024 * 1024  # size of each spill file before it is rotated
+SPILL_BACKUPS = 3  # number of old spill files kept
+
+
+class ConsoleLog():
+    """ ring buffer of console lines with a rotating spill file """
+
+    def __init__(self, capacity=200, name=None):
+        ''' name is the name of the spill file, None to not spill '''
+        self.lines = collections.deque(maxlen=capacity)
+        self.spill_path = None if name is None else os.path.join(CONSOLE_DIR, f'{name}.log')
+        self._spill_file = None
+        self._new = []  # lines added since the last sync
+        self._last = None  # replacement for the last line already in the view
+        self._spill = []  # lines that fell out of the ring since the last sync
+
+    @property
+    def capacity(self):
+        return self.lines.maxlen
+
+    def set_capacity(self, capacity):
+        if capacity != self.lines.maxlen:
+            # the oldest lines that no longer fit are spilled like any other line that falls out of the ring
+            for _ in range(len(self.lines) - capacity):
+                self._spill.append(self.lines.popleft())
+            self.lines = collections.deque(self.lines, maxlen=capacity)
+
+    def append(self, s, overwrite=False):
+        ''' add a line, or replace the last line if overwrite is True '''
+        if overwrite and self.lines:
+            self.lines[-1] = s
+            if self._new:
+                self._new[-1] = s
+            else:
+                self._last = s
+            return
+
+        if len(self.lines) == self.lines.maxlen:
+            self._spill.append(self.lines[0])
+        self.lines.append(s)
+        self._new.append(s)
+
+    def clear(self):
+        self.lines.clear()
+        self._new = []
+        self._last = None
+
+    def sync(self):
+        ''' returns (replacement for the last line in the view or None, list of new lines) since the last sync, and spills any old lines '''
+        last, new = self._last, self._new
+        self._last = None
+        self._new = []
+        if self._spill:
+            self._write_spill(self._spill)
+            self._spill = []
+        return last, new
+
+    def _write_spill(self, lines):
+        if self.spill_path is None:
+            return
+        try:
+            if self._spill_file is None:
+                os.makedirs(CONSOLE_DIR, exist_ok=True)
+                self._spill_file = open(self.spill_path, 'a', encoding='utf-8', errors='replace')
+            self._spill_file.write('\n'.join(lines))
+            self._spill_file.write('\n')
+            self._spill_file.flush()
+            if self._spill_file.tell() > SPILL_SIZE:
+                self._rotate()
+        except OSError as e:
+            logging.getLogger().warning(f'ConsoleLog: could not write {self.spill_path}: {e}')
+            self.spill_path = None
+
+    def _rotate(self):
+        self._spill_file.close()
+        self._spill_file = None
+        for i in range(SPILL_BACKUPS - 1, 0, -1):
+            if os.path.exists(f'{self.spill_path}.{i}'):
+                os.replace(f'{self.spill_path}.{i}', f'{self.spill_path}.{i + 1}')
+        os.replace(self.spill_path, f'{self.spill_path}.1')
+
+    def spill_files(self):
+        ''' the spill files oldest first '''
+        if self.spill_path is None:
+            return []
+        files = [f'{self.spill_path}.{i}' for i in range(SPILL_BACKUPS, 0, -1)] + [self.spill_path]
+        return [f for f in files if os.path.exists(f)]
+
+    def search(self, text, limit=100):
+        ''' returns the last limit lines containing text (ignoring case) from the spill files and the ring '''
+        text = text.lower()
+        found = collections.deque(maxlen=limit)
+        # lines not yet spilled are older than the ones in the ring
+        for fn in self.spill_files():
+            with open(fn, encoding='utf-8', errors='replace') as f:
+                for ln in f:
+                    if text in ln.lower():
+                        found.append(ln.rstrip('\n'))
+        for ln in self._spill + list(self.lines):
+            if text in ln.lower():
+                found.append(ln)
+        return list(found)
+
+    def close(self):
+        self.sync()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
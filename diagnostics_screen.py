@@ -0,0 +1,113 @@
+from kivy.app import App
+from kivy.lang import Builder
+from kivy.uix.screenmanager import Screen
+from kivy.clock import Clock
+from kivy.properties import StringProperty
+import time
+
+Builder.load_string('''
+<DiagnosticsScreen>:
+    on_enter: self.start()
+    on_leave: self.stop()
+    BoxLayout:
+        canvas:
+            Color:
+                rgba: 0.3, 0.3, 0.3, 1
+            Rectangle:
+                size: self.size
+                pos: self.pos
+        orientation: 'vertical'
+        ScrollView:
+            scroll_type: ['bars', 'content']
+            bar_width: dp(10)
+            Label:
+                text: root.text
+                font_name: "RobotoMono-Regular.ttf"
+                font_size: 14
+                size_hint_y: None
+                height: self.texture_size[1]
+                text_size: self.width, None
+                padding: dp(8), dp(8)
+        BoxLayout:
+            size_hint_y: None
+            height: 40
+            Button:
+                text: 'Reset'
+                on_press: root.reset()
+            Button:
+                text: 'Back'
+                on_press: root.manager.current = 'main'
+''')
+
+
+class DiagnosticsScreen(Screen):
+    """ shows the comms metrics, updated once a second """
+    text = StringProperty()
+
+    def start(self):
+        self.app = App.get_running_app()
+        self.last = None
+        self.update()
+        self.ev = Clock.schedule_interval(self.update, 1.0)
+
+    def stop(self):
+        self.ev.cancel()
+
+    def reset(self):
+        self.app.comms.metrics.reset()
+        self.last = None
+        self.update()
+
+    def _rate(self, snap, now, name):
+        ''' per second rate of a counter since the last update '''
+        if self.last is None:
+            return 0.0
+        t, last = self.last
+        dt = now - t
+        return (snap[name] - last[name]) / dt if dt > 0 else 0.0
+
+    @staticmethod
+    def _hist(h):
+        ms = 1000.0
+        return f"n {h['count']:<8} avg {h['avg'] * ms:8.3f}  p50 {h['p50'] * ms:8.3f}  p99 {h['p99'] * ms:8.3f}  max {h['max'] * ms:8.3f} ms"
+
+    def update(self, *args):
+        comms = self.app.comms
+        snap = comms.metrics.snapshot()
+        now = time.monotonic()
+
+        ll = [
+            f"Connected:    {self.app.is_connected}",
+            f"Uptime:       {snap['uptime']:.0f} secs",
+            "",
+            f"Lines sent:   {snap['lines_sent_total']:<10} {self._rate(snap, now, 'lines_sent_total'):8.1f} lines/sec",
+            f"TX bytes:     {snap['tx_bytes_total']:<10} {self._rate(snap, now, 'tx_bytes_total'):8.1f} bytes/sec",
+            f"RX bytes:     {snap['rx_bytes_total']:<10} {self._rate(snap, now, 'rx_bytes_total'):8.1f} bytes/sec",
+            f"oks:          {snap['oks_total']}",
+            f"Errors:       {snap['errors_total']}",
+            f"Alarms:       {snap['alarms_total']}",
+            f"Write pauses: {snap['write_pauses_total']}",
+            f"Drains:       {snap['drains_total']}",
+            f"Connects:     {snap['connects_total']}",
+            f"Reconnects:   {snap['reconnects_total']}",
+            "",
+            f"ok RTT:        {self._hist(snap['ok_rtt_seconds'])}",
+            f"Drain wait:    {self._hist(snap['drain_wait_seconds'])}",
+            f"Loop lag:      {self._hist(snap['loop_lag_seconds'])}",
+            f"incoming_data: {self._hist(snap['incoming_data_seconds'])}",
+            f"Poll RTT:      {self._hist(snap['poll_rtt_seconds'])}",
+            f"Reconnect:     {self._hist(snap['reconnect_seconds'])}",
+            f"Realtime cmd:  {self._hist(snap['realtime_latency_seconds'])}",
+        ]
+
+        st = comms.get_poll_stats()
+        if st:
+            ll.append("")
+            ll.append(f"Poll interval: {st['interval']:.2f} secs, {st['polls']} polls, {st['tx_bps']:.1f} tx bytes/sec, {st['rx_bps']:.1f} rx bytes/sec")
+
+        ws = comms.get_write_stats()
+        if ws:
+            ll.append(f"Serial writes: {ws['writes']} writes, {ws['bytes']} bytes, {ws['bytes_per_write']:.1f} bytes/write")
+
+        self.text = '\n'.join(ll)
+        self.last = (now, snap)
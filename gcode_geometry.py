@@ -0,0 +1,507 @@
+# vectorized extraction of the geometry in a gcode file for the viewer
+#
+# The text is tokenized a chunk at a time with NumPy and one regex for the values, then the words are scattered into one row per G code
+# and the modal state (G code, absolute/relative, position, S) is resolved with NumPy operations instead of
+# per line python code. The result is arrays of segment start and end points with the motion type, feed, S
+# and E of each segment, and the bounds of everything read.
+#
+# This follows the same rules as the line by line parser in the viewer (which is still used for drill files
+# and when numpy is not available).
+
+import math
+import re
+
+try:
+    import numpy as np
+    numpy_available = True
+except Exception:
+    numpy_available = False
+
+# segment kinds
+CUT = 0  # G1 with E (or any G1 if not a 3D print), G2 and G3
+RAPID = 1  # G0
+MOVE = 2  # G1 with no E in a 3D print
+
+ARC_SEGMENTS = 64  # segments in a full circle
+CHUNK_SIZE = 4 * 1024 * 1024  # text is processed in chunks of about this size
+FIRST_CHUNK_SIZE = 128 * 1024  # chunks start this small and double so the first geometry is available quickly
+LOD_PIXELS = 1.0  # the toolpath is simplified to about this many pixels at the current zoom
+LOD_MAX_SEGMENTS = 250000  # most segments drawn if the vectors setting is unlimited
+RAPID_DASH = 1.0  # length of the dashes and of the gaps between them the rapids are drawn with
+
+_WORDS = 'GXYZIJESF'
+_values = re.compile(rb"[GXYZIJKESF](-?\d*\.?\d*\.?)")
+# same comment stripping as strip_gcode_line, lines starting with ( # or $ are dropped entirely
+_comments = re.compile(rb"^[ \t]*[(#$;].*$|;.*$|\([^)\n]*\)?", re.MULTILINE)
+
+if numpy_available:
+    # the bytes that start a token, the words and newline
+    _token_start = np.zeros(256, dtype=bool)
+    _token_start[list(b'GXYZIJKESF\n')] = True
+
+
+class ParseState():
+    """ The modal state carried from one chunk or band to the next """
+    __slots__ = ('x', 'y', 'z', 'modal_g', 'rel_move', 'laste', 'lasts', 'has_e', 'feed')
+
+    def __init__(self, x=None, y=None, z=None, modal_g=0, rel_move=False, laste=0, lasts=1, has_e=False):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.modal_g = modal_g
+        self.rel_move = rel_move
+        self.laste = laste
+        self.lasts = lasts
+        self.has_e = has_e
+        self.feed = math.nan
+
+
+class Geometry():
+    """ Segments extracted from a gcode file """
+
+    def __init__(self):
+        self.segments = np.zeros((0, 4))  # x0, y0, x1, y1
+        self.kind = np.zeros(0, dtype=np.uint8)
+        self.feed = np.zeros(0)
+        self.s = np.zeros(0)
+        self.e = np.zeros(0)
+        self.bounds = [math.nan] * 6  # min x, min y, min z, max x, max y, max z
+        self.last_z = None
+        self.too_many = False
+
+    @property
+    def point_count(self):
+        return len(self.segments)
+
+    @classmethod
+    def join(cls, parts):
+        ''' returns a Geometry with all the parts joined in order '''
+        g = cls()
+        if not parts:
+            return g
+        g.segments = np.concatenate([p.segments for p in parts])
+        g.kind = np.concatenate([p.kind for p in parts])
+        g.feed = np.concatenate([p.feed for p in parts])
+        g.s = np.concatenate([p.s for p in parts])
+        g.e = np.concatenate([p.e for p in parts])
+        b = np.array([p.bounds for p in parts], dtype=float)
+        with np.errstate(all='ignore'):
+            g.bounds = np.concatenate((np.fmin.reduce(b[:, 0:3]), np.fmax.reduce(b[:, 3:6]))).tolist()
+        for p in parts:
+            if p.last_z is not None:
+                g.last_z = p.last_z
+        g.too_many = any(p.too_many for p in parts)
+        return g
+
+
+def _ffill(a, init):
+    ''' forward fill the NaNs in a with the last value before them, or init '''
+    idx = np.where(np.isnan(a), 0, np.arange(1, len(a) + 1))
+    np.maximum.accumulate(idx, out=idx)
+    return np.concatenate(([init], a))[idx]
+
+
+def _shift(a, init):
+    ''' the value of the previous row '''
+    return np.concatenate(([init], a[:-1]))
+
+
+def _axis(v, has, rel, init, known):
+    # absolute moves set the position, relative moves add to it (from 0 if the position is not known yet)
+    inc = np.where(rel & has, v, 0.0)
+    c = np.cumsum(inc)
+    base = np.where(~rel & has, v - c, np.nan)
+    return _ffill(base, init if known else 0.0) + c
+
+
+def _nan(v):
+    return math.nan if v is None else v
+
+
+def _float(v):
+    try:
+        return float(v)
+    except ValueError:
+        return math.nan
+
+
+def _tokenize(data):
+    ''' returns the rows of words in the data as a dict of column arrays, NaN where the word is not present '''
+    if b'(' in data or b';' in data or b'#' in data or b'$' in data:
+        data = _comments.sub(b'', data)
+    buf = np.frombuffer(data, dtype=np.uint8)
+    lt = buf[_token_start[buf]]
+    if len(lt) == 0:
+        return None, 0
+
+    # the value of every word, in the same order as the words in lt
+    vals = _values.findall(data)
+    try:
+        v = np.fromiter(map(float, vals), dtype=float, count=len(vals))
+    except ValueError:
+        v = np.array([_float(x) for x in vals], dtype=float)
+    val = np.full(len(lt), np.nan)
+    val[lt != 10] = v
+
+    # a new row starts at each line, and at each extra G code on the same line
+    nl = lt == 10
+    isg = lt == 71  # G
+    cg = np.cumsum(isg)
+    line_g = np.maximum.accumulate(np.where(nl, cg, 0))
+    second_g = isg & (cg - isg - line_g >= 1)
+    row = np.cumsum(nl | second_g)
+    nrows = int(row[-1]) + 1
+
+    cols = {}
+    for c in _WORDS:
+        col = np.full(nrows, np.nan)
+        m = lt == ord(c)
+        col[row[m]] = val[m]
+        cols[c] = col
+
+    return cols, nrows
+
+
+def extract_chunk(data, st, twod_mode=False, laser_mode=False, above=-math.inf, below=math.inf):
+    ''' extract the segments from a chunk of complete lines of bytes, st is the ParseState which is updated '''
+    g = Geometry()
+    cols, nrows = _tokenize(data)
+    if cols is None:
+        return g
+
+    G = cols['G']
+    has = {c: ~np.isnan(cols[c]) for c in _WORDS}
+    hasG = has['G']
+
+    # rows with no G code take the modal one if they have X, Y, Z or S, any others are ignored
+    keep = hasG | has['X'] | has['Y'] | has['Z'] | has['S']
+    modal = _ffill(np.where(hasG & (G <= 3), G, np.nan), st.modal_g)
+    gcode = np.where(hasG, G, modal)
+
+    # G92 E0 resets E, and any E on a G1 means this is a 3D print
+    has_e = np.logical_or.accumulate(((gcode == 92) | (gcode == 1)) & has['E'] & keep) | st.has_e
+    rel = _ffill(np.where((gcode == 90) | (gcode == 91), gcode == 91, np.nan), st.rel_move).astype(bool)
+
+    # F is modal on its own line too
+    feed = _ffill(cols['F'], st.feed)
+    end_feed = float(feed[-1])
+
+    # only deal with G0/1/2/3
+    keep &= gcode <= 3
+    end_modal = modal[-1] if nrows else st.modal_g
+    end_rel = bool(rel[-1])
+    end_has_e = bool(has_e[-1])
+    if not keep.any():
+        st.modal_g = int(end_modal)
+        st.rel_move = end_rel
+        st.has_e = end_has_e
+        st.feed = end_feed
+        return g
+
+    gcode = gcode[keep].astype(np.int8)
+    rel = rel[keep]
+    has_e = has_e[keep]
+    v = {c: cols[c][keep] for c in _WORDS}
+    h = {c: has[c][keep] for c in _WORDS}
+
+    s = _ffill(v['S'], st.lasts)
+    e = _ffill(v['E'], st.laste)
+    feed = feed[keep]
+
+    xknown = np.logical_or.accumulate(h['X']) | (st.x is not None)
+    yknown = np.logical_or.accumulate(h['Y']) | (st.y is not None)
+    zknown = np.logical_or.accumulate(~rel & h['Z']) | (st.z is not None)
+    x = _axis(v['X'], h['X'], rel, st.x, st.x is not None)
+    y = _axis(v['Y'], h['Y'], rel, st.y, st.y is not None)
+    # a relative Z is ignored until Z is known
+    z = _axis(v['Z'], h['Z'] & (~rel | _shift(zknown, st.z is not None)), rel, st.z, st.z is not None)
+    z[~zknown] = np.nan
+
+    valid = xknown & yknown
+    px = _shift(x, _nan(st.x))
+    py = _shift(y, _nan(st.y))
+    pvalid = _shift(valid, st.x is not None and st.y is not None)
+
+    # carry the state to the next chunk
+    st.x = float(x[-1]) if xknown[-1] else None
+    st.y = float(y[-1]) if yknown[-1] else None
+    st.z = float(z[-1]) if zknown[-1] else None
+    st.modal_g = int(end_modal)
+    st.rel_move = end_rel
+    st.has_e = end_has_e
+    st.lasts = float(s[-1])
+    st.laste = float(e[-1])
+    st.feed = end_feed
+
+    # bounds of everything with a known position
+    if valid.any():
+        g.bounds = [np.min(x[valid]), np.min(y[valid]), np.nanmin(z[valid]) if zknown[valid].any() else math.nan,
+                    np.max(x[valid]), np.max(y[valid]), np.nanmax(z[valid]) if zknown[valid].any() else math.nan]
+        zv = z[valid & zknown]
+        g.last_z = float(zv[-1]) if len(zv) else None
+
+    draw = valid & pvalid
+    if twod_mode:
+        # in CNC mode we only want to see cuts within the slice
+        draw &= ~((gcode > 0) & zknown & ((z < above) | (z > below)))
+
+    g1xy = (gcode == 1) & (h['X'] | h['Y'])
+    if laser_mode:
+        # do not draw non cutting lines
+        g1xy &= s > 0.01
+
+    cut = draw & g1xy & (~has_e | h['E'])
+    move = draw & g1xy & has_e & ~h['E']
+    rapid = draw & (gcode == 0)
+    arc = draw & (gcode >= 2)
+
+    n = len(gcode)
+    seg = np.column_stack((px, py, x, y))
+    kind = np.full(n, 255, dtype=np.uint8)
+    kind[cut] = CUT
+    kind[move] = MOVE
+    kind[rapid] = RAPID
+
+    # tessellate arcs into short segments
+    ai = np.flatnonzero(arc)
+    if len(ai):
+        x0, y0, x1, y1 = px[ai], py[ai], x[ai], y[ai]
+        cx = x0 + np.nan_to_num(v['I'][ai])
+        cy = y0 + np.nan_to_num(v['J'][ai])
+        r = np.hypot(x0 - cx, y0 - cy)
+        a0 = np.arctan2(y0 - cy, x0 - cx)
+        a1 = np.arctan2(y1 - cy, x1 - cx)
+        cw = gcode[ai] == 2
+        sweep = np.where(cw, a0 - a1, a1 - a0)
+        sweep = np.where(sweep <= 0, sweep + 2 * math.pi, sweep)  # same start and end is a full circle
+        sweep = np.where(cw, -sweep, sweep)
+        nseg = np.clip(np.ceil(np.abs(sweep) / (2 * math.pi / ARC_SEGMENTS)), 1, ARC_SEGMENTS).astype(np.int64)
+        which = np.repeat(np.arange(len(ai)), nseg)
+        k = np.arange(nseg.sum()) - np.repeat(np.cumsum(nseg) - nseg, nseg)
+        t0 = a0[which] + sweep[which] * k / nseg[which]
+        t1 = a0[which] + sweep[which] * (k + 1) / nseg[which]
+        rr = r[which]
+        aseg = np.column_stack((cx[which] + rr * np.cos(t0), cy[which] + rr * np.sin(t0), cx[which] + rr * np.cos(t1), cy[which] + rr * np.sin(t1)))
+
+        # arcs go out from the end points so include them in the bounds
+        b = g.bounds
+        b[0] = np.fmin(b[0], aseg[:, 2].min())
+        b[1] = np.fmin(b[1], aseg[:, 3].min())
+        b[3] = np.fmax(b[3], aseg[:, 2].max())
+        b[4] = np.fmax(b[4], aseg[:, 3].max())
+
+        # put the arc segments in place of the arc rows so everything stays in file order
+        reps = np.ones(n, dtype=np.int64)
+        reps[ai] = nseg
+        order = np.repeat(np.arange(n), reps)
+        seg = seg[order]
+        kind = kind[order]
+        is_arc = np.repeat(arc, reps)
+        seg[is_arc] = aseg
+        kind[is_arc] = CUT
+        feed = feed[order]
+        s = s[order]
+        e = e[order]
+
+    m = kind != 255
+    g.segments = seg[m]
+    g.kind = kind[m]
+    g.feed = feed[m]
+    g.s = s[m]
+    g.e = e[m]
+    return g
+
+
+def mesh_batches(segments, max_vertices=65535, dash=None):
+    ''' pack segments into (vertices, indices) lists for Kivy Meshes in lines mode
+
+        connected segments share their vertices, each batch has at most max_vertices as Mesh indices are 16 bit
+        the vertices are in the default x, y, u, v format, if dash is given u is the distance along each run of
+        connected segments over twice dash, so a texture that is opaque for the first half of u draws them dashed
+    '''
+    batches = []
+    per_batch = max_vertices // 2  # worst case is no shared vertices
+    for b in range(0, len(segments), per_batch):
+        seg = segments[b:b + per_batch]
+        n = len(seg)
+        # a segment needs its own start vertex unless it starts where the previous one ended
+        new = np.ones(n, dtype=bool)
+        new[1:] = (seg[1:, 0] != seg[:-1, 2]) | (seg[1:, 1] != seg[:-1, 3])
+        nv = n + np.count_nonzero(new)
+        # each segment adds its end vertex, plus a start vertex if it is new,
+        # either way it starts at the vertex before its end vertex
+        end_idx = np.cumsum(new.astype(np.int64) + 1) - 1
+        verts = np.zeros((nv, 4))
+        verts[end_idx, 0:2] = seg[:, 2:4]
+        verts[end_idx[new] - 1, 0:2] = seg[new, 0:2]
+        if dash is not None:
+            d = np.hypot(seg[:, 2] - seg[:, 0], seg[:, 3] - seg[:, 1])
+            end = np.cumsum(d)
+            # each run starts at u = 0, so take off the distance to the start of the run it is in
+            first = np.maximum.accumulate(np.where(new, np.arange(n), 0))
+            verts[end_idx, 2] = (end - (end[first] - d[first])) / (2 * dash)
+        indices = np.column_stack((end_idx - 1, end_idx)).ravel()
+        batches.append((verts.ravel().tolist(), indices.tolist()))
+
+    return batches
+
+
+def clip(segments, kind, box):
+    ''' returns the segments and kinds that are not entirely outside box (min x, min y, max x, max y) '''
+    x0, y0, x1, y1 = box
+    sx = segments[:, 0::2]
+    sy = segments[:, 1::2]
+    keep = ((sx.max(axis=1) >= x0) & (sx.min(axis=1) <= x1) & (sy.max(axis=1) >= y0) & (sy.min(axis=1) <= y1))
+    return segments[keep], kind[keep]
+
+
+def decimate(segments, kind, tolerance, max_segments=-1):
+    ''' simplify the segments for display, tolerance is the size of a pixel in drawing units
+
+        the end points are snapped to a grid of that size, segments that collapse to a point are dropped and
+        duplicates of the same kind are removed, the order is kept so chains of segments stay connected.
+        if there are still more than max_segments the grid is doubled until there are not
+        returns (segments, kind, tolerance used)
+    '''
+    while True:
+        q = np.rint(segments / tolerance).astype(np.int64)
+        keep = (q[:, 0] != q[:, 2]) | (q[:, 1] != q[:, 3])
+        q = q[keep]
+        k = kind[keep]
+        # unique rows are found much faster as single opaque values
+        key = np.ascontiguousarray(np.column_stack((q, k.astype(np.int64))))
+        _, first = np.unique(key.view(np.dtype((np.void, key.itemsize * 5))).ravel(), return_index=True)
+        first.sort()
+        if max_segments <= 0 or len(first) <= max_segments:
+            return q[first] * tolerance, k[first], tolerance
+        tolerance *= 2
+
+
+def read_chunks(f, start=0, end=None, size=CHUNK_SIZE, first=None):
+    ''' yields the bytes of the file between start and end in chunks of complete lines
+        if first is given the chunks start at that size and double up to size
+    '''
+    f.seek(start)
+    rest = b''
+    pos = start
+    n = size if first is None else min(first, size)
+    while end is None or pos < end:
+        blk = f.read(n if end is None else min(n, end - pos))
+        if not blk:
+            break
+        pos += len(blk)
+        n = min(n * 2, size)
+        blk = rest + blk
+        p = blk.rfind(b'\n')
+        if p < 0:
+            rest = blk
+            continue
+        rest = blk[p + 1:]
+        yield blk[:p + 1]
+
+    if rest:
+        yield rest + b'\n'
+
+
+def extract_parts(fn, spans, states, twod_mode=False, laser_mode=False, above=-math.inf, below=math.inf, max_segments=-1, cancel=None):
+    ''' generator version of extract which yields (geometry, bytes read) for each chunk as it is extracted
+        so it can be displayed progressively, the last part has too_many set if it stopped early
+    '''
+    count = 0
+    done = 0
+    with open(fn, 'rb') as f:
+        for (start, end), st in zip(spans, states):
+            for blk in read_chunks(f, start, end, first=FIRST_CHUNK_SIZE):
+                if cancel is not None and cancel():
+                    return
+                g = extract_chunk(blk, st, twod_mode, laser_mode, above, below)
+                done += len(blk)
+                count += g.point_count
+                if max_segments > 0 and count > max_segments:
+                    g.too_many = True
+                    yield g, done
+                    return
+                yield g, done
+
+
+def extract(fn, spans, states, twod_mode=False, laser_mode=False, above=-math.inf, below=math.inf, max_segments=-1, cancel=None):
+    ''' extract the geometry from each (start, end) span of the file, states is the ParseState at the start of each span
+
+        stops once more than max_segments have been extracted if it is > 0
+        cancel is an optional callable which returns True to stop, in which case None is returned
+    '''
+    parts = [g for g, _ in extract_parts(fn, spans, states, twod_mode, laser_mode, above, below, max_segments, cancel)]
+    if cancel is not None and cancel():
+        return None
+    return Geometry.join(parts)
+
+
+def view_batches(segments, kind):
+    ''' the mesh batches of the cuts, of the moves and of the rapids, which the viewer draws differently '''
+    return (mesh_batches(segments[kind == CUT]), mesh_batches(segments[kind == MOVE]),
+            mesh_batches(segments[kind == RAPID], dash=RAPID_DASH))
+
+
+def parse_view(fn, idx, twod_mode, laser_mode, above, below, start, width, height, max_segments=LOD_MAX_SEGMENTS,
+               cancel=None, started=None, chunk=None):
+    ''' the viewer's parse of a file with its GcodeIndex, run in a thread when the file is opened
+
+        In 2D mode the bands that cut between above and below are read, otherwise the layer starting at file position
+        start. The whole of it is simplified to about a pixel at the scale it fits in width x height pixels, and the
+        full resolution is kept for when it is zoomed in.
+        started(bounds, z) is called once the bounds are known, before any of the file is read, and
+        chunk(cuts, moves, rapids, fraction done) with the view_batches of each chunk as it is read.
+        returns (next layer, (segments, kind), tolerance, batches), where batches is None unless the chunks drew more
+        than max_segments and it all had to be simplified again, or None if the layer is empty or it was cancelled
+    '''
+    if twod_mode:
+        # only read the bands that cut within the current slice, scaled to the extents of the whole file
+        spans = idx.slice_spans(above, below)
+        states = [ParseState(*idx.band_state(b)) for s, e, b in spans]
+        bounds = idx.bounds
+        z = above
+    else:
+        # the bounds of the layer are known from the index so it can be scaled before any of it is read
+        spans = [(start, idx.layer_end(start), None)]
+        states = [ParseState()]
+        z, min_x, min_y, max_x, max_y = idx.layer_at(start)
+        bounds = (min_x, min_y, z, max_x, max_y, z)
+        if z is None:
+            return None
+        if not all(math.isfinite(v) for v in (min_x, min_y, max_x, max_y)):
+            bounds = idx.bounds
+
+    if started is not None:
+        started(bounds, z)
+
+    dx = abs(bounds[3] - bounds[0]) + 4
+    dy = abs(bounds[4] - bounds[1]) + 4
+    tol = LOD_PIXELS / min(width / dx, height / dy)
+    if not math.isfinite(tol) or tol <= 0:
+        tol = None
+
+    total = max(sum((idx.size if e is None else e) - s for s, e, b in spans), 1)
+    parts = []
+    drawn = 0
+    for g, done in extract_parts(fn, [(s, e) for s, e, b in spans], states, twod_mode, laser_mode, above, below, cancel=cancel):
+        parts.append(g)
+        seg, kind = g.segments, g.kind
+        if tol is not None:
+            seg, kind, _ = decimate(seg, kind, tol)
+        drawn += len(seg)
+        # the vertices are built here too so the main thread only has to make the meshes
+        batches = view_batches(seg, kind)
+        if chunk is not None:
+            chunk(*batches, done / total)
+
+    if cancel is not None and cancel():
+        return None
+
+    full = Geometry.join(parts)
+    full = (full.segments.astype('float32'), full.kind)
+    batches = None
+    if tol is not None and drawn > max_segments:
+        # each chunk was simplified on its own, simplify it all together until it fits
+        batches = view_batches(*decimate(*full, tol, max_segments)[0:2])
+
+    return (None if twod_mode else spans[0][1], full, tol, batches)
@@ -0,0 +1,437 @@
+# one pass index of a gcode file for the viewer
+#
+# The index records the byte offset of each 3D layer (using the same rules the viewer uses to find layers)
+# and splits the file into bands of about BAND_SIZE bytes, recording the Z range moved through in each band and the
+# parser state at the start of it. The viewer can then seek straight to a layer, or only parse the bands that
+# move within a CNC slice, instead of rescanning the whole file.
+#
+# The index is saved in a compact binary file in the cache directory, keyed by the path, size and mtime of
+# the gcode file, so later opens do not need to scan the file at all.
+
+from array import array
+import bisect
+import hashlib
+import logging
+import math
+import os
+import re
+import struct
+
+INDEX_VERSION = 3
+BAND_SIZE = 256 * 1024
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'smoopi', 'index')
+
+# magic, version, size, mtime_ns, number of layers, number of bands, lines, segments, bounds
+_HEADER = struct.Struct('<4sIqqqqqq6d')
+_MAGIC = b'SMIX'
+
+# parser state saved at the start of each band, NaN is None
+# x, y, z, modal_g, rel_move, laste, lasts, has_e
+STATE_SIZE = 8
+
+extract_gcode = re.compile(r"(G|X|Y|Z|I|J|K|E|S)(-?\d*\.?\d*\.?)")
+
+
+def strip_gcode_line(ln):
+    ''' strip comments from a gcode line, returns an empty string if there is nothing left to parse '''
+    ln = ln.strip()
+    if not ln:
+        return ''
+    # skip comments and $ commands
+    if ln[0] in ';#$(':
+        return ''
+    p = ln.find(';')
+    if p >= 0:
+        ln = ln[:p]
+    p = ln.find('(')
+    if p >= 0:
+        p2 = ln.find(')')
+        lnt = ln[:p]
+        if p2 > 0:
+            lnt += ln[p2 + 1:]
+        ln = lnt
+    return ln
+
+
+def split_gcodes(ln):
+    ''' returns a list of dicts of the words on a stripped line, one for each G code on the line '''
+    matches = extract_gcode.findall(ln)
+
+    # this handles multiple G codes on one line
+    gcodes = []
+    d = {}
+    for m in matches:
+        if m[0] == 'G' and 'G' in d:
+            # we have another G code on the same line
+            gcodes.append(d)
+            d = {}
+        d[m[0]] = float(m[1])
+
+    gcodes.append(d)
+    return gcodes
+
+
+def arc_geometry(x0, y0, x1, y1, i, j, clockwise):
+    ''' returns center, radius, start and end angles, swept angle and the point the sweep starts at for a G2/G3 '''
+    centerX, centerY = (x0 + i, y0 + j)
+
+    sX = x0 - centerX
+    sY = y0 - centerY
+    eX = x1 - centerX
+    eY = y1 - centerY
+
+    if clockwise:
+        angleA = math.atan2(sY, sX)
+        angleB = math.atan2(eY, eX)
+        angle = angleA - angleB
+        p1 = x1
+        p2 = y1
+    else:
+        angleB = math.atan2(sY, sX)
+        angleA = math.atan2(eY, eX)
+        angle = angleB - angleA
+        p2 = y0
+        p1 = x0
+
+    if angle == 0:
+        angle = math.radians(360)
+    elif angle < 0:
+        angle = -angle
+
+    if angleA <= angleB:
+        angleA += 2.0 * math.pi
+
+    radius = math.sqrt(sX * sX + sY * sY)
+    return (centerX, centerY, radius, angleA, angleB, angle, p1, p2)
+
+
+# find the list of N points on the arc
+def arc_extents(cx, cy, px, py, theta, N):
+    points = []
+    dx = px - cx
+    dy = py - cy
+    ctheta = math.cos(theta / (N - 1))
+    stheta = math.sin(theta / (N - 1))
+    p = (cx + dx, cy + dy)
+    points.append(p)
+    for i in range(1, N):
+        dxtemp = ctheta * dx - stheta * dy
+        dy = stheta * dx + ctheta * dy
+        dx = dxtemp
+        p = (cx + dx, cy + dy)
+        points.append(p)
+
+    return points
+
+
+def _nan(v):
+    return float('nan') if v is None else float(v)
+
+
+def _none(v):
+    return None if math.isnan(v) else v
+
+
+class GcodeIndex():
+    """ Layer offsets and Z bands of a gcode file """
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.size = 0
+        self.mtime = 0
+        self.nlines = 0
+        self.nsegments = 0
+        # min x, min y, min z, max x, max y, max z of everything in the file
+        self.bounds = [float('nan')] * 6
+        # 3D layers
+        self.layer_offsets = array('q')
+        self.layer_z = array('d')
+        self.layer_segments = array('q')
+        self.layer_bounds = array('d')  # min x, min y, max x, max y for each layer
+        # bands
+        self.band_offsets = array('q')
+        self.band_z = array('d')  # min z, max z moved through in each band, +/-inf if Z was unknown
+        self.band_states = array('d')  # STATE_SIZE values for each band
+
+    def layer_end(self, pos):
+        ''' returns the offset of the start of the layer after the one containing pos, or None if it is the last layer '''
+        # the first layer may start after some setup moves which are still part of it
+        i = max(bisect.bisect_right(self.layer_offsets, pos), 1)
+        return self.layer_offsets[i] if i < len(self.layer_offsets) else None
+
+    def layer_at(self, pos):
+        ''' returns (z, min x, min y, max x, max y) of the layer containing pos '''
+        i = max(bisect.bisect_right(self.layer_offsets, pos), 1) - 1
+        return (_none(self.layer_z[i]), *self.layer_bounds[i * 4:i * 4 + 4])
+
+    def band_state(self, n):
+        ''' returns the parser state at the start of band n as (x, y, z, modal_g, rel_move, laste, lasts, has_e) '''
+        x, y, z, g, rel, e, s, has_e = self.band_states[n * STATE_SIZE:(n + 1) * STATE_SIZE]
+        return (_none(x), _none(y), _none(z), int(g), bool(rel), e, s, bool(has_e))
+
+    def slice_spans(self, above, below):
+        ''' returns a list of (start, end, band) for the runs of bands that move between the Z above and below '''
+        spans = []
+        n = len(self.band_offsets)
+        for b in range(n):
+            zmin, zmax = self.band_z[b * 2], self.band_z[b * 2 + 1]
+            if zmax < above or zmin > below:
+                continue
+            end = self.band_offsets[b + 1] if b + 1 < n else None
+            if spans and spans[-1][1] == self.band_offsets[b]:
+                # extend contiguous bands
+                spans[-1] = (spans[-1][0], end, spans[-1][2])
+            else:
+                spans.append((self.band_offsets[b], end, b))
+        return spans
+
+    def build(self, fn, cancel=None, progress=None):
+        ''' scan the file once, cancel is an optional callable that returns True to abort the scan
+            progress is an optional callable that is given the fraction of the file scanned so far
+        '''
+        st = os.stat(fn)
+        self.fn = fn
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+
+        lastpos = [None, None, None]
+        x = y = z = None
+        modal_g = 0
+        rel_move = False
+        laste = 0
+        lasts = 1
+        has_e = False
+        last_layer_z = None
+        band_zmin = math.inf
+        band_zmax = -math.inf
+        next_band = 0
+        nsegs = 0
+        bounds = self.bounds
+        lmin_x = lmin_y = math.inf
+        lmax_x = lmax_y = -math.inf
+        lsegs = 0
+
+        def add_layer(pos, lz):
+            self.layer_offsets.append(pos)
+            self.layer_z.append(_nan(lz))
+
+        def end_layer():
+            self.layer_segments.append(lsegs)
+            self.layer_bounds.extend((lmin_x, lmin_y, lmax_x, lmax_y))
+
+        add_layer(0, None)
+
+        pos = 0
+        with open(fn, 'rb') as f:
+            for raw in f:
+                line_pos = pos
+                pos += len(raw)
+                self.nlines += 1
+
+                if line_pos >= next_band:
+                    # start a new band, remembering the parser state at the start of it
+                    if self.band_offsets:
+                        self.band_z.extend((band_zmin, band_zmax))
+                        if cancel is not None and cancel():
+                            return False
+                        if progress is not None:
+                            progress(line_pos / self.size)
+                    self.band_offsets.append(line_pos)
+                    self.band_states.extend((_nan(x), _nan(y), _nan(z), modal_g, rel_move, laste, lasts, has_e))
+                    band_zmin = math.inf
+                    band_zmax = -math.inf
+                    next_band = line_pos + BAND_SIZE
+
+                ln = strip_gcode_line(raw.decode('latin1'))
+                if not ln:
+                    continue
+
+                for d in split_gcodes(ln):
+                    if not d:
+                        continue
+
+                    # handle modal commands
+                    if 'G' not in d and ('X' in d or 'Y' in d or 'Z' in d or 'S' in d):
+                        d['G'] = modal_g
+
+                    gcode = int(d['G'])
+
+                    # G92 E0 resets E
+                    if gcode == 92 and 'E' in d:
+                        laste = float(d['E'])
+                        has_e = True
+
+                    if gcode == 91 or gcode == 90:
+                        rel_move = gcode == 91
+
+                    # only deal with G0/1/2/3
+                    if gcode > 3:
+                        continue
+
+                    modal_g = gcode
+
+                    if not has_e and ('E' in d and gcode == 1):
+                        has_e = True
+
+                    if rel_move:
+                        if 'X' in d:
+                            x = (0 if x is None else x) + d['X']
+                        if 'Y' in d:
+                            y = (0 if y is None else y) + d['Y']
+                        if z is not None and 'Z' in d:
+                            z += d['Z']
+                    else:
+                        x = lastpos[0] if 'X' not in d else d['X']
+                        y = lastpos[1] if 'Y' not in d else d['Y']
+                        z = lastpos[2] if 'Z' not in d else d['Z']
+
+                    e = laste if 'E' not in d else d['E']
+                    s = lasts if 'S' not in d else d['S']
+
+                    if x is None or y is None:
+                        if x is not None:
+                            lastpos[0] = x
+                        if y is not None:
+                            lastpos[1] = y
+                        if z is not None:
+                            lastpos[2] = z
+                        continue
+
+                    # 3D layers, these are found the same way the viewer finds them when it reads a layer
+                    if last_layer_z is None:
+                        # the first layer is at the first Z a move is made at
+                        last_layer_z = z
+                        self.layer_z[-1] = _nan(z)
+                    elif z != last_layer_z:
+                        if z < last_layer_z:
+                            # probably preceded by a z lift, so this is really the start of the layer
+                            self.layer_offsets[-1] = line_pos
+                            self.layer_z[-1] = _nan(z)
+                        else:
+                            end_layer()
+                            add_layer(line_pos, z)
+                            lmin_x = lmin_y = math.inf
+                            lmax_x = lmax_y = -math.inf
+                            lsegs = 0
+                        last_layer_z = z
+
+                    # the Z range moved through in this band, rapids included as the slice view draws them too
+                    if z is None:
+                        band_zmin = -math.inf
+                        band_zmax = math.inf
+                    else:
+                        if z < band_zmin:
+                            band_zmin = z
+                        if z > band_zmax:
+                            band_zmax = z
+
+                    pts = [(x, y)]
+                    if gcode in (2, 3) and lastpos[0] is not None and lastpos[1] is not None:
+                        cx, cy, r, a, b, angle, p1, p2 = arc_geometry(lastpos[0], lastpos[1], x, y, d.get('I', 0.0), d.get('J', 0.0), gcode == 2)
+                        pts = arc_extents(cx, cy, p1, p2, angle, 64)
+
+                    for px, py in pts:
+                        if not px >= bounds[0]:
+                            bounds[0] = px
+                        if not py >= bounds[1]:
+                            bounds[1] = py
+                        if not px <= bounds[3]:
+                            bounds[3] = px
+                        if not py <= bounds[4]:
+                            bounds[4] = py
+                        if px < lmin_x:
+                            lmin_x = px
+                        if py < lmin_y:
+                            lmin_y = py
+                        if px > lmax_x:
+                            lmax_x = px
+                        if py > lmax_y:
+                            lmax_y = py
+
+                    if z is not None:
+                        if not z >= bounds[2]:
+                            bounds[2] = z
+                        if not z <= bounds[5]:
+                            bounds[5] = z
+
+                    if gcode > 0:
+                        nsegs += 1
+                        lsegs += 1
+
+                    lastpos = [x, y, z]
+                    laste = e
+                    lasts = s
+
+        if self.band_offsets:
+            self.band_z.extend((band_zmin, band_zmax))
+        end_layer()
+        self.nsegments = nsegs
+        return True
+
+    def save(self, path):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, INDEX_VERSION, self.size, self.mtime, len(self.layer_offsets), len(self.band_offsets), self.nlines, self.nsegments, *self.bounds))
+            for a in (self.layer_offsets, self.layer_z, self.layer_segments, self.layer_bounds, self.band_offsets, self.band_z, self.band_states):
+                a.tofile(f)
+        os.replace(tmp, path)
+
+    def load(self, path, fn):
+        ''' load a saved index, returns False if it is missing or is not for the current version of fn '''
+        st = os.stat(fn)
+        try:
+            with open(path, 'rb') as f:
+                hdr = f.read(_HEADER.size)
+                if len(hdr) != _HEADER.size:
+                    return False
+                magic, version, size, mtime, nlayers, nbands, nlines, nsegs, *bounds = _HEADER.unpack(hdr)
+                if magic != _MAGIC or version != INDEX_VERSION or size != st.st_size or mtime != st.st_mtime_ns:
+                    return False
+
+                self.layer_offsets.fromfile(f, nlayers)
+                self.layer_z.fromfile(f, nlayers)
+                self.layer_segments.fromfile(f, nlayers)
+                self.layer_bounds.fromfile(f, nlayers * 4)
+                self.band_offsets.fromfile(f, nbands)
+                self.band_z.fromfile(f, nbands * 2)
+                self.band_states.fromfile(f, nbands * STATE_SIZE)
+
+        except (OSError, EOFError):
+            return False
+
+        self.fn = fn
+        self.size = size
+        self.mtime = mtime
+        self.nlines = nlines
+        self.nsegments = nsegs
+        self.bounds = bounds
+        return True
+
+
+def index_path(fn):
+    ''' the path of the cached index for the gcode file fn '''
+    h = hashlib.sha1(os.path.abspath(fn).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, f'{h}.idx')
+
+
+def get_index(fn, cancel=None, progress=None):
+    ''' returns the index for fn, loading it from the cache if it is current otherwise building and caching it '''
+    log = logging.getLogger()
+    path = index_path(fn)
+    idx = GcodeIndex()
+    if idx.load(path, fn):
+        log.debug(f'GcodeIndex: loaded index for {fn}')
+        return idx
+
+    idx = GcodeIndex()
+    if not idx.build(fn, cancel, progress):
+        return None
+
+    log.info(f'GcodeIndex: indexed {fn}: {len(idx.layer_offsets)} layers, {len(idx.band_offsets)} bands, {idx.nsegments} segments')
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        idx.save(path)
+    except OSError as e:
+        log.warning(f'GcodeIndex: could not save index for {fn}: {e}')
+
+    return idx
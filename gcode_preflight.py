@@ -0,0 +1,386 @@
+# single pass preflight analysis of a gcode file
+#
+# Reads the file once and works out everything that is needed before it is run, the number of lines the
+# streamer will count for progress, the motion lines, tool changes and where the M0 and M6 stops are, the extents,
+# the total cut and rapid distance and an estimate of the run time.
+#
+# The run time is estimated from the feed rates with a trapezoidal acceleration model and smoothies junction
+# deviation for the speed between moves, and the estimated time so far is recorded every few lines so Eta can
+# work out the time remaining from the lines sent, corrected by how long it has actually taken so far.
+#
+# The result is cached as a small JSON file in the cache directory keyed by the path, size and mtime of the
+# gcode file (and in memory), so printing the same file again costs nothing. The analysis can optionally run
+# in another process so it does not hold the GIL while a print is being streamed.
+
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+
+from gcode_index import arc_geometry, arc_extents
+
+PREFLIGHT_VERSION = 2
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'smoopi', 'preflight')
+READ_SIZE = 1024 * 1024
+DEFAULT_FEED_RATE = 4000.0  # mm/min, smoothies default_feed_rate, used until there is an F
+RAPID_RATE = 4000.0  # mm/min, smoothies default_seek_rate
+DEFAULT_ACCELERATION = 1000.0  # mm/sec², smoothies default acceleration
+JUNCTION_DEVIATION = 0.05  # mm, smoothies default junction_deviation
+MAX_PROFILE = 4096  # most entries in the time profile, the lines between them doubles when it fills up
+
+_words = re.compile(rb"([GMXYZIJEFPST])(-?\d*\.?\d*)")
+_comments = re.compile(rb";.*$|\([^)]*\)?")
+
+_cache = {}
+
+
+class Preflight():
+    """ the results of the preflight analysis of a file """
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.size = 0
+        self.mtime = 0
+        self.lines = 0  # all the lines in the file
+        self.gcode_lines = 0  # lines starting with G, M, X or Y, which is what the streamer counts for progress
+        self.motion_lines = 0  # G0/1/2/3 moves
+        self.tool_changes = 0
+        self.m0_lines = []  # file line numbers of the M0 and M6 stops
+        self.m6_lines = []
+        self.bounds = [math.nan] * 6  # min x, min y, min z, max x, max y, max z
+        self.cut_distance = 0.0
+        self.rapid_distance = 0.0
+        self.est_time = 0.0  # seconds at the programmed feed rates
+        self.acceleration = DEFAULT_ACCELERATION  # the acceleration the time was estimated with
+        # estimated time after every profile_step gcode lines
+        self.profile = []
+        self.profile_step = 1
+
+    def to_dict(self):
+        d = dict(self.__dict__)
+        d['version'] = PREFLIGHT_VERSION
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('version') != PREFLIGHT_VERSION:
+            return None
+        pf = cls()
+        for k in pf.__dict__:
+            setattr(pf, k, d[k])
+        return pf
+
+    def summary(self):
+        ''' a one line description for the console '''
+        return (f'{self.gcode_lines} GCode lines, {self.motion_lines} moves, {self.tool_changes} tool changes, '
+                f'cut: {self.cut_distance / 1000:1.1f}m, rapid: {self.rapid_distance / 1000:1.1f}m, '
+                f'est time: {datetime.timedelta(seconds=int(self.est_time))}')
+
+
+def _update_bounds(b, x, y, z):
+    if not x >= b[0]:
+        b[0] = x
+    if not y >= b[1]:
+        b[1] = y
+    if not x <= b[3]:
+        b[3] = x
+    if not y <= b[4]:
+        b[4] = y
+    if z is not None:
+        if not z >= b[2]:
+            b[2] = z
+        if not z <= b[5]:
+            b[5] = z
+
+
+def _move_time(d, v0, v1, v, a):
+    ''' time to move d mm starting at v0 and ending at v1 with a top speed of v mm/sec and acceleration a '''
+    da = (v * v - v0 * v0) / (2 * a)
+    dd = (v * v - v1 * v1) / (2 * a)
+    if da + dd <= d:
+        # reaches full speed
+        return (v - v0) / a + (v - v1) / a + (d - da - dd) / v
+    # triangle, accelerates to vp then decelerates
+    vp = math.sqrt((2 * a * d + v0 * v0 + v1 * v1) / 2)
+    if vp < max(v0, v1):
+        return 2 * d / (v0 + v1)
+    return (vp - v0) / a + (vp - v1) / a
+
+
+class _Planner():
+    """ a one move look ahead version of the smoothie planner, just enough to estimate the time of each move """
+
+    def __init__(self, acceleration, junction_deviation=JUNCTION_DEVIATION):
+        self.a = acceleration
+        self.jd = junction_deviation
+        self.pending = None
+        self.v_entry = 0.0
+
+    def add(self, d, v, u):
+        ''' add a move of d mm at v mm/sec in the direction of unit vector u, returns the time of the move before it '''
+        if d <= 0:
+            return 0.0
+        t = 0.0
+        if self.pending is not None:
+            pd, pv, pu = self.pending
+            # junction speed is limited by the angle between the moves
+            cos_theta = -(pu[0] * u[0] + pu[1] * u[1] + pu[2] * u[2])
+            vj = 0.0
+            if cos_theta < 0.95:
+                vj = min(pv, v)
+                if cos_theta > -0.95:
+                    sin_theta_d2 = math.sqrt(0.5 * (1.0 - cos_theta))
+                    vj = min(vj, math.sqrt(self.a * self.jd * sin_theta_d2 / (1.0 - sin_theta_d2)))
+            t = self._finish(vj)
+        self.pending = (d, v, u)
+        return t
+
+    def _finish(self, v_exit):
+        d, v, u = self.pending
+        v_exit = min(v_exit, math.sqrt(self.v_entry * self.v_entry + 2 * self.a * d))
+        t = _move_time(d, self.v_entry, v_exit, v, self.a)
+        self.v_entry = v_exit
+        self.pending = None
+        return t
+
+    def flush(self):
+        ''' come to a stop, returns the time of the last move '''
+        t = self._finish(0.0) if self.pending is not None else 0.0
+        self.v_entry = 0.0
+        return t
+
+
+def analyze(fn, acceleration=DEFAULT_ACCELERATION):
+    ''' read the file once and return its Preflight, acceleration is in mm/sec² '''
+    pf = Preflight(fn)
+    pf.acceleration = acceleration
+    planner = _Planner(acceleration)
+    profile = pf.profile
+    step = 1
+    st = os.stat(fn)
+    pf.size = st.st_size
+    pf.mtime = st.st_mtime_ns
+
+    x = y = z = None
+    e = 0.0
+    feed = DEFAULT_FEED_RATE
+    modal_g = 0
+    rel_move = False
+    rel_e = False
+    lineno = 0
+    b = pf.bounds
+    with open(fn, 'rb', buffering=READ_SIZE) as f:
+        for raw in f:
+            if pf.gcode_lines == len(profile) * step:
+                profile.append(pf.est_time)
+                if len(profile) > MAX_PROFILE:
+                    del profile[1::2]
+                    step *= 2
+
+            lineno += 1
+            ln = raw.strip()
+            if not ln:
+                continue
+            c = ln[0]
+            if c in b'GMXY':
+                pf.gcode_lines += 1
+            elif c == 0x3b or c == 0x28:  # ; or (
+                continue
+
+            if b'M' in ln:
+                # same tests as GcodeReader.classify so these are where the streamer will stop
+                if ln == b"M6" or ln == b"M06" or b"M6 " in ln or b"M06 " in ln or ln.endswith(b"M6"):
+                    pf.tool_changes += 1
+                    pf.m6_lines.append(lineno)
+                elif ln == b"M0" or ln == b"M00":
+                    pf.m0_lines.append(lineno)
+
+            if b';' in ln or b'(' in ln:
+                ln = _comments.sub(b'', ln)
+
+            gcodes = []
+            d = {}
+            for w, v in _words.findall(ln):
+                if w == b'G':
+                    gcodes.append(v)
+                elif w == b'M':
+                    if v in (b'82', b'83'):
+                        rel_e = v == b'83'
+                elif v:
+                    try:
+                        d[w] = float(v)
+                    except ValueError:
+                        pass
+
+            motion = None
+            for g in gcodes:
+                if g in (b'0', b'00', b'1', b'01', b'2', b'02', b'3', b'03'):
+                    motion = modal_g = int(g)
+                elif g == b'90' or g == b'91':
+                    rel_move = g == b'91'
+                elif g == b'92':
+                    if b'E' in d:
+                        e = d[b'E']
+                elif g == b'4' or g == b'04':
+                    # dwell, P is in milliseconds and S in seconds
+                    pf.est_time += planner.flush() + d.get(b'P', 0.0) / 1000.0 + d.get(b'S', 0.0)
+
+            if b'F' in d and d[b'F'] > 0:
+                feed = d[b'F']
+
+            if motion is None:
+                if gcodes or not (b'X' in d or b'Y' in d or b'Z' in d):
+                    continue
+                # modal move
+                motion = modal_g
+
+            pf.motion_lines += 1
+
+            if rel_move:
+                nx = (x or 0.0) + d.get(b'X', 0.0)
+                ny = (y or 0.0) + d.get(b'Y', 0.0)
+                nz = (z or 0.0) + d.get(b'Z', 0.0)
+            else:
+                nx = d.get(b'X', x)
+                ny = d.get(b'Y', y)
+                nz = d.get(b'Z', z)
+
+            # an axis that has not been set yet is assumed to not have moved
+            dx = 0.0 if x is None or nx is None else nx - x
+            dy = 0.0 if y is None or ny is None else ny - y
+            dz = 0.0 if z is None or nz is None else nz - z
+
+            chord = math.sqrt(dx * dx + dy * dy + dz * dz)
+            u = (dx / chord, dy / chord, dz / chord) if chord > 0 else (0.0, 0.0, 0.0)
+            if motion >= 2 and x is not None and y is not None and nx is not None and ny is not None:
+                cx, cy, r, a, ab, angle, p1, p2 = arc_geometry(x, y, nx, ny, d.get(b'I', 0.0), d.get(b'J', 0.0), motion == 2)
+                dist = math.hypot(r * angle, dz)
+                for px, py in arc_extents(cx, cy, p1, p2, angle, 16):
+                    _update_bounds(b, px, py, None)
+            else:
+                dist = chord
+
+            if b'E' in d:
+                de = d[b'E'] if rel_e else d[b'E'] - e
+                e = e + d[b'E'] if rel_e else d[b'E']
+                if dist == 0:
+                    # retract or prime
+                    dist = abs(de)
+
+            if motion == 0:
+                pf.rapid_distance += dist
+                rate = RAPID_RATE
+            else:
+                pf.cut_distance += dist
+                rate = feed
+            pf.est_time += planner.add(dist, rate / 60.0, u)
+
+            x, y, z = nx, ny, nz
+            if x is not None and y is not None:
+                _update_bounds(b, x, y, z)
+
+    pf.est_time += planner.flush()
+    pf.lines = lineno
+    pf.profile_step = step
+    return pf
+
+
+def _cache_path(fn):
+    h = hashlib.sha1(os.path.abspath(fn).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, f'{h}.json')
+
+
+def _current(pf, fn, st, acceleration):
+    return pf is not None and pf.fn == fn and pf.size == st.st_size and pf.mtime == st.st_mtime_ns and pf.acceleration == acceleration
+
+
+def cached_preflight(fn, acceleration=DEFAULT_ACCELERATION):
+    ''' returns the Preflight for fn if it has already been done and the file has not changed since, otherwise None '''
+    st = os.stat(fn)
+    pf = _cache.get(os.path.abspath(fn))
+    if _current(pf, fn, st, acceleration):
+        return pf
+
+    try:
+        with open(_cache_path(fn)) as f:
+            pf = Preflight.from_dict(json.load(f))
+    except Exception:
+        return None
+
+    if not _current(pf, fn, st, acceleration):
+        return None
+
+    _cache[os.path.abspath(fn)] = pf
+    return pf
+
+
+def get_preflight(fn, use_process=False, acceleration=DEFAULT_ACCELERATION):
+    ''' returns the Preflight for fn from the cache, or analyzes it (in another process if use_process is True) and caches it '''
+    log = logging.getLogger()
+    pf = cached_preflight(fn, acceleration)
+    if pf is not None:
+        return pf
+
+    if use_process:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as ex:
+            pf = ex.submit(analyze, fn, acceleration).result()
+    else:
+        pf = analyze(fn, acceleration)
+
+    log.info(f'Preflight: {fn}: {pf.summary()}')
+    _cache[os.path.abspath(fn)] = pf
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = _cache_path(fn) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(pf.to_dict(), f)
+        os.replace(tmp, _cache_path(fn))
+    except OSError as e:
+        log.warning(f'Preflight: could not save preflight for {fn}: {e}')
+
+    return pf
+
+
+class Eta():
+    """ works out the time remaining in a run from the preflight time profile and the number of gcode lines sent so far
+
+    The estimate is scaled by how long the run has actually taken compared to the estimate for the lines done so far,
+    this correction is trusted more the further into the run it is.
+    """
+
+    CORRECTION_TIME = 120.0  # seconds of estimated time before the correction is fully trusted
+
+    def __init__(self, pf):
+        self.pf = pf
+
+    def done_time(self, n):
+        ''' the estimated time to run the first n gcode lines '''
+        p = self.pf.profile
+        step = self.pf.profile_step
+        if not p:
+            return 0.0
+        i = n / step
+        k = int(i)
+        if k < len(p) - 1:
+            return p[k] + (p[k + 1] - p[k]) * (i - k)
+        # past the last entry so interpolate to the end
+        last = (len(p) - 1) * step
+        if self.pf.gcode_lines <= last:
+            return self.pf.est_time
+        return p[-1] + (self.pf.est_time - p[-1]) * min((n - last) / (self.pf.gcode_lines - last), 1.0)
+
+    def update(self, n, elapsed):
+        ''' returns (seconds remaining, fraction of the estimated time done) after n lines have taken elapsed seconds '''
+        total = self.pf.est_time
+        if total <= 0:
+            return (0.0, 1.0)
+        done = self.done_time(n)
+        ratio = 1.0
+        if done > 0 and elapsed > 0:
+            c = min(done / self.CORRECTION_TIME, 1.0)
+            ratio += (elapsed / done - 1.0) * c
+        return ((total - done) * ratio, done / total)
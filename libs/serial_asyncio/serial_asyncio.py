@@ -10,6 +10,9 @@
 #
 # wolfmanjm: Made the write() trukly asynchronus. Write data is always buffered, and not written unt
 # write is ready. This also avoids the bug in posix serial.write().
+# Added write_priority() so realtime commands are written ahead of any buffered data.
+# Writes are appended to one reusable buffer so everything written since the port was last writable goes out in
+# one write call, the number of write calls and bytes written are counted.
 """\
 Support asyncio with serial ports. EXPERIMENTAL
 
@@ -55,7 +58,11 @@ class SerialTransport(asyncio.Transport):
         self._closing = False
         self._protocol_paused = False
         self._max_read_size = 1024
-        self._write_buffer = []
+        self._write_buffer = bytearray()
+        self._priority_buffer = bytearray()  # written before anything in _write_buffer
+        self._priority_callbacks = []
+        self._write_calls = 0
+        self._bytes_written = 0
         self._set_write_buffer_limits()
         self._has_reader = False
         self._has_writer = False
@@ -117,12 +124,24 @@ class SerialTransport(asyncio.Transport):
         transport has been closed will be ignored."""
         if self._closing:
             return
-        if self.get_write_buffer_size() == 0:
-            self._write_buffer.append(data)
-            self._ensure_writer()
-        else:
-            self._write_buffer.append(data)
+        self._write_buffer += data
+        self._ensure_writer()
+        self._maybe_pause_protocol()
+
+    def write_priority(self, data, written_cb=None):
+        """Write some data ahead of anything already buffered.
 
+        This is for realtime commands that the controller picks out of
+        the incoming characters as they arrive, as the data may end up
+        in the middle of a partly written line. Priority writes are
+        kept in order with each other. written_cb is called once the
+        data has been written to the serial port."""
+        if self._closing:
+            return
+        self._priority_buffer += data
+        if written_cb is not None:
+            self._priority_callbacks.append(written_cb)
+        self._ensure_writer()
         self._maybe_pause_protocol()
 
     def can_write_eof(self):
@@ -158,6 +177,7 @@ class SerialTransport(asyncio.Transport):
         """
         self._set_write_buffer_limits(high=high, low=low)
         self._maybe_pause_protocol()
+        self._maybe_resume_protocol()
 
     def get_write_buffer_size(self):
         """The number of bytes in the write buffer.
@@ -165,7 +185,17 @@ class SerialTransport(asyncio.Transport):
         This buffer is unbounded, so the result may be larger than the
         the high water mark.
         """
-        return sum(map(len, self._write_buffer))
+        return len(self._priority_buffer) + len(self._write_buffer)
+
+    def get_write_stats(self):
+        """The number of write calls made to the serial port and the
+        bytes written, bytes_per_write shows how well the writes are
+        being coalesced."""
+        return {
+            'writes': self._write_calls,
+            'bytes': self._bytes_written,
+            'bytes_per_write': self._bytes_written / self._write_calls if self._write_calls else 0.0
+        }
 
     def write_eof(self):
         raise NotImplementedError("Serial connections do not support end-of-file")
@@ -181,10 +211,13 @@ class SerialTransport(asyncio.Transport):
         self._abort(None)
 
     def flush(self):
-        """ clears output buffer and stops any more data being written
+        """ clears output buffer and stops any more data being written,
+        any priority data is still written
         """
         self._remove_writer()
         self._write_buffer.clear()
+        if self._priority_buffer:
+            self._ensure_writer()
         self._maybe_resume_protocol()
 
     def _maybe_pause_protocol(self):
@@ -241,35 +274,66 @@ class SerialTransport(asyncio.Transport):
         connection_lost() method will be called with None as its
         argument.
         """
-        data = b''.join(self._write_buffer)
-        assert data, 'Write buffer should not be empty'
+        assert self._priority_buffer or self._write_buffer, 'Write buffer should not be empty'
 
-        self._write_buffer.clear()
+        if self._priority_buffer:
+            n = self._write_serial(self._priority_buffer)
+            if n is None:
+                return
+            del self._priority_buffer[:n]
+            if not self._priority_buffer:
+                self._priority_written()
+
+        # the rest only goes once the priority data has all been written
+        if self._write_buffer and not self._priority_buffer:
+            n = self._write_serial(self._write_buffer)
+            if n is None:
+                return
+            # deleting from the front of a bytearray does not copy the rest
+            del self._write_buffer[:n]
 
+        if self._flushed():
+            self._remove_writer()
+            self._maybe_resume_protocol()  # May cause further writes
+            # _write_ready may have been invoked by the event loop
+            # after the transport was closed, as part of the ongoing
+            # process of flushing buffered data. If the buffer
+            # is now empty, we can close the connection
+            if self._closing and self._flushed():
+                self._close()
+            return
+
+        # Try again later
+        self._maybe_resume_protocol()
+        assert self._has_writer
+
+    def _write_serial(self, data):
+        """Write as much of data as the port will take, returns the
+        number of bytes written or None after a fatal error."""
         try:
             n = self._serial.write(data)
         except (BlockingIOError, InterruptedError):
-            self._write_buffer.append(data)
+            return 0
         except serial.SerialException as exc:
             self._fatal_error(exc, 'Fatal write error on serial transport')
-        else:
-            if n == len(data):
-                assert self._flushed()
-                self._remove_writer()
-                self._maybe_resume_protocol()  # May cause further writes
-                # _write_ready may have been invoked by the event loop
-                # after the transport was closed, as part of the ongoing
-                # process of flushing buffered data. If the buffer
-                # is now empty, we can close the connection
-                if self._closing and self._flushed():
-                    self._close()
-                return
-
-            assert 0 <= n < len(data)
-            data = data[n:]
-            self._write_buffer.append(data)  # Try again later
-            self._maybe_resume_protocol()
-            assert self._has_writer
+            return None
+        self._write_calls += 1
+        self._bytes_written += n
+        return n
+
+    def _priority_written(self):
+        callbacks = self._priority_callbacks
+        self._priority_callbacks = []
+        for cb in callbacks:
+            try:
+                cb()
+            except Exception as exc:
+                self._loop.call_exception_handler({
+                    'message': 'priority write callback failed',
+                    'exception': exc,
+                    'transport': self,
+                    'protocol': self._protocol,
+                })
 
     if os.name == "nt":
         def _poll_read(self):
@@ -401,6 +465,8 @@ class SerialTransport(asyncio.Transport):
             self._protocol.connection_lost(exc)
         finally:
             self._write_buffer.clear()
+            self._priority_buffer.clear()
+            self._priority_callbacks.clear()
             self._serial.close()
             self._serial = None
             self._protocol = None
@@ -38,6 +38,8 @@ from mpg_knob import Knob
 from libs.hat import Hat
 
 from comms import Comms
+from gcode_preflight import get_preflight, cached_preflight, Eta
+from console_log import ConsoleLog
 from message_box import MessageBox
 from notice_box import NoticeBox
 from input_box import InputBox
@@ -46,6 +48,7 @@ from file_dialog import FileDialog
 from viewer import GcodeViewerScreen
 from web_server import ProgressServer
 from camera_screen import CameraScreen
+from mjpeg_relay import MjpegRelay
 from spindle_camera import SpindleCamera
 from config_editor import ConfigEditor
 from configv2_editor import ConfigV2Editor
@@ -54,6 +57,7 @@ from text_editor import TextEditor
 from tool_scripts import ToolScripts
 from notify import Notify
 from calc_widget import CalcScreen
+from diagnostics_screen import DiagnosticsScreen
 from uart_logger import UartLogger
 from tmc_configurator import TMCConfigurator
 from spindle_handler import SpindleHandler
@@ -61,7 +65,6 @@ from spindle_handler import SpindleHandler
 import subprocess
 import threading
 import traceback
-import queue
 import math
 import os
 import sys
@@ -77,6 +80,9 @@ assert (3, 13, 99) >= sys.version_info >= (3, 7, 3), f"Python version needs to b
 
 kivy.require('2.1.0')
 
+MAX_PENDING_DISPLAY = 1000  # most lines from other threads waiting to be displayed, the oldest are dropped after that
+WEB_METRICS_INTERVAL = 5  # secs between copies of the comms metrics given to the web server
+
 # Window.softinput_mode = 'below_target'
 
 
@@ -416,13 +422,26 @@ class MainWindow(BoxLayout):
         super(MainWindow, self).__init__(**kwargs)
         self.app = App.get_running_app()
         self._trigger = Clock.create_trigger(self.async_get_display_data)
-        self._q = queue.Queue()
+        # lines from other threads waiting for the next frame, and how many were dropped as there were too many
+        self._q = collections.deque()
+        self._q_lock = threading.Lock()
+        self._dropped = 0
+        # repeated lines are shown once with a count
+        self._repeat_line = None
+        self._repeat_count = 0
         self.config = self.app.config
         self.last_path = self.config.get('General', 'last_gcode_path')
         self.paused = False
         self.is_sdprint = False
-        self.save_console_data = None
-        self.uart_log_data = []
+        self.is_uploading = False
+        self.eta_model = None
+        self.paused_time = 0.0
+        self.pause_start = None
+        # the console and uart logs, only the one in view is shown in the log window
+        console_lines = self.config.getint('UI', 'console_lines')
+        self.console = ConsoleLog(console_lines, 'console')
+        self.uart_console = ConsoleLog(console_lines, 'uart')
+        self._log_trigger = Clock.create_trigger(self._update_log_view)
         self.is_uart_log_in_view = False
         self.uart_log = None
 
@@ -430,32 +449,63 @@ class MainWindow(BoxLayout):
         return self.app.comms.actual_line
 
     def on_touch_down(self, touch):
+        # any interaction stops the status polling from being backed off
+        self.app.comms.ui_activity()
+
         if self.ids.log_window.collide_point(touch.x, touch.y):
             if touch.is_triple_tap:
-                self.ids.log_window.data = []
+                self.clear_log()
                 return True
 
         return super(MainWindow, self).on_touch_down(touch)
 
     def add_line_to_log(self, s, overwrite=False):
-        ''' Add lines to the log window, which is trimmed to the last 200 lines '''
-        if self.is_uart_log_in_view:
-            # not in view at the moment
-            self.save_console_data.append({'text': s})
+        ''' Add lines to the console log, the log window is updated once per frame '''
+        if not overwrite and s == self._repeat_line:
+            self._repeat_count += 1
+            self.console.append(f'{s} (x{self._repeat_count})', True)
+        else:
+            # commands we sent are not collapsed so they stay in the history
+            self._repeat_line = None if overwrite or s.startswith('<< ') else s
+            self._repeat_count = 1
+            self.console.append(s, overwrite)
+        self._log_trigger()
+
+    def _update_log_view(self, *args):
+        # add the lines added since the last frame to the log window in one go
+        log, other = (self.uart_console, self.console) if self.is_uart_log_in_view else (self.console, self.uart_console)
+        other.sync()  # not in view so just spill
+        last, new = log.sync()
+        if len(new) >= log.capacity:
+            # a flood so just show the last lines
+            self.ids.log_window.data = [{'text': x} for x in new[-log.capacity:]]
             return
 
-        max_lines = 200  # TODO needs to be configurable
-        n = len(self.ids.log_window.data)
-        if overwrite:
-            self.ids.log_window.data[n - 1] = ({'text': s})
+        data = self.ids.log_window.data
+        if last is not None and data:
+            data[-1] = {'text': last}
+        if new:
+            data.extend([{'text': x} for x in new])
+
+        # deleting from the front makes the whole view refresh so we use some hysteresis here
+        n = len(data) - log.capacity  # how many lines over our max
+        if n > max(10, log.capacity // 4):
+            del data[0:n]
+
+    def clear_log(self):
+        log = self.uart_console if self.is_uart_log_in_view else self.console
+        log.clear()
+        self.ids.log_window.data = []
+        self._repeat_line = None
+
+    def search_log(self, text):
+        ''' show the lines in the console log, including the ones that have been spilled to disk, that contain text '''
+        if not text:
             return
-
-        self.ids.log_window.data.append({'text': s})
-        # we use some hysteresis here so we don't truncate every line added over max_lines
-        n = n - max_lines  # how many lines over our max
-        if n > 10:
-            # truncate log to last max_lines, we delete the oldest 10 or so lines
-            del self.ids.log_window.data[0:n]
+        found = self.console.search(text)
+        self.display(f'>>> Search: {text}, {len(found)} found')
+        for ln in found:
+            self.display(f'>>> {ln}')
 
     def connect(self):
         if self.app.is_connected:
@@ -482,14 +532,26 @@ class MainWindow(BoxLayout):
     def async_display(self, data):
         ''' called from external thread to display incoming data '''
         # puts the data onto queue and triggers an event to read it in the Kivy thread
-        self._q.put(data)
+        with self._q_lock:
+            if len(self._q) >= MAX_PENDING_DISPLAY:
+                # can't keep up so drop the oldest
+                self._q.popleft()
+                self._dropped += 1
+            self._q.append(data)
         self._trigger()
 
     def async_get_display_data(self, *largs):
-        ''' fetches data from the Queue and displays it, triggered by incoming data '''
-        while not self._q.empty():
-            # we need this loop until q is empty as trigger only triggers once per frame
-            data = self._q.get(False)
+        ''' displays everything queued since the last frame, triggered by incoming data '''
+        with self._q_lock:
+            q = self._q
+            self._q = collections.deque()
+            dropped = self._dropped
+            self._dropped = 0
+
+        if dropped:
+            self.add_line_to_log(f'>>> {dropped} lines dropped, too many to display')
+
+        for data in q:
             if data.endswith('\r'):
                 self.add_line_to_log(data[0:-1], True)
             else:
@@ -518,39 +580,43 @@ class MainWindow(BoxLayout):
         self.add_line_to_log("...Disconnected")
 
     @mainthread
-    def update_status(self, stat, d):
+    def update_status(self, stat, r):
+        # r is a StatusReport snapshot, it is only sent when something changed
         self.status = stat
         self.app.status = stat
-        if 'WPos' in d:
-            self.wpos = d['WPos']
+        if r is None:
+            return
+
+        if r.wpos is not None:
+            self.wpos = list(r.wpos)
             self.app.wpos = self.wpos
 
-        if 'MPos' in d:
-            self.app.mpos = d['MPos']
+        if r.mpos is not None:
+            self.app.mpos = list(r.mpos)
 
-        if 'F' in d:
-            if len(d['F']) == 2:
-                self.app.fr = d['F'][0]
-                self.app.frr = d['F'][0]
-                self.app.fro = d['F'][1]
-            elif len(d['F']) == 3:
+        if r.f is not None:
+            if len(r.f) == 2:
+                self.app.fr = r.f[0]
+                self.app.frr = r.f[0]
+                self.app.fro = r.f[1]
+            elif len(r.f) == 3:
                 # NOTE fr is current actual feedrate and frr is requested feed rate (from the Fxxx)
-                self.app.fr = d['F'][0]
-                self.app.frr = d['F'][1]
-                self.app.fro = d['F'][2]
+                self.app.fr = r.f[0]
+                self.app.frr = r.f[1]
+                self.app.fro = r.f[2]
 
-        if 'S' in d:
-            self.app.sr = d['S'][0]
+        if r.s is not None:
+            self.app.sr = r.s[0]
             if self.app.spindle_handler is not None:
                 # convert from the PWM to RPM
                 self.app.rpm = self.app.spindle_handler.reverse_lookup(self.app.sr)
 
-        if 'L' in d:
-            self.app.lp = d['L'][0]
+        if r.l is not None:
+            self.app.lp = r.l[0]
 
-        if 'SD' in d:
-            rt = datetime.timedelta(seconds=int(d['SD'][0]))
-            self.eta = f"SD: {rt} {d['SD'][1]}%"
+        if r.sd is not None:
+            rt = datetime.timedelta(seconds=int(r.sd[0]))
+            self.eta = f"SD: {rt} {r.sd[1]}%"
             if not self.is_sdprint:
                 self.is_sdprint = True
                 self.is_printing = True
@@ -568,12 +634,12 @@ class MainWindow(BoxLayout):
             # extract temperature readings and update the extruder property
             # We only want to update once per query
             t = {}
-            if 'T' in d:
-                t['hotend0'] = (d['T'][0], d['T'][1])
-            if 'T1' in d:
-                t['hotend1'] = (d['T1'][0], d['T1'][1])
-            if 'B' in d:
-                t['bed'] = (d['B'][0], d['B'][1])
+            if r.t is not None:
+                t['hotend0'] = (r.t[0], r.t[1])
+            if r.t1 is not None:
+                t['hotend1'] = (r.t1[0], r.t1[1])
+            if r.b is not None:
+                t['bed'] = (r.b[0], r.b[1])
 
             if t:
                 self.ids.extruder.update_temp(t)
@@ -703,6 +769,13 @@ class MainWindow(BoxLayout):
         self.ids.print_but.text = 'Resume' if paused else 'Pause'
         self.paused = paused
         self.is_suspended = suspended
+        # time spent paused is not counted by the ETA
+        now = datetime.datetime.now()
+        if paused and self.pause_start is None:
+            self.pause_start = now
+        elif not paused and self.pause_start is not None:
+            self.paused_time += (now - self.pause_start).total_seconds()
+            self.pause_start = None
         if paused:
             if suspended:
                 self.add_line_to_log(">>> Streaming Suspended, Resume or Abort as needed")
@@ -747,15 +820,10 @@ class MainWindow(BoxLayout):
 
         Logger.info(f'MainWindow: printing file: {file_path}')
 
-        try:
-            self.nlines = Comms.file_len(file_path, False)  # get number of lines so we can do progress and ETA
-            Logger.debug(f'MainWindow: number of lines: {self.nlines}')
-        except Exception:
-            Logger.warning(f'MainWindow: exception in file_len: {traceback.format_exc()}')
-            self.nlines = None
-
         self.start_print_time = datetime.datetime.now()
-        self.display(f'>>> Running file: {file_path}, {self.nlines} GCode lines')
+        self.display(f'>>> Running file: {file_path}')
+        # get number of lines so we can do progress and ETA
+        self._preflight(file_path, False)
 
         if self.app.comms.stream_gcode(file_path, progress=lambda x: self.display_progress(x)):
             self.display(f">>> Run started at: {self.start_print_time.strftime('%x %X')}")
@@ -834,13 +902,8 @@ class MainWindow(BoxLayout):
         else:
             txt = f"[color=ffffff]{txt}[/color]"
 
-        d = {'text': txt}
-
-        self.uart_log_data.append(d)
-
-        if self.is_uart_log_in_view:
-            # The uart log is in view
-            self.ids.log_window.data.append(d)
+        self.uart_console.append(txt)
+        self._log_trigger()
 
     def _set_uart_port(self, s):
         if s:
@@ -855,16 +918,10 @@ class MainWindow(BoxLayout):
                 self.display(f'Error unable to open {s} as Uart log port')
 
     def toggle_uart_view(self, state):
-        if state == "down":
-            self.save_console_data = []
-            for i in self.ids.log_window.data:
-                self.save_console_data.append(i)
-            self.ids.log_window.data = self.uart_log_data
-            self.is_uart_log_in_view = True
-        else:
-            self.is_uart_log_in_view = False
-            self.ids.log_window.data = self.save_console_data
-            self.save_console_data = None
+        self.is_uart_log_in_view = state == "down"
+        log = self.uart_console if self.is_uart_log_in_view else self.console
+        log.sync()
+        self.ids.log_window.data = [{'text': x} for x in log.lines]
 
     @mainthread
     def stream_finished(self, ok):
@@ -895,23 +952,20 @@ class MainWindow(BoxLayout):
         self.display(f">>> Elapsed time: {et}")
         self.eta = 'Not Streaming'
         self.is_printing = False
+        self.is_uploading = False
         self.app.comms.fast_stream = False
 
     def _upload_gcode(self, file_path, dir_path):
         if not file_path:
             return
 
-        # use built-in fast stream for uploads
-        fast_stream = True
-        try:
-            self.nlines = Comms.file_len(file_path, fast_stream)  # get number of lines so we can do progress and ETA
-            Logger.debug(f'MainWindow: number of lines: {self.nlines}')
-        except Exception:
-            Logger.warning(f'MainWindow: exception in file_len: {traceback.format_exc()}')
-            self.nlines = None
+        # use built-in fast stream for uploads, unless a window is set which keeps a limited number of lines in flight
+        fast_stream = self.app.comms.upload_window <= 0
 
         self.start_print_time = datetime.datetime.now()
-        self.display(f'>>> Uploading file: {file_path}, {self.nlines} lines')
+        self.display(f'>>> Uploading file: {file_path}')
+        # get number of lines so we can do progress and ETA, uploads count all lines
+        self._preflight(file_path, True)
 
         # set fast stream mode if requested
         self.app.comms.fast_stream = fast_stream
@@ -921,6 +975,42 @@ class MainWindow(BoxLayout):
             return
         else:
             self.is_printing = True
+            self.is_uploading = True
+
+    def _preflight(self, file_path, all_lines):
+        # the analysis is cached so a reprint does not need to read the file again, otherwise it is done in the background
+        self.nlines = None
+        self.eta_model = None
+        self.paused_time = 0.0
+        self.pause_start = None
+        try:
+            pf = cached_preflight(file_path, self.app.eta_acceleration)
+        except Exception:
+            Logger.warning(f'MainWindow: exception in preflight: {traceback.format_exc()}')
+            return
+
+        if pf is not None:
+            self._preflight_done(pf, all_lines)
+        else:
+            threading.Thread(target=self._preflight_thread, daemon=True, args=(file_path, all_lines)).start()
+
+    def _preflight_thread(self, file_path, all_lines):
+        try:
+            pf = get_preflight(file_path, self.app.preflight_process, self.app.eta_acceleration)
+        except Exception:
+            Logger.warning(f'MainWindow: exception in preflight: {traceback.format_exc()}')
+            return
+
+        self._preflight_done(pf, all_lines)
+
+    @mainthread
+    def _preflight_done(self, pf, all_lines):
+        # this has to be the count the streamer reports progress in, and the ETA profile is indexed by gcode_lines
+        self.nlines = pf.lines if all_lines else pf.gcode_lines
+        # uploads are not limited by the machine so only the line rate is used for them
+        self.eta_model = None if all_lines else Eta(pf)
+        Logger.debug(f'MainWindow: number of lines: {self.nlines}')
+        self.display(f'>>> Preflight: {pf.summary()}')
 
     def fast_stream_gcode(self):
         # get file to fast stream
@@ -962,15 +1052,29 @@ class MainWindow(BoxLayout):
 
         if self.nlines and n <= self.nlines:
             now = datetime.datetime.now()
-            d = (now - self.start_print_time).seconds
-            if n > 10 and d > 10:
-                # we have to wait a bit to get reasonable estimates
-                lps = n / d
-                eta = (self.nlines - n) / lps
+            if self.eta_model is not None:
+                # the estimated time of the lines left, corrected by how the run is going so far
+                d = (now - self.start_print_time).total_seconds() - self.paused_time
+                if self.pause_start is not None:
+                    d -= (now - self.pause_start).total_seconds()
+                eta, done = self.eta_model.update(n, d)
             else:
-                eta = 0
+                d = (now - self.start_print_time).seconds
+                if n > 10 and d > 10:
+                    # we have to wait a bit to get reasonable estimates
+                    lps = n / d
+                    eta = (self.nlines - n) / lps
+                else:
+                    eta = 0
+                done = n / self.nlines
+
+            rate = ''
+            if self.is_uploading:
+                st = self.app.comms.get_upload_stats()
+                if st:
+                    rate = f" | {st['bps'] / 1024:.1f} KB/s"
 
-            self.eta = f"ETA: {'Paused' if self.paused else datetime.timedelta(seconds=int(eta))} | {n / self.nlines:.1%}"
+            self.eta = f"ETA: {'Paused' if self.paused else datetime.timedelta(seconds=int(eta))} | {done:.1%}{rate}"
 
     def list_sdcard(self):
         if self.app.comms.list_sdcard(self._list_sdcard_results):
@@ -1051,12 +1155,13 @@ class MainWindow(BoxLayout):
         self.app.comms.release_m0()
 
     # called by query timer in comms context, return strings for queries to send
-    def get_queries(self):
+    # busy_ok is set when comms has throttled the queries enough to send them to a running v1
+    def get_queries(self, busy_ok=False):
         if not self.app.is_connected or self.is_printing:
             return ""
 
-        if not self.app.is_v2 and self.status in ['Run', 'Home']:
-            # FIXME: for v1 we do not send these commands when running as they clog up the USB serial channel
+        if not self.app.is_v2 and self.status in ['Run', 'Home'] and not busy_ok:
+            # for v1 we do not send these commands on every poll when running as they clog up the USB serial channel
             return ""
 
         cmd = ""
@@ -1113,6 +1218,13 @@ class MainWindow(BoxLayout):
 
         self.app.sm.current = 'calculator'
 
+    def open_diagnostics(self, arg=None):
+        if not self.app.sm.has_screen('diagnostics'):
+            diagnostics = DiagnosticsScreen(name='diagnostics')
+            self.app.sm.add_widget(diagnostics)
+
+        self.app.sm.current = 'diagnostics'
+
 
 class MainScreen(Screen):
     pass
@@ -1158,6 +1270,8 @@ class SmoothieHost(App):
         self.is_v2 = True
         self.wait_on_m0 = False
         self.fast_stream_cmd = ""
+        self.preflight_process = False
+        self.eta_acceleration = 1000.0
         self.is_cnc = False
         self.is_desktop = 0
         self.webserver = False
@@ -1165,6 +1279,7 @@ class SmoothieHost(App):
         self.blank_timeout = 0
         self.last_touch_time = 0
         self.camera_url = None
+        self.camera_relay = None
         self.loaded_modules = []
         self.last_probe = {'X': 0, 'Y': 0, 'Z': 0, 'status': False}
         self.tool_scripts = ToolScripts()
@@ -1190,11 +1305,18 @@ class SmoothieHost(App):
             'last_print_file': '',
             'serial_port': 'serial:///dev/ttyACM0',
             'report_rate': '1.0',
+            'fast_report_rate': '0.1',
+            'stream_window': '0',
+            'auto_reconnect': 'true',
+            'upload_window': '8',
+            'upload_verify': 'false',
             'blank_timeout': '0',
             'manual_tool_change': 'false',
             'wait_on_m0': 'false',
             'tool_change_popup': 'true',
             'fast_stream_cmd': 'python3 -u comms.py serial:///dev/ttyACM1 {file} -f -q',
+            'preflight_process': 'false',
+            'eta_acceleration': '1000',
             'v2': 'false',
             'is_spindle_camera': 'false',
             'notify_email': 'false',
@@ -1212,7 +1334,8 @@ class SmoothieHost(App):
             'screen_offset': '0,0',
             'filechooser': 'default',
             'touch_screen': 'false',
-            'use_keypad': 'default'
+            'use_keypad': 'default',
+            'console_lines': '200'
         })
         config.setdefaults('Viewer', {
             'slice': "1.0",
@@ -1229,7 +1352,8 @@ class SmoothieHost(App):
         config.setdefaults('Web', {
             'webserver': 'false',
             'show_video': 'false',
-            'camera_url': 'http://localhost:8080/?action=stream'
+            'camera_url': 'http://localhost:8080/?action=stream',
+            'camera_max_fps': '10'
         })
 
     def build_settings(self, settings):
@@ -1261,6 +1385,12 @@ class SmoothieHost(App):
                   "options": ["default", "yes", "no"]
                 },
 
+                { "type": "numeric",
+                  "title": "Console lines",
+                  "desc": "Number of lines kept in the console, older lines are saved in ~/.cache/smoopi/console and can be searched with ctrl-f in desktop mode",
+                  "section": "UI",
+                  "key": "console_lines" },
+
                 { "type": "bool",
                   "title": "CNC layout",
                   "desc": "Turn on for a CNC layout, otherwise it is a 3D printer Layout",
@@ -1293,6 +1423,36 @@ class SmoothieHost(App):
                   "section": "General",
                   "key": "report_rate" },
 
+                { "type": "numeric",
+                  "title": "Fast report rate",
+                  "desc": "Rate in seconds to query for status when running or jogging, idle polling backs off when not in use, 0 disables",
+                  "section": "General",
+                  "key": "fast_report_rate" },
+
+                { "type": "numeric",
+                  "title": "Stream window",
+                  "desc": "Bytes allowed to be unacknowledged when streaming (character counting), 0 is ping pong, 128 is good for V1",
+                  "section": "General",
+                  "key": "stream_window" },
+
+                { "type": "bool",
+                  "title": "Auto reconnect",
+                  "desc": "Reconnect if the connection is lost, commands sent while reconnecting are sent once reconnected",
+                  "section": "General",
+                  "key": "auto_reconnect" },
+
+                { "type": "numeric",
+                  "title": "Upload window",
+                  "desc": "Lines allowed to be waiting for their ok when uploading to the sdcard, 0 sends without waiting for the oks",
+                  "section": "General",
+                  "key": "upload_window" },
+
+                { "type": "bool",
+                  "title": "Verify uploads",
+                  "desc": "Check the size of the file on the sdcard after uploading",
+                  "section": "General",
+                  "key": "upload_verify" },
+
                 { "type": "numeric",
                   "title": "Blank Timeout",
                   "desc": "Inactive timeout in seconds before screen will blank",
@@ -1334,6 +1494,19 @@ class SmoothieHost(App):
                   "key": "fast_stream_cmd"
                 },
 
+                { "type": "numeric",
+                  "title": "ETA acceleration",
+                  "desc": "Acceleration in mm/sec² used to estimate the run time, set to the acceleration in the smoothie config",
+                  "section": "General",
+                  "key": "eta_acceleration" },
+
+                { "type": "bool",
+                  "title": "Preflight in a process",
+                  "desc": "Analyze files before they are run in a separate process, uses more memory but does not slow the UI on large files",
+                  "section": "General",
+                  "key": "preflight_process"
+                },
+
                 { "type": "bool",
                   "title": "Notify via EMail",
                   "desc": "send email when runs finish",
@@ -1365,6 +1538,13 @@ class SmoothieHost(App):
                   "key": "camera_url"
                 },
 
+                { "type": "numeric",
+                  "title": "Camera max FPS",
+                  "desc": "Most frames per second shown on the Web Cam screen, lower uses less CPU",
+                  "section": "Web",
+                  "key": "camera_max_fps"
+                },
+
                 { "type": "title",
                   "title": "Extruder Settings" },
 
@@ -1401,10 +1581,16 @@ class SmoothieHost(App):
             self.main_window.display("NOTICE: Restart is needed")
         elif token == ('UI', 'tab_top'):
             self.tab_top = value == "1"
+        elif token == ('UI', 'console_lines'):
+            self.main_window.console.set_capacity(int(value))
+            self.main_window.uart_console.set_capacity(int(value))
         elif token == ('Extruder', 'hotend_presets'):
             self.main_window.ids.extruder.ids.set_hotend_temp.values = value.split(',')
         elif token == ('Extruder', 'bed_presets'):
             self.main_window.ids.extruder.ids.set_bed_temp.values = value.split(',')
+        elif token == ('General', 'fast_report_rate'):
+            self.comms.fast_report_rate = float(value)
+
         elif token == ('General', 'blank_timeout'):
             self.blank_timeout = float(value)
         elif token == ('General', 'manual_tool_change'):
@@ -1413,26 +1599,66 @@ class SmoothieHost(App):
             self.wait_on_m0 = value == '1'
         elif token == ('Web', 'camera_url'):
             self.camera_url = value
+            if self.camera_relay:
+                # used the next time it connects
+                self.camera_relay.url = value
+        elif token == ('Web', 'camera_max_fps'):
+            pass  # read each time the web cam screen is shown
         elif token == ('General', 'fast_stream_cmd'):
             self.fast_stream_cmd = value
+        elif token == ('General', 'preflight_process'):
+            self.preflight_process = value == '1'
+        elif token == ('General', 'eta_acceleration'):
+            self.eta_acceleration = float(value)
         elif token == ('General', 'notify_email'):
             self.notify_email = value == '1'
         elif token == ('Jog', 'safez'):
             self.safez = float(value)
+        elif token == ('General', 'stream_window'):
+            self.comms.stream_window = int(float(value))
+        elif token == ('General', 'auto_reconnect'):
+            self.comms.auto_reconnect = value == '1'
+        elif token == ('General', 'upload_window'):
+            self.comms.upload_window = int(float(value))
+        elif token == ('General', 'upload_verify'):
+            self.comms.upload_verify = value == '1'
         else:
             self.main_window.display("NOTICE: Restart is needed")
 
+    def _publish_web_status(self, *args):
+        ''' the web server threads only ever see this snapshot, so they never touch the UI '''
+        mw = self.main_window
+        self.webserver.publish({
+            'connected': self.is_connected,
+            'status': self.status,
+            'printing': mw.is_printing,
+            'suspended': mw.is_suspended,
+            'eta': mw.eta,
+            'file': self.gcode_file,
+            'wpos': list(self.wpos),
+            'mpos': list(self.mpos),
+            'camera_url': self.camera_url if self.is_show_camera else None
+        })
+
+    def _publish_web_metrics(self, *args):
+        m = self.comms.metrics
+        self.webserver.publish_metrics(m.to_prometheus(), m.to_json())
+
     def on_stop(self):
         # The Kivy event loop is about to stop, stop the async main loop
         self.comms.stop()   # stop the aysnc loop
         if self.is_webserver:
             self.webserver.stop()
+        if self.camera_relay:
+            self.camera_relay.stop()
         if self.is_touch and self.blank_timeout > 0 and self._blanked:
             # unblank if blanked
             self.unblank_screen()
         # stop any loaded modules
         for m in self.loaded_modules:
             m.stop()
+        self.main_window.console.close()
+        self.main_window.uart_console.close()
 
     def on_start(self):
         # in case we added something to the defaults, make sure they are written to the ini file
@@ -1519,6 +1745,8 @@ class SmoothieHost(App):
             Builder.load_file('rpi.kv')
 
         self.fast_stream_cmd = self.config.get('General', 'fast_stream_cmd')
+        self.preflight_process = self.config.getboolean('General', 'preflight_process')
+        self.eta_acceleration = self.config.getfloat('General', 'eta_acceleration')
         self.notify_email = self.config.getboolean('General', 'notify_email')
         self.is_cnc = self.config.getboolean('UI', 'cnc')
         self.tab_top = self.config.getboolean('UI', 'tab_top')
@@ -1531,6 +1759,11 @@ class SmoothieHost(App):
         self.hdmi = self.config.getboolean('General', 'hdmi')
         self.safez = self.config.getfloat('Jog', 'safez')
         self.comms = Comms(App.get_running_app(), self.config.getfloat('General', 'report_rate'))
+        self.comms.stream_window = int(self.config.getfloat('General', 'stream_window'))
+        self.comms.auto_reconnect = self.config.getboolean('General', 'auto_reconnect')
+        self.comms.upload_window = int(self.config.getfloat('General', 'upload_window'))
+        self.comms.upload_verify = self.config.getboolean('General', 'upload_verify')
+        self.comms.fast_report_rate = self.config.getfloat('General', 'fast_report_rate')
         self.gcode_file = self.config.get('General', 'last_print_file')
 
         # see if we want to force the use of the keypad
@@ -1637,15 +1870,31 @@ class SmoothieHost(App):
         if not self.is_cnc:
             self.main_window.ids.tabs.jog_rose.jogrosemain.remove_widget(self.main_window.ids.tabs.jog_rose.abc_panel)
 
+        if self.is_show_camera:
+            # the web cam screen and the web server share the one connection to the camera
+            self.camera_url = self.config.get('Web', 'camera_url')
+            self.camera_relay = MjpegRelay(self.camera_url,
+                                           user=self.config.get('Web', 'camera_user', fallback=None),
+                                           pw=self.config.get('Web', 'camera_password', fallback=None),
+                                           singleshot=self.config.getboolean('Web', 'camera_singleshot', fallback=False))
+
         if self.is_webserver:
             self.webserver = ProgressServer()
             self.webserver.start(self, 8000)
+            # the web server is given a copy of the state whenever it changes
+            self._web_trigger = Clock.create_trigger(self._publish_web_status)
+            self.bind(is_connected=self._web_trigger, status=self._web_trigger, wpos=self._web_trigger, mpos=self._web_trigger, gcode_file=self._web_trigger)
+            self.main_window.bind(eta=self._web_trigger, is_printing=self._web_trigger, is_suspended=self._web_trigger)
+            self._web_trigger()
+            # the metrics change all the time so they are copied on a timer rather than on change
+            Clock.schedule_interval(self._publish_web_metrics, WEB_METRICS_INTERVAL)
+            self._publish_web_metrics()
 
         # add calculator to menu
         self.main_window.tools_menu.add_widget(ActionButton(text='Calculator', on_press=self.main_window.open_calculator))
+        self.main_window.tools_menu.add_widget(ActionButton(text='Diagnostics', on_press=self.main_window.open_diagnostics))
 
         if self.is_show_camera:
-            self.camera_url = self.config.get('Web', 'camera_url')
             self.sm.add_widget(CameraScreen(name='web cam'))
             self.main_window.tools_menu.add_widget(ActionButton(text='Web Cam', on_press=self._show_web_cam))
 
@@ -1777,8 +2026,12 @@ class SmoothieHost(App):
                     pass
                 elif codepoint == 'c':
                     # clear console
-                    self.main_window.ids.log_window.data = []
+                    self.main_window.clear_log()
                     self.command_history = None
+                elif codepoint == 'f':
+                    # search console including the lines that have been spilled to disk
+                    o = InputBox(title='Search console', text='enter text to search for', cb=self.main_window.search_log)
+                    o.open()
 
             elif self.command_history:
                 self.command_history = None
@@ -0,0 +1,154 @@
+# a small registry of counters, gauges and histograms for the comms layer
+#
+# The metrics are updated from the comms thread and read from the UI and web server threads, the values are
+# simple numbers so a snapshot is consistent enough for display without any locking.
+# They can be exported as JSON or in the Prometheus text format.
+
+import bisect
+import json
+import time
+
+# latency buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# buckets for short bits of work like handling a block of incoming data
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+
+class Counter():
+    """ a value that only goes up """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def reset(self):
+        self.value = 0
+
+    def snapshot(self):
+        return self.value
+
+    def prometheus(self):
+        return [f'{self.name} {self.value}']
+
+
+class Gauge(Counter):
+    """ a value that can go up or down """
+    kind = 'gauge'
+
+    def set(self, v):
+        self.value = v
+
+    def reset(self):
+        # a gauge is the current state (eg connected) not a count since the reset, so it is kept
+        pass
+
+
+class Histogram():
+    """ counts of observations in fixed buckets, plus the count, sum and max """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)  # the last is for anything over the last bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q):
+        ''' estimate of the q quantile, the upper bound of the bucket it falls in '''
+        if self.count == 0:
+            return 0.0
+        n = q * self.count
+        c = 0
+        for i, b in enumerate(self.buckets):
+            c += self.counts[i]
+            if c >= n:
+                return b
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'avg': self.sum / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts))
+        }
+
+    def prometheus(self):
+        ll = []
+        c = 0
+        for b, n in zip(self.buckets, self.counts):
+            c += n
+            ll.append(f'{self.name}_bucket{{le="{b}"}} {c}')
+        ll.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        ll.append(f'{self.name}_sum {self.sum}')
+        ll.append(f'{self.name}_count {self.count}')
+        return ll
+
+
+class Metrics():
+    """ registry of the metrics by name """
+
+    def __init__(self, prefix='smoopi_'):
+        self.prefix = prefix
+        self.metrics = {}
+        self.start = time.time()
+
+    def _add(self, m):
+        self.metrics[m.name[len(self.prefix):]] = m
+        return m
+
+    def counter(self, name, help):
+        return self._add(Counter(self.prefix + name, help))
+
+    def gauge(self, name, help):
+        return self._add(Gauge(self.prefix + name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, buckets))
+
+    def get(self, name):
+        return self.metrics[name]
+
+    def reset(self):
+        ''' zero the counters and histograms, the gauges keep their current values '''
+        for m in self.metrics.values():
+            m.reset()
+        self.start = time.time()
+
+    def snapshot(self):
+        ''' a dict of the current values '''
+        d = {k: m.snapshot() for k, m in self.metrics.items()}
+        d['uptime'] = time.time() - self.start
+        return d
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        ll = []
+        for m in self.metrics.values():
+            ll.append(f'# HELP {m.name} {m.help}')
+            ll.append(f'# TYPE {m.name} {m.kind}')
+            ll.extend(m.prometheus())
+        return '\n'.join(ll) + '\n'
@@ -0,0 +1,283 @@
+# shares one MJPEG camera stream between any number of viewers
+#
+# A single thread reads the upstream stream (from mjpg-streamer etc) while there is at least one subscriber and
+# keeps only the latest frame. Each viewer waits for a frame newer than the last one it got, so a slow viewer
+# just skips the frames it was too slow for and never holds up the others or the upstream.
+
+import base64
+import http.client
+import logging
+import socket
+import threading
+import time
+import urllib.parse
+
+RETRY_DELAY = 1.0  # first delay before reconnecting to the camera after an error
+MAX_RETRY_DELAY = 10.0
+SINGLESHOT_DELAY = 0.2  # delay between snapshots when the camera only supplies single frames
+FRAME_BUFFER_SIZE = 256 * 1024  # initial size of the read buffer, it grows if a frame is bigger
+READ_SIZE = 16 * 1024  # minimum space kept free in the buffer for each read
+MAX_HEADER_SIZE = 4096  # a part header bigger than this means we are lost in the stream
+MAX_FRAME_SIZE = 8 * 1024 * 1024  # a frame bigger than this means we are lost in the stream
+CONNECT_TIMEOUT = 10.0
+STOP_TIMEOUT = 2.0  # how long stop waits for the reader thread, it is a daemon so it can not hold up the exit
+
+
+class MjpegParser():
+    """ reads the jpeg frames from a multipart MJPEG stream, or a single jpeg
+
+    Everything is read into one preallocated buffer as it arrives. When the part headers have a Content-Length the frame is read
+    without searching it, otherwise the boundary (or the end of the jpeg if there is no boundary) is searched for,
+    each search only looks at the data added since the last one.
+    """
+
+    def __init__(self, stream, content_type='', content_length=None):
+        self.stream = stream
+        self.buf = bytearray(FRAME_BUFFER_SIZE)
+        self.start = 0  # first byte not yet used
+        self.end = 0  # end of the data read
+        self.single_length = None
+        self.boundary = None
+        ct = content_type.lower()
+        if ct.startswith('multipart'):
+            for param in content_type.split(';')[1:]:
+                k, _, v = param.strip().partition('=')
+                if k.lower() == 'boundary':
+                    # some servers include the leading -- in the header and some do not, just look for the token
+                    self.boundary = v.strip('"').lstrip('-').encode('latin1')
+        elif ct.startswith('image/') and content_length is not None:
+            self.single_length = int(content_length)
+
+    def _fill(self, need=READ_SIZE):
+        ''' read more data, making room for at least need more bytes by compacting or growing the buffer '''
+        if len(self.buf) - self.end < need:
+            n = self.end - self.start
+            if self.start > 0:
+                self.buf[:n] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = n
+            if len(self.buf) - n < need:
+                self.buf.extend(bytes(max(need, len(self.buf))))
+
+        # read1 returns whatever has arrived rather than blocking until the buffer is full
+        data = self.stream.read1(len(self.buf) - self.end)
+        if not data:
+            raise EOFError('camera stream closed')
+        n = len(data)
+        self.buf[self.end:self.end + n] = data
+        self.end += n
+
+    def _find(self, pat, frm, limit=None, discard=False):
+        ''' returns the position of pat at or after frm, reading more as needed, only new data is searched each time
+            if discard is True the data searched is not needed, so it is dropped rather than kept in the buffer
+        '''
+        while True:
+            i = self.buf.find(pat, frm, self.end)
+            if i >= 0:
+                return i
+            # the pattern may straddle the end of what we have so far
+            frm = max(frm, self.end - len(pat) + 1)
+            if discard:
+                self.start = frm
+            elif limit is not None and self.end - self.start > limit:
+                raise ValueError('camera stream is not a valid MJPEG stream')
+            offset = self.start
+            self._fill()
+            frm -= offset - self.start  # the data may have been moved to the start of the buffer
+
+    def _take(self, n):
+        ''' returns the next n bytes, reading as needed '''
+        while self.end - self.start < n:
+            self._fill(n - (self.end - self.start))
+        frame = bytes(self.buf[self.start:self.start + n])
+        self.start += n
+        return frame
+
+    def read_frame(self):
+        ''' returns the next jpeg frame as bytes '''
+        if self.single_length is not None:
+            return self._take(self.single_length)
+
+        if self.boundary is None:
+            # no idea how the frames are delimited so find the start and end of the jpeg, anything before the start is junk
+            self.start = self._find(b'\xff\xd8', self.start, discard=True)
+            i = self._find(b'\xff\xd9', self.start + 2, MAX_FRAME_SIZE)
+            return self._take(i + 2 - self.start)
+
+        # skip to the next boundary then parse the part headers
+        i = self._find(self.boundary, self.start, MAX_HEADER_SIZE)
+        self.start = i + len(self.boundary)
+        i = self._find(b'\r\n\r\n', self.start, MAX_HEADER_SIZE)
+        length = None
+        for ln in bytes(self.buf[self.start:i]).split(b'\r\n'):
+            k, _, v = ln.partition(b':')
+            if k.strip().lower() == b'content-length':
+                length = int(v)
+        self.start = i + 4
+
+        if length is not None:
+            return self._take(length)
+
+        # no length so the frame is everything up to the next boundary
+        i = self._find(b'\r\n--' + self.boundary, self.start, MAX_FRAME_SIZE)
+        return self._take(i - self.start)
+
+
+class MjpegRelay():
+    """ single upstream MJPEG reader whose latest frame is shared by all the subscribers """
+
+    def __init__(self, url, user=None, pw=None, singleshot=False):
+        self.url = url
+        self.user = user
+        self.pw = pw
+        self.singleshot = singleshot
+        self.log = logging.getLogger()
+        self.cond = threading.Condition()
+        self.clients = 0
+        self.frame = None
+        self.seq = 0  # incremented for every new frame
+        self.frames = 0  # frames read from upstream
+        self.thread = None
+        self.stopping = False
+        self.conn = None  # kept open between single shots
+        self.sock = None  # the socket being read, so stop can break a blocked read
+
+    def subscribe(self):
+        ''' a viewer wants frames, starts the upstream reader if it is not running '''
+        with self.cond:
+            self.clients += 1
+            self.stopping = False
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self):
+        ''' the upstream reader stops once there are no subscribers '''
+        with self.cond:
+            self.clients = max(0, self.clients - 1)
+            self.cond.notify_all()
+
+    def stop(self):
+        ''' stops the upstream reader and releases any waiting viewers '''
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+            t = self.thread
+            sock = self.sock
+        if sock is not None:
+            # the reader may be blocked reading the camera for up to CONNECT_TIMEOUT, this makes the read return
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if t is not None:
+            t.join(STOP_TIMEOUT)
+
+    def wait_frame(self, seq, timeout=None):
+        ''' wait until there is a frame newer than seq, returns (seq, jpeg bytes) of the latest frame, or the same seq on timeout '''
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq != seq or self.stopping, timeout)
+            return self.seq, self.frame
+
+    def _running(self):
+        return self.clients > 0 and not self.stopping
+
+    def _publish(self, jpg):
+        with self.cond:
+            self.frame = jpg
+            self.seq += 1
+            self.frames += 1
+            self.cond.notify_all()
+
+    def _open(self, retry=True):
+        ''' send the request, reusing the connection if it is still open, returns the response '''
+        u = urllib.parse.urlsplit(self.url)
+        if self.conn is None:
+            if u.scheme == 'https':
+                self.conn = http.client.HTTPSConnection(u.netloc, timeout=CONNECT_TIMEOUT)
+            else:
+                self.conn = http.client.HTTPConnection(u.netloc, timeout=CONNECT_TIMEOUT)
+
+        headers = {}
+        if self.user and self.pw:
+            headers['Authorization'] = 'Basic ' + base64.b64encode(f'{self.user}:{self.pw}'.encode('utf-8')).decode('ascii')
+
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        try:
+            self.conn.request('GET', path, headers=headers)
+            # the response keeps reading the socket after the connection lets go of it when it will close
+            self.sock = self.conn.sock
+            resp = self.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            self._close()
+            if not retry:
+                raise
+            # the camera may have closed the connection we kept open, so try once more on a new one
+            return self._open(False)
+
+        if resp.status == 401:
+            self._close()
+            raise PermissionError(f"requires authentication: {resp.getheader('www-authenticate')}")
+        if resp.status != 200:
+            self._close()
+            raise ConnectionError(f'HTTP error {resp.status} {resp.reason}')
+        return resp
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self.sock = None
+
+    def _run(self):
+        self.log.info(f"MjpegRelay: started reading {self.url}")
+        delay = RETRY_DELAY
+        while True:
+            with self.cond:
+                if not self._running():
+                    self.thread = None
+                    break
+
+            try:
+                self._read_stream()
+                delay = RETRY_DELAY
+
+            except Exception as err:
+                if not self._running():
+                    # stop broke the read
+                    continue
+                self.log.error(f"MjpegRelay: Failed to read url: {self.url} - error: {err}")
+
+                # keep trying while someone is watching
+                t = time.monotonic() + delay
+                while self._running() and time.monotonic() < t:
+                    time.sleep(0.1)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+        self.log.info("MjpegRelay: stopped reading")
+
+    def _read_stream(self):
+        ''' reads frames from the upstream until there are no subscribers '''
+        try:
+            resp = self._open()
+            parser = MjpegParser(resp, resp.getheader('content-type', ''), resp.getheader('content-length'))
+            while self._running():
+                self._publish(parser.read_frame())
+
+                if self.singleshot:
+                    # camera only supplies a snapshot not a stream, the connection is reused if the camera allows it
+                    if parser.single_length is None or resp.will_close:
+                        self._close()
+                    else:
+                        resp.read()  # finishes the response so the connection can be used for the next one
+                    time.sleep(SINGLESHOT_DELAY)
+                    return
+
+        except Exception:
+            self._close()
+            raise
+
+        # nobody is watching now
+        self._close()
@@ -0,0 +1,89 @@
+# parses the <...> status reports from smoothie into a reusable record
+# <Idle|MPos:68.9980,-49.9240,40.0000,12.3456|WPos:68.9980,-49.9240,40.0000|F:12345.12|S:1.2>
+# if temp readings are enabled then also returns T:25.0,0.0|B:25.2,0.0
+
+
+class StatusReport():
+    """ Fixed slot record of the last status report, parse() fills it in place and reports if anything changed """
+
+    # the prefix of each field in the report and the slot it is stored in
+    FIELDS = (
+        (b'|MPos:', 'mpos'),
+        (b'|WPos:', 'wpos'),
+        (b'|F:', 'f'),
+        (b'|S:', 's'),
+        (b'|L:', 'l'),
+        (b'|SD:', 'sd'),
+        (b'|T:', 't'),
+        (b'|T1:', 't1'),
+        (b'|B:', 'b')
+    )
+
+    VALUES = ('state', 'mpos', 'wpos', 'f', 's', 'l', 'sd', 't', 't1', 'b')
+
+    # _raw holds the bytes each value was last parsed from, the state first then the FIELDS in order
+    __slots__ = VALUES + ('_raw',)
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        ''' forget the last report so the next one is seen as a change '''
+        for a in self.VALUES:
+            setattr(self, a, None)
+        self._raw = [None] * (len(self.FIELDS) + 1)
+
+    def copy(self):
+        ''' a snapshot that can be handed to another thread, the values are immutable tuples '''
+        r = StatusReport.__new__(StatusReport)
+        for a in self.VALUES:
+            setattr(r, a, getattr(self, a))
+        r._raw = None
+        return r
+
+    def parse(self, s):
+        ''' parse the bytes of a <...> report, returns True if anything changed since the last one
+            or None if the report is in the old status format
+        '''
+        # the state is up to the first |, and the new format has at least two fields after it
+        i = s.find(b'|')
+        if i < 0 or s.find(b'|', i + 1) < 0:
+            return None
+
+        end = len(s) - 1  # the >
+        raw = self._raw
+        changed = False
+
+        # each value is compared in place with the bytes it was last parsed from, and only converted if it differs
+        r = raw[0]
+        if r is None or len(r) != i - 1 or not s.startswith(r, 1):
+            raw[0] = r = s[1:i]
+            self.state = r.decode('latin1')
+            changed = True
+
+        n = 0
+        for prefix, a in self.FIELDS:
+            n += 1
+            p = s.find(prefix, i)
+            if p < 0:
+                # fields that are not in this report are cleared
+                if raw[n] is not None:
+                    raw[n] = None
+                    setattr(self, a, None)
+                    changed = True
+                continue
+
+            p += len(prefix)
+            e = s.find(b'|', p)
+            if e < 0:
+                e = end
+            r = raw[n]
+            if r is not None and len(r) == e - p and s.startswith(r, p):
+                continue
+
+            r = s[p:e]
+            setattr(self, a, tuple(map(float, r.split(b','))))
+            raw[n] = r
+            changed = True
+
+        return changed
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# streaming benchmark, streams a file with Comms.stream_file to the smoothie emulator in each streaming mode
+#
+# For each mode it measures the lines/sec, the ok latency (from the comms ok_rtt histogram) and the CPU used by
+# this process per line, the emulator runs in its own process so its CPU is not counted. The results are printed
+# and can be saved as JSON, and compared with a previous run to catch regressions.
+#
+# The modes are run once for each link round trip time in --ok-latency, by default with none and with 2ms which is
+# where keeping lines in flight should beat ping pong. The results with a round trip time are named mode@2ms.
+#
+# Run from the top of the repo:
+#   python3 tests/bench_streaming.py [--lines N] [--file gcode] [--net] [--modes pingpong,window,fast]
+#       [--ok-latency 0,0.002] [--output results.json] [--baseline old.json] [--tolerance 0.15] [emulator options]
+# It exits with 1 if the baseline was given and a mode got slower or used more CPU than the tolerance allows.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+os.chdir(TOP)
+
+import comms  # noqa: E402
+
+EMULATOR = os.path.join(TOP, 'tests', 'smoothie_emulator.py')
+MODES = ('pingpong', 'window', 'fast')
+
+
+class BenchApp():
+    """ the parts of the app and main window that Comms uses, without any UI """
+
+    def __init__(self, verbose=False):
+        self.main_window = self
+        self.verbose = verbose
+        self.connected_ev = threading.Event()
+        self.end_event = threading.Event()
+        self.is_connected = False
+        self.ok = False
+        self.is_v2 = False
+        self.is_sdprint = False
+        self.cont_jog = False
+        self.last_probe = None
+        self.manual_tool_change = False
+        self.wait_on_m0 = False
+        self.spindle_handler = None
+        self.alarms = []
+
+    def connected(self):
+        self.is_connected = True
+        self.connected_ev.set()
+
+    def disconnected(self):
+        self.is_connected = False
+        self.connected_ev.set()
+
+    def async_display(self, data):
+        if self.verbose:
+            print(data)
+
+    def stream_finished(self, ok):
+        self.ok = ok
+        self.end_event.set()
+
+    def alarm_state(self, msg):
+        self.alarms.append(msg)
+
+    def update_status(self, stat, d):
+        pass
+
+    def update_state(self, a):
+        pass
+
+    def action_paused(self, flag, suspend=False):
+        pass
+
+    def get_queries(self, busy_ok=False):
+        return ""
+
+    def tool_change_prompt(self, tool):
+        pass
+
+    def m0_dlg(self):
+        pass
+
+
+def make_gcode(fn, nlines):
+    ''' a 3D print like file of short G1 moves '''
+    rnd = random.Random(1)
+    x = y = e = 0.0
+    with open(fn, 'w') as f:
+        f.write('; benchmark file\nG21\nG90\nG92 E0\n')
+        for i in range(nlines):
+            x = min(max(x + rnd.uniform(-2, 2), 0), 200)
+            y = min(max(y + rnd.uniform(-2, 2), 0), 200)
+            e += rnd.uniform(0.01, 0.1)
+            f.write(f'G1 X{x:.3f} Y{y:.3f} E{e:.5f}\n')
+
+
+def start_emulator(args, ok_latency=0.0):
+    cmd = [sys.executable, EMULATOR, '--tcp', '0'] if args.net else [sys.executable, EMULATOR, '--pty']
+    cmd += ['--ok-latency', str(ok_latency), '--line-time', str(args.line_time), '--move-time', str(args.move_time),
+            '--queue', str(args.queue), '--rx-buffer', str(args.rx_buffer)]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.DEVNULL, text=True)
+    ln = p.stdout.readline()
+    if not ln.startswith('port:'):
+        p.kill()
+        raise RuntimeError(f'emulator did not start: {ln}')
+    return p, ln.split()[1]
+
+
+def run_mode(c, app, mode, fn, nlines, window):
+    c.fast_stream = mode == 'fast'
+    c.stream_window = window if mode == 'window' else 0
+    c.metrics.reset()
+    app.end_event.clear()
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    if not c.stream_gcode(fn):
+        raise RuntimeError('stream_gcode failed, not connected')
+    app.end_event.wait()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    rtt = c.metrics.snapshot()['ok_rtt_seconds']
+    r = {
+        'ok': app.ok,
+        'lines': nlines,
+        'elapsed': elapsed,
+        'lines_per_sec': nlines / elapsed,
+        'cpu': cpu,
+        'cpu_per_line_us': cpu / nlines * 1e6,
+        'tx_bytes': c.m_tx_bytes.value,
+        'drains': c.m_drains.value,
+    }
+    if rtt['count']:
+        # fast stream does not time each line
+        r['ok_latency_ms'] = {k: rtt[k] * 1000 for k in ('avg', 'p50', 'p99', 'max')}
+    if mode == 'window':
+        r['window'] = window
+    return r
+
+
+def compare(results, baseline, tolerance):
+    ''' returns a list of the regressions from the baseline '''
+    bad = []
+    for mode, r in results.items():
+        b = baseline.get('results', {}).get(mode)
+        if not b:
+            continue
+        if r['lines_per_sec'] < b['lines_per_sec'] * (1 - tolerance):
+            bad.append(f"{mode}: {r['lines_per_sec']:.0f} lines/sec, was {b['lines_per_sec']:.0f}")
+        if r['cpu_per_line_us'] > b['cpu_per_line_us'] * (1 + tolerance):
+            bad.append(f"{mode}: {r['cpu_per_line_us']:.1f} us CPU/line, was {b['cpu_per_line_us']:.1f}")
+    return bad
+
+
+def run_latency(args, modes, fn, nlines, latency):
+    ''' runs the modes with a new emulator with the latency as its link round trip time '''
+    emulator, port = start_emulator(args, latency)
+    app = BenchApp(args.verbose)
+    c = comms.Comms(app, args.report_rate)
+    # Comms sets the root logger to INFO
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    results = {}
+    t = None
+    try:
+        t = c.connect(port)
+        if not app.connected_ev.wait(10) or not app.is_connected:
+            raise RuntimeError(f'could not connect to the emulator on {port}')
+        time.sleep(0.5)  # let the M115 reply settle
+
+        for mode in modes:
+            name = f'{mode}@{latency * 1000:g}ms' if latency > 0 else mode
+            r = run_mode(c, app, mode, fn, nlines, args.window)
+            r['ok_latency'] = latency
+            results[name] = r
+            lat = r.get('ok_latency_ms')
+            lat = f", ok latency avg {lat['avg']:.2f} p99 {lat['p99']:.2f} max {lat['max']:.2f} ms" if lat else ''
+            print(f"{name:16} {'ok' if r['ok'] else 'FAILED':6} {r['lines_per_sec']:9.0f} lines/sec, {r['cpu_per_line_us']:7.1f} us CPU/line{lat}")
+
+    finally:
+        c.stop()
+        if t:
+            t.join(10)
+        emulator.kill()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Comms.stream_file against the smoothie emulator')
+    parser.add_argument('--lines', type=int, default=5000, help='lines in the generated gcode file')
+    parser.add_argument('--file', help='stream this gcode file instead of a generated one')
+    parser.add_argument('--net', action='store_true', help='connect over TCP instead of the pty')
+    parser.add_argument('--modes', default=','.join(MODES), help=f'comma separated modes from {",".join(MODES)}')
+    parser.add_argument('--window', type=int, default=128, help='character counting window in bytes')
+    parser.add_argument('--report-rate', type=float, default=0, help='status poll rate in secs, 0 for no polling')
+    parser.add_argument('--ok-latency', default='0,0.002', help='comma separated link round trip times in secs, each is a run of all the modes')
+    parser.add_argument('--line-time', type=float, default=0.0)
+    parser.add_argument('--move-time', type=float, default=0.0)
+    parser.add_argument('--queue', type=int, default=32)
+    parser.add_argument('--rx-buffer', type=int, default=4096)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='fraction slower than the baseline allowed')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    modes = [m for m in args.modes.split(',') if m]
+    for m in modes:
+        if m not in MODES:
+            parser.error(f'unknown mode {m}')
+    latencies = [float(v) for v in args.ok_latency.split(',') if v]
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+
+    tmp = None
+    if args.file:
+        fn = args.file
+        with open(fn, 'rb') as f:
+            nlines = sum(1 for ln in f if ln.strip() and not ln.startswith(b';'))
+    else:
+        tmp = tempfile.NamedTemporaryFile(suffix='.g', delete=False)
+        tmp.close()
+        fn = tmp.name
+        make_gcode(fn, args.lines)
+        nlines = args.lines + 3  # plus the header lines that are not comments
+
+    results = {}
+    try:
+        for latency in latencies:
+            results.update(run_latency(args, modes, fn, nlines, latency))
+
+    finally:
+        if tmp:
+            os.unlink(tmp.name)
+
+    out = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'connection': 'net' if args.net else 'pty',
+        'file': args.file,
+        'config': {'lines': nlines, 'report_rate': args.report_rate, 'ok_latency': latencies, 'line_time': args.line_time, 'move_time': args.move_time,
+                   'queue': args.queue, 'rx_buffer': args.rx_buffer},
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2)
+        print(f'results saved to {args.output}')
+
+    failed = [m for m, r in results.items() if not r['ok']]
+    if failed:
+        print(f"FAILED: {', '.join(failed)} did not complete")
+        sys.exit(1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            bad = compare(results, json.load(f), args.tolerance)
+        if bad:
+            print('REGRESSION:')
+            for b in bad:
+                print(f'  {b}')
+            sys.exit(1)
+        print('no regressions from the baseline')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# viewer parse benchmark, runs the viewer's gcode parsing headless on generated files
+#
+# Each file is parsed by the same code the viewer runs when a file is opened: the index is built then parse_view
+# extracts the geometry a chunk at a time, simplifies it to about a pixel and packs it into meshes, and simplifies
+# it again if too many segments were drawn. Drill files go through the viewer's line by line parse_gcode_file, as
+# they do in the viewer. The corpora are a multi layer 3D print, a 2D CNC job with thousands of arcs, a laser raster
+# with S modulated G1s and a FlatCAM drill file.
+#
+# For each one it reports the index and parse times (best of --repeat runs), the peak memory (measured with
+# tracemalloc in a separate run as it slows things down), the number of canvas instructions the viewer would add
+# and the point_count of the extracted geometry. The results can be saved as JSON and compared with a previous run.
+#
+# Run from the top of the repo:
+#   python3 tests/bench_viewer.py [--scale N] [--corpus printer,cnc,laser,drill] [--repeat N]
+#       [--output results.json] [--baseline old.json] [--time-tolerance 0.25] [--memory-tolerance 0.1]
+# It exits with 1 if the baseline was given and any corpus got slower, used more memory or more instructions
+# than the tolerances allow, or its point_count changed, or if the baseline was run with a different scale or size.
+#
+# NOTE the line by line parser is part of the viewer so the drill file needs kivy, it is imported without opening
+# a window and the Lines it draws are only counted as they need a GL context. Without kivy the drill file is skipped.
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+
+from gcode_index import GcodeIndex  # noqa: E402
+from gcode_geometry import numpy_available, parse_view  # noqa: E402
+
+
+def gen_printer(f, scale):
+    ''' a 3D print, each layer has round perimeters and zig zag infill with retracts and travel moves '''
+    rnd = random.Random(1)
+    e = 0.0
+    f.write('; 3D print benchmark\nG21\nG90\nM82\nM104 S200\nG28\nG92 E0\nG1 Z0.3 F3000\n')
+    for layer in range(int(50 * scale)):
+        z = 0.3 + layer * 0.2
+        f.write(f';LAYER:{layer}\nG1 Z{z:.2f} F3000\n')
+        for loop in range(3):
+            r = 40 - loop * 0.45 + rnd.uniform(-0.01, 0.01)
+            f.write(f'G0 X{100 + r:.3f} Y100.000 F6000\nG1 E{e + 1:.5f} F2400\n')
+            e += 1
+            for i in range(1, 129):
+                a = 2 * math.pi * i / 128
+                e += 0.06
+                f.write(f'G1 X{100 + r * math.cos(a):.3f} Y{100 + r * math.sin(a):.3f} E{e:.5f} F1800\n')
+            f.write(f'G1 E{e - 1:.5f} F2400\n')
+            e -= 1
+        for i in range(100):
+            y = 62 + i * 0.76
+            x0, x1 = (62, 138) if i % 2 == 0 else (138, 62)
+            f.write(f'G0 X{x0:.3f} Y{y:.3f}\n')
+            e += 2.5
+            f.write(f'G1 X{x1:.3f} Y{y:.3f} E{e:.5f}\n')
+    f.write('M104 S0\nM84\n')
+
+
+def gen_cnc(f, scale):
+    ''' a 2D CNC job of circular pockets cut with G2 arcs at several depths plus a G3 contour '''
+    n = int(1000 * scale)
+    cols = int(math.sqrt(n)) + 1
+    f.write('(CNC arcs benchmark)\nG21\nG90\nG94\nM3 S10000\nG0 Z5\n')
+    for depth in (-0.25, -0.5, -0.75, -1.0):
+        for h in range(n):
+            cx = 10 + (h % cols) * 6
+            cy = 10 + (h // cols) * 6
+            f.write(f'G0 Z1\nG0 X{cx + 2:.4f} Y{cy:.4f}\nG1 Z{depth:.4f} F100\n')
+            f.write(f'G2 X{cx - 2:.4f} Y{cy:.4f} I-2.0000 J0.0000 F400\nG2 X{cx + 2:.4f} Y{cy:.4f} I2.0000 J0.0000\n')
+        # a contour around everything made of quarter arcs
+        w = cols * 6 + 10
+        f.write(f'G0 Z1\nG0 X5 Y0\nG1 Z{depth:.4f} F100\n')
+        f.write(f'G1 X{w:.4f} Y0 F400\nG3 X{w + 5:.4f} Y5 I0 J5\nG1 X{w + 5:.4f} Y{w:.4f}\nG3 X{w:.4f} Y{w + 5:.4f} I-5 J0\n')
+        f.write(f'G1 X5 Y{w + 5:.4f}\nG3 X0 Y{w:.4f} I0 J-5\nG1 X0 Y5\nG3 X5 Y0 I5 J0\n')
+    f.write('G0 Z5\nM5\nM2\n')
+
+
+def gen_laser(f, scale):
+    ''' a laser raster image, each row is one G1 per pixel with the power in S '''
+    rnd = random.Random(2)
+    rows = int(200 * scale)
+    f.write('; laser raster benchmark\nG21\nG90\nM3\nG1 F3000\n')
+    for r in range(rows):
+        y = r * 0.1
+        f.write(f'G0 X0 Y{y:.2f} S0\n')
+        v = 0.5
+        for p in range(1, 401):
+            # a random walk so neighbouring pixels are similar, with some blank runs
+            v = min(max(v + rnd.uniform(-0.1, 0.1), 0.0), 1.0)
+            s = 0 if v < 0.2 else v
+            f.write(f'G1 X{p * 0.1:.2f} S{s:.3f}\n')
+    f.write('M5\nG0 X0 Y0\n')
+
+
+def gen_drill(f, scale):
+    ''' a FlatCAM excellon to gcode drill file with a tool table '''
+    rnd = random.Random(3)
+    tools = {1: 0.8, 2: 1.0, 3: 1.2, 4: 3.0}
+    f.write('(G-CODE GENERATED BY FLATCAM)\n(Name: benchmark_drill)\n(TOOLS DIAMETER: )\n')
+    for t, d in tools.items():
+        f.write(f'(Tool: {t} -> Dia: {d})\n')
+    f.write('\n(FEEDRATE Z: 100.0)\nG21\nG90\nG94\nG01 F100.00\nG00 Z2.0000\nM03\n')
+    n = int(2000 * scale)
+    for t in tools:
+        f.write(f'T{t}\nM6\nG00 Z2.0000\n')
+        for i in range(n // len(tools)):
+            f.write(f'G00 X{rnd.uniform(0, 100):.4f} Y{rnd.uniform(0, 80):.4f}\nG01 Z-1.7000\nG01 Z0\nG00 Z2.0000\n')
+    f.write('M05\nG00 Z2.0000\n')
+
+
+# name: (generator, twod mode, laser mode, drill mode, slice above, slice below)
+CORPORA = {
+    'printer': (gen_printer, False, False, False, -1.0, 0.0),
+    'cnc': (gen_cnc, True, False, False, -1.0, 0.0),  # the first slice the viewer shows
+    'laser': (gen_laser, True, True, False, -1.0, 0.0),
+    'drill': (gen_drill, True, False, True, -1.0, 0.0),
+}
+
+
+class DrawnLine():
+    """ stands in for the kivy Line, which can not be made without a GL context, and keeps what would be drawn """
+
+    def __init__(self, points=(), circle=None, **kwargs):
+        self.points = len(points) // 2
+        self.circle = circle
+
+
+class Canvas():
+    """ keeps the instructions the viewer adds """
+
+    def __init__(self):
+        self.instructions = []
+
+    def add(self, i):
+        self.instructions.append(i)
+
+    def clear(self):
+        self.instructions = []
+
+
+def load_viewer():
+    ''' returns the viewer module imported without opening a window, or None if kivy is not installed '''
+    os.environ['KIVY_NO_ARGS'] = '1'
+    os.environ.setdefault('KIVY_NO_CONSOLELOG', '1')
+    os.environ['KIVY_WINDOW'] = ''  # no window provider so no window is opened
+    try:
+        import viewer
+    except ImportError:
+        return None
+    viewer.Line = DrawnLine
+    return viewer
+
+
+def line_parser(viewer, idx, twod_mode, laser_mode, drill_mode, above, below):
+    ''' the state of the viewer screen its line by line parser uses, with the viewer's own methods '''
+    V = viewer.GcodeViewerScreen
+
+    class LineParser():
+        extract_tool = V.extract_tool
+        read_drill_list = V.read_drill_list
+        _read_spans = V._read_spans
+        parse_gcode_file = V.parse_gcode_file
+
+        def __init__(self):
+            self.index = idx
+            self.canv = Canvas()
+            self.ids = types.SimpleNamespace(surface=types.SimpleNamespace(transform=None, scale=1.0))
+            self.twod_mode = twod_mode
+            self.laser_mode = laser_mode
+            self.drill_mode = drill_mode
+            self.above_layer = above
+            self.below_layer = below
+            self.layers = [0]
+            self.max_vectors = -1
+            self.too_many = False
+            self.rval = 0.0
+            self.current_z = None
+            self.is_visible = False
+            self.bounds = None
+
+        def _finish_parse(self, *bounds):
+            self.bounds = bounds
+
+    return LineParser()
+
+
+def parse(fn, twod_mode, laser_mode, drill_mode, above, below, width, height, viewer=None):
+    ''' parses the file the way the viewer does when it is opened, returns the counts and times '''
+    t0 = time.perf_counter()
+    idx = GcodeIndex()
+    idx.build(fn)
+    t1 = time.perf_counter()
+
+    r = {
+        'lines': idx.nlines,
+        'layers': len(idx.layer_offsets),
+    }
+    if drill_mode:
+        p = line_parser(viewer, idx, twod_mode, laser_mode, drill_mode, above, below)
+        p.parse_gcode_file(fn, True)
+        drawn = p.canv.instructions
+        r['instructions'] = len(drawn)
+        r['point_count'] = sum(i.points for i in drawn if isinstance(i, DrawnLine))
+        r['drills'] = sum(1 for i in drawn if isinstance(i, DrawnLine) and i.circle is not None)
+
+    else:
+        chunks = []
+
+        def chunk(cuts, moves, rapids, v):
+            chunks.append(len(cuts) + len(moves) + len(rapids))
+
+        # the first layer or slice
+        v = parse_view(fn, idx, twod_mode, laser_mode, above, below, 0, width, height, chunk=chunk)
+        next_layer, full, tol, batches = v if v is not None else (None, ([], None), None, None)
+        # a Color and the meshes for the cuts then another Color and the meshes for the moves and the rapids
+        if batches is None:
+            r['instructions'] = sum(2 + n for n in chunks)
+        else:
+            # it is all redrawn simplified together
+            r['instructions'] = 2 + sum(len(b) for b in batches)
+        r['chunks'] = len(chunks)
+        r['point_count'] = len(full[0])
+
+    t2 = time.perf_counter()
+    r['index_time'] = t1 - t0
+    r['parse_time'] = t2 - t1
+    r['total_time'] = t2 - t0
+    return r
+
+
+def run(name, fn, args):
+    gen, twod_mode, laser_mode, drill_mode, above, below = CORPORA[name]
+    best = None
+    for i in range(args.repeat):
+        r = parse(fn, twod_mode, laser_mode, drill_mode, above, below, args.width, args.height, args.viewer)
+        if best is None:
+            best = r
+        else:
+            for k in ('index_time', 'parse_time', 'total_time'):
+                best[k] = min(best[k], r[k])
+
+    tracemalloc.start()
+    parse(fn, twod_mode, laser_mode, drill_mode, above, below, args.width, args.height, args.viewer)
+    best['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best['file_size'] = os.path.getsize(fn)
+    return best
+
+
+def compare(results, baseline, args):
+    ''' returns a list of the regressions from the baseline, raises ValueError if it was run with different settings '''
+    cfg = baseline.get('config', {})
+    diff = [f'{k} {cfg.get(k)}' for k in ('scale', 'width', 'height') if cfg.get(k) != getattr(args, k)]
+    if diff:
+        raise ValueError(f"the baseline was run with {', '.join(diff)}, use the same settings to compare with it")
+
+    bad = []
+    for name, r in results.items():
+        b = baseline.get('results', {}).get(name)
+        if not b:
+            continue
+        if r['total_time'] > b['total_time'] * (1 + args.time_tolerance):
+            bad.append(f"{name}: {r['total_time'] * 1000:.0f} ms, was {b['total_time'] * 1000:.0f} ms")
+        if r['peak_memory'] > b['peak_memory'] * (1 + args.memory_tolerance):
+            bad.append(f"{name}: peak memory {r['peak_memory'] / 1e6:.1f} MB, was {b['peak_memory'] / 1e6:.1f} MB")
+        if r['instructions'] > b['instructions'] * (1 + args.memory_tolerance):
+            bad.append(f"{name}: {r['instructions']} instructions, was {b['instructions']}")
+        if r['point_count'] != b['point_count']:
+            bad.append(f"{name}: point_count {r['point_count']}, was {b['point_count']}")
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the viewer gcode parsing on generated files')
+    parser.add_argument('--corpus', default=','.join(CORPORA), help=f'comma separated corpora from {",".join(CORPORA)}')
+    parser.add_argument('--scale', type=float, default=1.0, help='size of the generated files')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each, the best is reported')
+    parser.add_argument('--width', type=int, default=800, help='width of the viewer in pixels')
+    parser.add_argument('--height', type=int, default=480, help='height of the viewer in pixels')
+    parser.add_argument('--keep', help='write the generated files to this directory and keep them')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--time-tolerance', type=float, default=0.25, help='fraction slower than the baseline allowed')
+    parser.add_argument('--memory-tolerance', type=float, default=0.1, help='fraction more memory or instructions than the baseline allowed')
+    args = parser.parse_args()
+
+    if not numpy_available:
+        print('numpy is needed for the viewer parser')
+        sys.exit(1)
+
+    names = [n for n in args.corpus.split(',') if n]
+    for n in names:
+        if n not in CORPORA:
+            parser.error(f'unknown corpus {n}')
+
+    args.viewer = load_viewer() if any(CORPORA[n][3] for n in names) else None
+
+    tmpdir = args.keep or tempfile.mkdtemp(prefix='bench_viewer')
+    os.makedirs(tmpdir, exist_ok=True)
+    results = {}
+    try:
+        for name in names:
+            if CORPORA[name][3] and args.viewer is None:
+                print(f'{name:8} skipped, the viewer parses drill files line by line which needs kivy')
+                continue
+
+            fn = os.path.join(tmpdir, f'{name}.gcode')
+            with open(fn, 'w') as f:
+                CORPORA[name][0](f, args.scale)
+
+            r = run(name, fn, args)
+            results[name] = r
+            print(f"{name:8} {r['lines']:8} lines {r['file_size'] / 1e6:6.1f} MB: index {r['index_time'] * 1000:7.0f} ms, parse {r['parse_time'] * 1000:7.0f} ms, "
+                  f"peak {r['peak_memory'] / 1e6:6.1f} MB, {r['instructions']:5} instructions, point_count {r['point_count']}")
+
+    finally:
+        if not args.keep:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    out = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'config': {'scale': args.scale, 'repeat': args.repeat, 'width': args.width, 'height': args.height},
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2)
+        print(f'results saved to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            bad = compare(results, baseline, args)
+        except ValueError as e:
+            print(f'can not compare: {e}')
+            sys.exit(1)
+        if bad:
+            print('REGRESSION:')
+            for b in bad:
+                print(f'  {b}')
+            sys.exit(1)
+        print('no regressions from the baseline')
+
+
+if __name__ == "__main__":
+    main()
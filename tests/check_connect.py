@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# connect test, connects Comms to the smoothie emulator and checks the connection is usable straight away
+#
+# It checks that the connect completes without an error in the comms loop, that the M115 sent on connect gets its
+# reply, and that a short file streams to the end. By default it runs over the pty like a USB serial port, which is
+# where the transport is set up after the connect returns, and with --net over TCP as well.
+#
+# Run from the top of the repo:
+#   python3 tests/check_connect.py [--net] [-v]
+# It exits with 1 if any check failed.
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_streaming import BenchApp, start_emulator, make_gcode  # noqa: E402
+import comms  # noqa: E402
+
+
+class ConnectApp(BenchApp):
+    """ records what Comms displays so the replies can be checked """
+
+    def __init__(self, verbose=False):
+        super().__init__(verbose)
+        self.lines = []
+        self.m115_ev = threading.Event()
+        self.disconnected_ev = threading.Event()
+
+    def async_display(self, data):
+        super().async_display(data)
+        self.lines.append(data)
+        if data.startswith('FIRMWARE_NAME:'):
+            self.m115_ev.set()
+
+    def disconnected(self):
+        super().disconnected()
+        self.disconnected_ev.set()
+
+
+class LogErrors(logging.Handler):
+    """ keeps the errors logged by comms, the comms loop logs any exception rather than raising it """
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.errors = []
+
+    def emit(self, record):
+        self.errors.append(record.getMessage())
+
+
+def check(args, net):
+    ''' returns a list of the checks that failed '''
+    failed = []
+    args.net = net
+    emulator, port = start_emulator(args)
+    app = ConnectApp(args.verbose)
+    errors = LogErrors()
+    c = comms.Comms(app, 0)
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger().addHandler(errors)
+
+    tmp = tempfile.NamedTemporaryFile(suffix='.g', delete=False)
+    tmp.close()
+    make_gcode(tmp.name, 20)
+
+    t = None
+    try:
+        t = c.connect(port)
+        if not app.connected_ev.wait(10) or not app.is_connected:
+            failed.append(f'did not connect to {port}')
+            return failed
+
+        if not app.m115_ev.wait(5):
+            failed.append('no reply to the M115 sent on connect')
+
+        if app.disconnected_ev.is_set():
+            failed.append('disconnected straight after connecting')
+
+        elif not c.stream_gcode(tmp.name):
+            failed.append('stream_gcode failed, not connected')
+
+        elif not app.end_event.wait(10):
+            failed.append('the stream did not finish')
+
+        elif not app.ok:
+            failed.append('the stream failed')
+
+    finally:
+        c.stop()
+        if t:
+            t.join(10)
+        emulator.kill()
+        os.unlink(tmp.name)
+        logging.getLogger().removeHandler(errors)
+
+    failed += [f'comms logged: {e}' for e in errors.errors]
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check Comms connects to the smoothie emulator')
+    parser.add_argument('--net', action='store_true', help='check over TCP as well as the pty')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    # the emulator options start_emulator needs
+    args.line_time = 0.0
+    args.move_time = 0.0
+    args.queue = 32
+    args.rx_buffer = 4096
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+
+    bad = False
+    for net in ([False, True] if args.net else [False]):
+        start = time.monotonic()
+        failed = check(args, net)
+        name = 'net' if net else 'pty'
+        if failed:
+            bad = True
+            print(f'{name}: FAILED')
+            for f in failed:
+                print(f'  {f}')
+        else:
+            print(f'{name}: ok ({time.monotonic() - start:.1f} secs)')
+
+    if bad:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
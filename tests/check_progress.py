@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# progress test, streams a file that has lines not starting with G, M, X or Y to the smoothie emulator in each
+# streaming mode, and checks the progress counts match what the preflight counted for the ETA
+#
+# The streamer reports the GMXY lines sent (ping pong), the GMXY lines ok'd (character counting) or all the lines
+# ok'd (fast stream), and the UI divides that by the preflight gcode_lines or lines and looks it up in the ETA
+# profile, so if they count differently the progress stops or the ETA reads the wrong part of the profile.
+#
+# Run from the top of the repo:
+#   python3 tests/check_progress.py [--net] [--modes pingpong,window,fast] [-v]
+# It exits with 1 if any check failed.
+
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_streaming import BenchApp, MODES, start_emulator  # noqa: E402
+from gcode_preflight import analyze, Eta  # noqa: E402
+import comms  # noqa: E402
+
+
+def make_gcode(fn, nlines):
+    ''' a laser like file where the feed rate, power, tool and Z are changed on lines of their own '''
+    rnd = random.Random(2)
+    with open(fn, 'w') as f:
+        f.write('; progress test\n(header comment)\nG21\nG90\nT0\nF1200\nS0\nZ1\n\n')
+        for i in range(nlines):
+            if i % 7 == 0:
+                f.write(f'F{rnd.randint(600, 3000)}\n')
+            if i % 11 == 0:
+                f.write(f'S{rnd.random():.3f}\n')
+            if i % 50 == 0:
+                f.write(f'Z{rnd.uniform(0, 2):.2f}\n; layer {i // 50}\n')
+            if i % 3 == 0:
+                f.write(f'X{rnd.uniform(0, 100):.3f} Y{rnd.uniform(0, 100):.3f}\n')
+            else:
+                f.write(f'G1 X{rnd.uniform(0, 100):.3f} Y{rnd.uniform(0, 100):.3f}\n')
+        f.write('M400\n')
+
+
+def check_mode(c, app, mode, fn, pf, window):
+    ''' returns a list of the checks that failed '''
+    c.fast_stream = mode == 'fast'
+    c.stream_window = window if mode == 'window' else 0
+    app.end_event.clear()
+
+    # the same count the UI uses for the progress and ETA
+    nlines = pf.lines if c.fast_stream else pf.gcode_lines
+    counts = []
+    if not c.stream_gcode(fn, progress=counts.append):
+        return ['stream_gcode failed, not connected']
+    if not app.end_event.wait(60):
+        return ['the stream did not finish']
+
+    failed = []
+    if not app.ok:
+        failed.append('the stream failed')
+    if not counts:
+        return failed + ['no progress was reported']
+
+    last = counts[-1]
+    over = [n for n in counts if n > nlines]
+    if over:
+        failed.append(f'progress {max(over)} went past the {nlines} lines counted by the preflight')
+
+    if mode == 'pingpong':
+        # ping pong only reports every 10 lines
+        if last < nlines - 10:
+            failed.append(f'progress ended at {last} of {nlines}')
+    elif mode == 'window' and last != nlines:
+        failed.append(f'progress ended at {last} of {nlines}')
+
+    if mode != 'fast':
+        # the ETA profile is indexed by the same count so the end of the run is the end of the estimate
+        eta, done = Eta(pf).update(last, pf.est_time)
+        if mode == 'window' and (abs(done - 1.0) > 1e-6 or eta > 1e-6):
+            failed.append(f'ETA at the end is {eta:.1f} secs, {done:.1%} done')
+        elif done > 1.0 + 1e-6:
+            failed.append(f'ETA done {done:.1%} is past the end')
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the stream progress matches the preflight line count')
+    parser.add_argument('--net', action='store_true', help='connect over TCP instead of the pty')
+    parser.add_argument('--modes', default=','.join(MODES), help=f'comma separated modes from {",".join(MODES)}')
+    parser.add_argument('--lines', type=int, default=1000, help='moves in the generated gcode file')
+    parser.add_argument('--window', type=int, default=128, help='character counting window in bytes')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    modes = [m for m in args.modes.split(',') if m]
+    for m in modes:
+        if m not in MODES:
+            parser.error(f'unknown mode {m}')
+
+    # the emulator options start_emulator needs
+    args.line_time = 0.0
+    args.move_time = 0.0
+    args.queue = 32
+    args.rx_buffer = 4096
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+
+    tmp = tempfile.NamedTemporaryFile(suffix='.g', delete=False)
+    tmp.close()
+    make_gcode(tmp.name, args.lines)
+    pf = analyze(tmp.name)
+    print(f'{pf.lines} lines, {pf.gcode_lines} GMXY lines')
+
+    emulator, port = start_emulator(args)
+    app = BenchApp(args.verbose)
+    c = comms.Comms(app, 0)
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    bad = False
+    t = None
+    try:
+        t = c.connect(port)
+        if not app.connected_ev.wait(10) or not app.is_connected:
+            print(f'could not connect to the emulator on {port}')
+            sys.exit(1)
+
+        for mode in modes:
+            failed = check_mode(c, app, mode, tmp.name, pf, args.window)
+            if failed:
+                bad = True
+                print(f'{mode}: FAILED')
+                for f in failed:
+                    print(f'  {f}')
+            else:
+                print(f'{mode}: ok')
+
+    finally:
+        c.stop()
+        if t:
+            t.join(10)
+        emulator.kill()
+        os.unlink(tmp.name)
+
+    if bad:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import functools
 import sys
 import re
 import traceback
+import serial.tools.list_ports
 
 async_main_loop= None
 
@@ -20,18 +21,17 @@ class TcpConnection(asyncio.Protocol):
         self.hipri_queue = asyncio.Queue()
         self._ready = asyncio.Event()
         self._msg_ready = asyncio.Semaphore(value=0)
-        self.tsk= asyncio.async(self._send_messages())  # Or asyncio.ensure_future if using 3.4.3+
+        self.tsk= asyncio.ensure_future(self._send_messages())
         self.flush= False
 
-    @asyncio.coroutine
-    def _send_messages(self):
+    async def _send_messages(self):
         ''' Send messages to the board as they become available. '''
         # checks high priority queue first
-        yield from self._ready.wait()
+        await self._ready.wait()
         self.log.debug("TcpConnection: send_messages Ready!")
         while True:
             # every message added to one of the queues increments the semaphore
-            yield from self._msg_ready.acquire()
+            await self._msg_ready.acquire()
 
             if self.flush:
                 while not self.hipri_queue.empty():
@@ -63,15 +63,14 @@ class TcpConnection(asyncio.Protocol):
         self.flush= True
         self._msg_ready.release()
 
-    @asyncio.coroutine
-    def send_message(self, data, hipri=False):
+    async def send_message(self, data, hipri=False):
         """ Feed a message to the sender coroutine. """
         self.log.debug('TcpConnection: send_message - hipri: ' + str(hipri))
         self._msg_ready.release()
         if hipri:
-            yield from self.hipri_queue.put(data)
+            await self.hipri_queue.put(data)
         else:
-            yield from self.queue.put(data)
+            await self.queue.put(data)
 
     def data_received(self, data):
         #print('data received', repr(data))
@@ -140,13 +139,13 @@ class CommsNet():
         # calls the send_message in Serial Connection proto which is a queue
         #self.log.debug('CommsNet: _write ' + data)
         if self.proto:
-           asyncio.async(self.proto.send_message(data))
+           asyncio.ensure_future(self.proto.send_message(data))
 
     def _get_reports(self):
         # calls the send_message in Serial Connection proto which is a queue
         if self.proto:
-           asyncio.async(self.proto.send_message('M105\n', True))
-           asyncio.async(self.proto.send_message('?', True))
+           asyncio.ensure_future(self.proto.send_message('M105\n', True))
+           asyncio.ensure_future(self.proto.send_message('?', True))
            self.timer = async_main_loop.call_later(5, self._get_reports)
 
     def stop(self):
@@ -348,7 +347,7 @@ class CommsNet():
             self.log.warning('CommsNet: Cannot print to a closed connection')
 
     def _stream_file(self, fn):
-        self.file_streamer= asyncio.async(self.stream_file(fn))
+        self.file_streamer= asyncio.ensure_future(self.stream_file(fn))
 
     def stream_pause(self, pause, do_abort= False):
         ''' called from external thread to pause or kill in process streaming '''
@@ -364,8 +363,7 @@ class CommsNet():
         else:
             self.pause_stream= False #.set() # releases pause on stream
 
-    @asyncio.coroutine
-    def stream_file(self, fn):
+    async def stream_file(self, fn):
 
         self.log.info('CommsNet: Streaming file {} to port'.format(fn))
 
@@ -380,14 +378,14 @@ class CommsNet():
         success= False
         linecnt= 0
         try:
-            f = yield from aiofiles.open(fn, mode='r')
+            f = await aiofiles.open(fn, mode='r')
             while True:
-                #yield from self.pause_stream.wait() # wait for pause to be released
+                #await self.pause_stream.wait() # wait for pause to be released
                 # needed to do it this way as the Event did nto seem to work it would pause but not unpause
                 while self.pause_stream:
-                   yield from asyncio.sleep(1)
+                   await asyncio.sleep(1)
 
-                line = yield from f.readline()
+                line = await f.readline()
 
                 if not line:
                     # EOF
@@ -403,7 +401,7 @@ class CommsNet():
                 # wait for ok... (Note we interleave read from file with wait for ok)
                 if self.ping_pong and self.okcnt:
                     try:
-                        yield from self.okcnt.acquire()
+                        await self.okcnt.acquire()
                     except:
                         self.log.debug('CommsNet: okcntr wait cancelled')
                         break
@@ -428,7 +426,7 @@ class CommsNet():
             self.log.info('CommsNet: Streaming complete')
 
             if f:
-                yield from f.close()
+                await f.close()
 
             if success and not self.ping_pong:
                 self.log.debug('CommsNet: Waiting for okcnt to catch up: {} vs {}'.format(self.okcnt, linecnt))
@@ -440,7 +438,7 @@ class CommsNet():
                         success= False
                         break
 
-                    yield from asyncio.sleep(1)
+                    await asyncio.sleep(1)
 
             self.file_streamer= None
             self.progress= None
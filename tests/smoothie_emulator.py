@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# a stand in for a Smoothie board, so the comms can be tested and benchmarked without real hardware
+#
+# It listens on a pty (like the USB serial port) and/or on TCP (like the network console) and answers the way
+# Smoothie does: an ok for each line once it is in the planner queue, realtime ?, !, ~, ctrl-X and ctrl-Y,
+# <...> status reports, [GC:...] for $G and $I, [PRB:...] for G38.x probes, alarms and M28/M29 uploads to a
+# simulated sdcard.
+#
+# Moves take --move-time secs each to execute and at most --queue of them can be waiting in the planner, so
+# the oks are held back once the queue is full just like the real thing. --ok-latency is the round trip time of
+# the link, every reply is delivered that much later but the next line is handled straight away, so it slows down
+# ping pong streaming but not a stream that keeps lines in flight. --line-time is how long handling each line
+# takes, which holds up every line after it. --rx-buffer is how many received bytes can be waiting before it
+# stops reading the port.
+#
+# Usage: smoothie_emulator.py [--pty] [--tcp PORT] [options]
+# The ports to connect to are printed as:
+#   port: serial:///dev/pts/5
+#   port: net://127.0.0.1:2323
+
+import argparse
+import asyncio
+import collections
+import logging
+import os
+import re
+import sys
+import time
+import tty
+
+FIRMWARE = ("FIRMWARE_NAME:Smoothieware, FIRMWARE_URL:http%3A//smoothieware.org, "
+            "X-SOURCE_CODE_URL:https://github.com/Smoothieware/Smoothieware, FIRMWARE_VERSION:emulator, "
+            "X-FIRMWARE_BUILD_DATE:{date}, X-SYSTEM_CLOCK:100MHz, X-AXES:3, X-GRBL_MODE:0, X-CNC:{cnc}")
+
+REALTIME = b'?!~\x18\x19'
+MOTION = ('G0', 'G1', 'G2', 'G3')
+PROBE = ('G38.2', 'G38.3', 'G38.4', 'G38.5')
+
+word_exp = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]+)')
+
+log = logging.getLogger('emulator')
+
+
+class Machine():
+    """ the state shared by all the connections, there is only one machine however many hosts talk to it """
+
+    def __init__(self, args):
+        self.args = args
+        self.mpos = [0.0, 0.0, 0.0]  # where the head is now
+        self.planned = [0.0, 0.0, 0.0]  # where it will be once the planner queue is empty
+        self.offset = [0.0, 0.0, 0.0]  # work coordinate offset from G92
+        self.feed = 1000.0
+        self.absolute = True
+        self.planner = collections.deque()  # targets of the moves waiting to be executed
+        self.hold = False
+        self.alarm = False
+        self.lines = 0  # gcode lines handled, for --alarm-after
+        self.sd = {}  # the simulated sdcard, name: contents
+        self.cond = asyncio.Condition()
+        self.executor = None
+
+    def start(self):
+        self.executor = asyncio.ensure_future(self._execute())
+
+    async def _changed(self):
+        async with self.cond:
+            self.cond.notify_all()
+
+    async def _execute(self):
+        ''' executes the moves in the planner queue one at a time '''
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(lambda: self.planner and not self.hold)
+
+            await asyncio.sleep(self.args.move_time)
+
+            async with self.cond:
+                if self.planner:
+                    self.mpos = list(self.planner.popleft())
+                self.cond.notify_all()
+
+    def state(self):
+        if self.alarm:
+            return 'Alarm'
+        if self.hold:
+            return 'Hold'
+        if self.planner:
+            return 'Run'
+        return 'Idle'
+
+    def status(self):
+        x, y, z = self.mpos
+        ox, oy, oz = self.offset
+        return f'<{self.state()}|MPos:{x:.4f},{y:.4f},{z:.4f}|WPos:{x - ox:.4f},{y - oy:.4f},{z - oz:.4f}|F:{self.feed:.1f},100.0>'
+
+    def gc_state(self):
+        return f"[GC:G0 G54 G17 G21 {'G90' if self.absolute else 'G91'} G94 M0 M5 M9 T0 F{self.feed:.4f} S0.8000]"
+
+    async def realtime(self, c, reply):
+        ''' the realtime commands act as soon as they arrive, even in the middle of a line '''
+        if c == '?':
+            reply(self.status())
+
+        elif c == '!':
+            self.hold = True
+
+        elif c == '~':
+            self.hold = False
+            await self._changed()
+
+        elif c == '\x18':
+            # kill, drops everything queued and needs $X to clear
+            self.planner.clear()
+            self.planned = list(self.mpos)
+            self.hold = False
+            self.alarm = True
+            reply('ALARM: Abort during cycle')
+            await self._changed()
+
+        elif c == '\x19':
+            # stops a continuous jog
+            self.planner.clear()
+            self.planned = list(self.mpos)
+            await self._changed()
+
+    def _target(self, words):
+        t = list(self.planned)
+        for i, a in enumerate('XYZ'):
+            if a in words:
+                v = words[a]
+                t[i] = t[i] + v if not self.absolute else v + self.offset[i]
+        return t
+
+    async def _queue_move(self, target):
+        ''' waits for room in the planner then queues the move, this is what holds back the ok '''
+        async with self.cond:
+            await self.cond.wait_for(lambda: len(self.planner) < self.args.queue or self.alarm)
+            if self.alarm:
+                return False
+            self.planner.append(tuple(target))
+            self.planned = list(target)
+            self.cond.notify_all()
+        return True
+
+    async def wait_idle(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: not self.planner or self.alarm)
+
+    async def gcode(self, ln, reply):
+        ''' handles one gcode line, returns False if it did not get an ok '''
+        words = {}
+        codes = []
+        for a, v in word_exp.findall(ln.upper()):
+            if a in 'GM':
+                codes.append(f'{a}{v}' if '.' in v else f'{a}{int(float(v))}')
+            else:
+                words[a] = float(v)
+
+        if 'F' in words:
+            self.feed = words['F']
+        if 'G90' in codes:
+            self.absolute = True
+        if 'G91' in codes:
+            self.absolute = False
+
+        probe = [c for c in codes if c in PROBE]
+        if probe:
+            # the probe triggers half way to the target
+            target = self._target(words)
+            hit = [p + (t - p) / 2 for p, t in zip(self.planned, target)]
+            if not await self._queue_move(hit):
+                return False
+            await self.wait_idle()
+            reply(f'[PRB:{hit[0]:.3f},{hit[1]:.3f},{hit[2]:.3f}:1]')
+
+        elif 'G28' in codes:
+            return await self._queue_move([0.0, 0.0, 0.0])
+
+        elif 'G92' in codes:
+            for i, a in enumerate('XYZ'):
+                if a in words:
+                    self.offset[i] = self.planned[i] - words[a]
+
+        elif any(c in MOTION for c in codes) or (not codes and any(a in words for a in 'XYZ')):
+            return await self._queue_move(self._target(words))
+
+        elif 'M400' in codes:
+            await self.wait_idle()
+
+        elif 'M115' in codes:
+            reply(FIRMWARE.format(date=time.strftime('%b %d %Y %H:%M:%S'), cnc=1 if self.args.cnc else 0))
+
+        elif 'M20' in codes:
+            reply('Begin file list')
+            for name in sorted(self.sd):
+                reply(name)
+            reply('End file list')
+
+        return True
+
+
+class Connection(asyncio.Protocol):
+    """ one host talking to the machine, over the pty or a TCP connection """
+
+    def __init__(self, machine, name):
+        self.machine = machine
+        self.args = machine.args
+        self.name = name
+        self.transport = None
+        self.writer = None
+        self.rx = bytearray()
+        self.lines = collections.deque()
+        self.pending = 0  # bytes received but not yet handled
+        self.paused = False
+        self.ev = asyncio.Event()
+        self.upload = None  # (name, lines) while doing an M28 upload
+        self.task = None
+        self.out = collections.deque()  # (time due, data) of the replies delayed by --ok-latency
+        self.out_timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.writer is None:
+            self.writer = transport
+        log.info(f'{self.name}: connected')
+        self.task = asyncio.ensure_future(self._handle_lines())
+
+    def connection_lost(self, exc):
+        log.info(f'{self.name}: disconnected')
+        if self.out_timer:
+            self.out_timer.cancel()
+            self.out_timer = None
+        if self.task:
+            self.task.cancel()
+
+    def reply(self, s):
+        log.debug(f'{self.name}: >>> {s}')
+        data = s.encode('latin1') + b'\r\n'
+        if self.args.ok_latency <= 0:
+            self._write(data)
+            return
+
+        # the reply takes the round trip time to get back to the host, in the order they were sent
+        loop = asyncio.get_event_loop()
+        self.out.append((loop.time() + self.args.ok_latency, data))
+        if self.out_timer is None:
+            self.out_timer = loop.call_at(self.out[0][0], self._deliver)
+
+    def _deliver(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        data = bytearray()
+        while self.out and self.out[0][0] <= now:
+            data += self.out.popleft()[1]
+        self._write(bytes(data))
+        self.out_timer = loop.call_at(self.out[0][0], self._deliver) if self.out else None
+
+    def _write(self, data):
+        if data and self.writer is not None and not self.writer.is_closing():
+            self.writer.write(data)
+
+    def data_received(self, data):
+        # realtime characters are picked out as they arrive, unless we are uploading when they are just data
+        if self.upload is None and any(c in REALTIME for c in data):
+            for c in data:
+                if c in REALTIME:
+                    asyncio.ensure_future(self.machine.realtime(chr(c), self.reply))
+                else:
+                    self.rx.append(c)
+        else:
+            self.rx += data
+
+        while True:
+            i = self.rx.find(b'\n')
+            if i < 0:
+                break
+            ln = bytes(self.rx[:i + 1])
+            del self.rx[:i + 1]
+            self.lines.append(ln)
+            self.pending += len(ln)
+
+        # like the USB serial, stop reading when the receive buffer is full
+        if self.pending + len(self.rx) > self.args.rx_buffer and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+        self.ev.set()
+
+    async def _handle_lines(self):
+        while True:
+            while not self.lines:
+                self.ev.clear()
+                await self.ev.wait()
+
+            ln = self.lines.popleft()
+            try:
+                await self._handle(ln)
+            finally:
+                self.pending -= len(ln)
+                if self.paused and self.pending + len(self.rx) <= self.args.rx_buffer // 2:
+                    self.paused = False
+                    self.transport.resume_reading()
+
+    async def _handle(self, raw):
+        m = self.machine
+        ln = raw.decode('latin1').strip()
+        log.debug(f'{self.name}: <<< {ln}')
+
+        if self.upload is not None:
+            name, data = self.upload
+            if ln.upper().startswith('M29'):
+                m.sd[name] = b''.join(data)
+                self.upload = None
+                self.reply('Done saving file.')
+            else:
+                data.append(raw)
+            self.reply('ok')
+            return
+
+        if self.args.line_time > 0:
+            await asyncio.sleep(self.args.line_time)
+
+        # strip comments
+        i = ln.find(';')
+        if i >= 0:
+            ln = ln[:i].strip()
+        ln = re.sub(r'\(.*?\)', '', ln).strip()
+
+        if not ln:
+            self.reply('ok')
+            return
+
+        up = ln.upper()
+        if up in ('$X', 'M999'):
+            m.alarm = False
+            self.reply('[Caution: Unlocked]')
+            self.reply('ok')
+            return
+
+        if m.alarm:
+            self.reply('!!')
+            return
+
+        if up in ('$G', '$I'):
+            self.reply(m.gc_state())
+            if up == '$I':
+                self.reply(m.status())
+            self.reply('ok')
+            return
+
+        if up.startswith('M28'):
+            name = ln[3:].strip().lower()
+            if not name:
+                self.reply('open failed, File: .')
+                self.reply('ok')
+                return
+            self.upload = (os.path.basename(name), [])
+            self.reply(f'Writing to file: /sd/{os.path.basename(name)}')
+            self.reply('ok')
+            return
+
+        if up.startswith('LS'):
+            for name in sorted(m.sd):
+                self.reply(f'{name} {len(m.sd[name])}' if '-S' in up else name)
+            self.reply('ok')
+            return
+
+        if up.startswith('$J'):
+            ln = ln[2:]
+
+        elif up[0] not in 'GMTXYZFS':
+            self.reply(f'error:Unsupported command - {ln}')
+            self.reply('ok')
+            return
+
+        m.lines += 1
+        if self.args.alarm_after and m.lines == self.args.alarm_after:
+            m.alarm = True
+            m.planner.clear()
+            m.planned = list(m.mpos)
+            self.reply('ALARM: Hard limit +X')
+            return
+
+        if await m.gcode(ln, self.reply):
+            self.reply('ok')
+        else:
+            self.reply('!!')
+
+
+class PtyWriter(asyncio.BaseProtocol):
+    pass
+
+
+async def serve_pty(machine):
+    ''' creates a pty, the client opens the slave end like a USB serial port '''
+    loop = asyncio.get_event_loop()
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    # we keep the slave open so the master does not see a hang up when the client closes it
+    os.set_blocking(master, False)
+    conn = Connection(machine, 'pty')
+    writer, _ = await loop.connect_write_pipe(PtyWriter, os.fdopen(os.dup(master), 'wb', buffering=0))
+    conn.writer = writer
+    await loop.connect_read_pipe(lambda: conn, os.fdopen(master, 'rb', buffering=0))
+    return os.ttyname(slave), slave
+
+
+async def main(args):
+    machine = Machine(args)
+    machine.start()
+    servers = []
+
+    if args.pty:
+        path, slave = await serve_pty(machine)
+        print(f'port: serial://{path}', flush=True)
+
+    if args.tcp is not None:
+        n = 0
+
+        def new_connection():
+            nonlocal n
+            n += 1
+            return Connection(machine, f'tcp{n}')
+
+        server = await asyncio.get_event_loop().create_server(new_connection, args.host, args.tcp)
+        servers.append(server)
+        port = server.sockets[0].getsockname()[1]
+        print(f'port: net://{args.host}:{port}', flush=True)
+
+    # runs until killed
+    await asyncio.Event().wait()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Smoothie emulator for testing and benchmarking the comms')
+    parser.add_argument('--pty', action='store_true', help='listen on a pty, the default if --tcp is not given')
+    parser.add_argument('--tcp', type=int, default=None, help='listen on this TCP port, 0 picks a free one')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on for TCP')
+    parser.add_argument('--ok-latency', type=float, default=0.0, help='secs round trip time of the link, each reply is delayed by this')
+    parser.add_argument('--line-time', type=float, default=0.0, help='secs it takes to handle each line')
+    parser.add_argument('--move-time', type=float, default=0.0, help='secs each move takes to execute')
+    parser.add_argument('--queue', type=int, default=32, help='planner queue depth')
+    parser.add_argument('--rx-buffer', type=int, default=4096, help='bytes that can be waiting to be handled')
+    parser.add_argument('--alarm-after', type=int, default=0, help='raise a limit alarm on this gcode line')
+    parser.add_argument('--laser', dest='cnc', action='store_false', help='report as a 3D printer/laser not CNC')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    if args.tcp is None:
+        args.pty = True
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG if args.verbose else logging.INFO, stream=sys.stderr)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
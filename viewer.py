@@ -3,9 +3,10 @@ from kivy.app import App
 from kivy.lang import Builder
 from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.logger import Logger, LOG_LEVELS
-from kivy.graphics import Color, Line, Scale, Translate, PopMatrix, PushMatrix, Rectangle
+from kivy.graphics import Color, Line, Mesh, Scale, Translate, PopMatrix, PushMatrix, Rectangle
 from kivy.graphics import InstructionGroup
-from kivy.properties import NumericProperty, BooleanProperty, ListProperty, ObjectProperty
+from kivy.graphics.texture import Texture
+from kivy.properties import NumericProperty, BooleanProperty, ListProperty, ObjectProperty, StringProperty
 from kivy.graphics.transformation import Matrix
 from kivy.core.window import Window
 from kivy.uix.boxlayout import BoxLayout
@@ -14,12 +15,18 @@ from kivy.clock import Clock, mainthread
 from kivy.core.text import Label as CoreLabel
 from message_box import MessageBox
 from input_box import InputBox
+from gcode_preflight import get_preflight, DEFAULT_ACCELERATION
+from gcode_index import get_index, strip_gcode_line, split_gcodes, arc_geometry, arc_extents
+from gcode_geometry import numpy_available, parse_view, view_batches, clip, decimate, LOD_PIXELS, LOD_MAX_SEGMENTS
 
+import datetime
 import logging
+import os
 import sys
 import re
 import math
 import time
+import threading
 import traceback
 
 Builder.load_string('''
@@ -58,7 +65,7 @@ Builder.load_string('''
                 canvas.after:
                     ScissorPop:
             Label:
-                text: "{} size: {:1.4f}x{:1.4f} minz: {:1.4f} maxz: {:1.4f} {}".format(app.gcode_file, root.bounds[0], root.bounds[1], root.bounds[2], root.bounds[3], "Not all displayed" if root.too_many else "")
+                text: "{} size: {:1.4f}x{:1.4f} minz: {:1.4f} maxz: {:1.4f} {}".format(app.gcode_file, root.bounds[0], root.bounds[1], root.bounds[2], root.bounds[3], "Not all displayed" if root.too_many else root.est_time)
                 size_hint_y: None
                 height: self.texture_size[1]
 
@@ -164,6 +171,20 @@ Builder.load_string('''
                 size_hint_y: None
                 height: dp(40)
                 on_press: root.manager.current = 'main'
+
+<LoadProgress>:
+    size_hint: 0.6, None
+    height: dp(40)
+    pos_hint: {'center_x': 0.5, 'y': 0.2}
+    spacing: dp(8)
+    ProgressBar:
+        max: 1.0
+        value: root.value
+    Button:
+        text: 'Cancel'
+        size_hint_x: None
+        width: dp(80)
+        on_press: root.cancel()
 ''')
 
 XY = 0
@@ -171,6 +192,12 @@ XZ = 1
 CNC_accuracy = 0.1
 
 
+class LoadProgress(BoxLayout):
+    """ progress bar and cancel button shown while the file is parsed in the background """
+    value = NumericProperty(0)
+    cancel = ObjectProperty(None)
+
+
 class GcodeViewerScreen(Screen):
     current_z = NumericProperty(0)
     select_mode = BooleanProperty(False)
@@ -184,6 +211,7 @@ class GcodeViewerScreen(Screen):
     above_layer = NumericProperty(-1.0)
     below_layer = NumericProperty(0.0)
     too_many = BooleanProperty(False)
+    est_time = StringProperty('')
 
     def __init__(self, comms=None, is_standalone=False, **kwargs):
         super(GcodeViewerScreen, self).__init__(**kwargs)
@@ -198,6 +226,18 @@ class GcodeViewerScreen(Screen):
         self.twod_mode = self.app.is_cnc
         self.rval = 0.0
         self.max_vectors = -1
+        self.index = None
+        self.li = None
+        self.lp = None
+        self.geom = None
+        self._dash = None
+        # incremented to cancel a parse running in the background, or to ignore its results
+        self._parse_gen = 0
+        # full resolution segments and kinds, and the (tolerance, clip box) they are currently drawn at
+        self.full = None
+        self.lod = None
+        self._lod_gen = 0
+        self.ids.surface.bind(transform=self._zoomed)
         if not is_standalone:
             self.slice_size = self.app.config.get('Viewer', 'slice')
             self.above_layer = -self.slice_size
@@ -205,8 +245,9 @@ class GcodeViewerScreen(Screen):
 
     def loading(self):
         self.valid = False
-        self.li = Image(source='img/image-loading.gif')
-        self.add_widget(self.li)
+        if self.li is None:
+            self.li = Image(source='img/image-loading.gif')
+            self.add_widget(self.li)
         self.ids.surface.canvas.remove(self.canv)
         # give loading image a chance to display
         Clock.schedule_once(self._load_file)
@@ -228,9 +269,31 @@ class GcodeViewerScreen(Screen):
             if self.app.is_connected:
                 self.app.bind(wpos=self.update_tool)
 
+    def _get_index(self, fn, cancel=None, progress=None):
+        # the index is rebuilt if the file has changed since it was made
+        try:
+            st = os.stat(fn)
+            if self.index is None or self.index.fn != fn or self.index.size != st.st_size or self.index.mtime != st.st_mtime_ns:
+                self.index = get_index(fn, cancel, progress)
+        except Exception as e:
+            Logger.warning('GcodeViewerScreen: could not index {}: {}'.format(fn, e))
+            self.index = None
+
+        return self.index
+
     def _load_file(self, *args):
         self._loaded_ok = False
+        if numpy_available and not self.drill_mode:
+            # parsed in a thread and drawn as it arrives
+            self._start_parse(self.app.gcode_file)
+            return
+
+        self._parse_file()
+
+    def _parse_file(self, use_index=True):
         try:
+            if use_index:
+                self._get_index(self.app.gcode_file)
             self.parse_gcode_file(self.app.gcode_file, True)
         except Exception as e:
             Logger.error('GcodeViewerScreen: Got Exception: {}'.format(e))
@@ -246,6 +309,12 @@ class GcodeViewerScreen(Screen):
     def clear(self):
         self.app.unbind(wpos=self.update_tool)
 
+        # stop any background parse
+        self._parse_gen += 1
+        self._remove_progress()
+        Clock.unschedule(self._update_lod)
+        self.full = None
+
         if self.li:
             self.remove_widget(self.li)
             self.li = None
@@ -338,7 +407,18 @@ class GcodeViewerScreen(Screen):
         f.seek(0)
         return tt
 
-    extract_gcode = re.compile(r"(G|X|Y|Z|I|J|K|E|S)(-?\d*\.?\d*\.?)")
+    def _read_spans(self, f, spans):
+        ''' yields (file position, line, state) for each line in the spans, state is the parser state saved at the start of a band or None '''
+        for start, end, band in spans:
+            f.seek(start)
+            state = self.index.band_state(band) if band is not None else None
+            while end is None or f.tell() < end:
+                pos = f.tell()
+                ln = f.readline()
+                if not ln:
+                    break
+                yield (pos, ln, state)
+                state = None
 
     def parse_gcode_file(self, fn, one_layer=False):
         # open file parse gcode and draw
@@ -382,6 +462,20 @@ class GcodeViewerScreen(Screen):
         z = lastpos[2]
 
         point_count = 0
+
+        # use the index to only read the current layer, or only the bands that cut within the current slice
+        idx = self.index if self.index is not None and self.index.fn == fn else None
+        spans = [(self.layers[-1], None, None)]
+        sliced = False
+        if idx is not None:
+            if not self.twod_mode:
+                spans = [(self.layers[-1], idx.layer_end(self.layers[-1]), None)]
+            elif not self.drill_mode:
+                spans = idx.slice_spans(self.above_layer, self.below_layer)
+                sliced = True
+                self.current_z = self.above_layer
+                Logger.debug('GcodeViewerScreen: reading {} spans of bands for slice'.format(len(spans)))
+
         with open(fn) as f:
             # if we are in drill_mode then try to read flatcams drill list
             if self.drill_mode:
@@ -391,38 +485,25 @@ class GcodeViewerScreen(Screen):
                     Logger.error('GcodeViewerScreen: read_drill_list Got Exception: {}'.format(e))
                     tool_table = None
 
-            # jump to last read position
-            f.seek(self.layers[-1])
-            # print('Jumped to layer position: {}'.format(f.tell()))
-
             got_layer = False
-            while not got_layer:
-                last_file_pos = f.tell()  # save the start of this line
+            for last_file_pos, ln, state in self._read_spans(f, spans):
+                if state is not None:
+                    # skipped to the start of a band, restore the parser state saved in the index
+                    if points:
+                        point_count += len(points) / 2
+                        self.canv.add(Color(0, 0, 0))
+                        self.canv.add(Line(points=points, width=1, cap='none', joint='none'))
+                        points = []
+                    x, y, z, modal_g, rel_move, laste, lasts, has_e = state
+                    lastpos = [x, y, z]
+                    last_gcode = -1
 
-                ln = f.readline()
-                if not ln:
-                    break
                 Logger.debug("GcodeViewerScreen: {}".format(ln))
 
                 cnt += 1
-                ln = ln.strip()
+                ln = strip_gcode_line(ln)
                 if not ln:
                     continue
-                    # skip comments and $ commands
-                if ln.startswith(';') or ln.startswith('#') or ln.startswith('$'):
-                    continue
-                if ln.startswith('('):
-                    continue
-                p = ln.find(';')
-                if p >= 0:
-                    ln = ln[:p]
-                p = ln.find('(')
-                if p >= 0:
-                    p2 = ln.find(')')
-                    lnt = ln[:p]
-                    if p2 > 0:
-                        lnt += ln[p2 + 1:]
-                    ln = lnt
 
                 # in drill mode we try to set the drill size
                 if self.drill_mode:
@@ -434,21 +515,7 @@ class GcodeViewerScreen(Screen):
                         else:
                             drill_size = 3.0  # default drill size
 
-                matches = self.extract_gcode.findall(ln)
-
-                # this handles multiple G codes on one line
-                gcodes = []
-                d = {}
-                for m in matches:
-                    if m[0] == 'G' and 'G' in d:
-                        # we have another G code on the same line
-                        gcodes.append(d)
-                        d = {}
-                    d[m[0]] = float(m[1])
-
-                gcodes.append(d)
-
-                for d in gcodes:
+                for d in split_gcodes(ln):
                     if not d:
                         continue
 
@@ -679,40 +746,7 @@ class GcodeViewerScreen(Screen):
 
                     elif gcode in [2, 3]:  # CW=2,CCW=3 circle
                         # G02 X0 Y-2 I0 J-2.0
-                        mposx, mposy = (lastpos[0], lastpos[1])
-                        centerX, centerY = (mposx + i, mposy + j)
-                        endpointX, endpointY = (x, y)
-                        clockwise = (gcode == 2)
-
-                        sX = mposx - centerX
-                        sY = mposy - centerY
-                        eX = endpointX - centerX
-                        eY = endpointY - centerY
-
-                        if clockwise:
-                            # Clockwise
-                            angleA = math.atan2(sY, sX)
-                            angleB = math.atan2(eY, eX)
-                            angle = angleA - angleB
-                            p1 = endpointX
-                            p2 = endpointY
-                        else:
-                            # Counterclockwise
-                            angleB = math.atan2(sY, sX)
-                            angleA = math.atan2(eY, eX)
-                            angle = angleB - angleA
-                            p2 = mposy
-                            p1 = mposx
-
-                        if angle == 0:
-                            angle = math.radians(360)
-                        elif angle < 0:
-                            angle = -angle
-
-                        if angleA <= angleB:
-                            angleA += 2.0 * math.pi
-
-                        radius = math.sqrt(sX * sX + sY * sY)
+                        centerX, centerY, radius, angleA, angleB, angle, p1, p2 = arc_geometry(lastpos[0], lastpos[1], x, y, i, j, gcode == 2)
                         circle_dat = (centerX, centerY, radius, 90 - math.degrees(angleA), 90 - math.degrees(angleB), 64)
                         self.canv.add(Color(0, 0, 0))
                         self.canv.add(Line(circle=circle_dat))
@@ -736,6 +770,18 @@ class GcodeViewerScreen(Screen):
                     got_layer = False
                     Logger.debug("GcodeViewerScreen: no geometry found try next line")
 
+                if got_layer:
+                    break
+
+        if not self.twod_mode and not got_layer and spans[0][1] is not None:
+            # we read upto the start of the next layer found by the index
+            self.layers.append(spans[0][1])
+            Logger.debug('Saved position: {} for layer: {}'.format(self.layers[-1], len(self.layers)))
+
+        if sliced:
+            # we only read part of the file so use the extents of the whole thing from the index
+            min_x, min_y, min_z, max_x, max_y, max_z = idx.bounds
+
         if not self.twod_mode and last_layer_z is None:
             # we hit the end of file before finding the layer we want
             Logger.info("GcodeViewerScreen: no layer found - last layer was at {}".format(lastpos[2]))
@@ -750,7 +796,235 @@ class GcodeViewerScreen(Screen):
             points = []
 
         Logger.debug("GcodeViewerScreen: point count= {}".format(point_count))
+        self._finish_parse(min_x, min_y, min_z, max_x, max_y, max_z)
+
+    def _start_parse(self, fn):
+        # the geometry is extracted in a thread, and added to the canvas as a few meshes per chunk as it arrives
+        Logger.debug("GcodeViewerScreen: parsing file {} in background".format(fn))
+        self.is_visible = True
+        if self.laser_mode:
+            self.twod_mode = True  # laser mode implies 2D mode
+
+        # reset scale and translation
+        m = Matrix()
+        m.identity()
+        self.ids.surface.transform = m
+        self.canv.clear()
+        self.full = None
+        self.est_time = ''
+
+        self._parse_gen += 1
+        self._remove_progress()
+        self.lp = LoadProgress(cancel=self.cancel_load)
+        self.add_widget(self.lp)
+
+        # the thread gets copies of everything it needs as it must not touch any kivy objects
+        args = (self._parse_gen, fn, self.twod_mode, self.laser_mode, self.above_layer, self.below_layer, self.layers[-1],
+                self._lod_max(), self.ids.surface.width, self.ids.surface.height, getattr(self.app, 'eta_acceleration', DEFAULT_ACCELERATION))
+        threading.Thread(target=self._parse_thread, args=args, daemon=True).start()
+
+    def _parse_thread(self, gen, fn, twod_mode, laser_mode, above, below, start, max_segments, width, height, acceleration):
+        def cancelled():
+            return gen != self._parse_gen
+
+        try:
+            idx = self._get_index(fn, cancelled, lambda v: self._parse_progress(gen, v))
+            if cancelled():
+                return
+            if idx is None:
+                # no index so parse it the old way
+                self._parse_fallback(gen)
+                return
 
+            r = parse_view(fn, idx, twod_mode, laser_mode, above, below, start, width, height, max_segments, cancelled,
+                           lambda bounds, z: self._parse_started(gen, bounds, z),
+                           lambda cuts, moves, rapids, v: self._parse_geometry(gen, cuts, moves, rapids, v))
+            if cancelled():
+                return
+            if r is None:
+                # an empty layer
+                self._parse_done(gen, None, None)
+                return
+
+            self._parse_done(gen, *r)
+
+            # the same preflight the print uses, so this is free if it has been run before and saves the time when it is
+            pf = get_preflight(fn, acceleration=acceleration)
+            self._preflight_ready(gen, pf.est_time)
+
+        except Exception as e:
+            Logger.error('GcodeViewerScreen: Got Exception: {}'.format(e))
+            print(traceback.format_exc())
+            self._parse_failed(gen)
+
+    @mainthread
+    def _parse_progress(self, gen, v):
+        if gen == self._parse_gen and self.lp is not None:
+            self.lp.value = v
+
+    @mainthread
+    def _parse_started(self, gen, bounds, z):
+        if gen != self._parse_gen:
+            return
+
+        self.current_z = z
+        self.canv.add(PushMatrix())
+        # the geometry goes in its own group so it ends up between the transforms and the markers
+        self.geom = InstructionGroup()
+        self.canv.add(self.geom)
+        self._finish_parse(*bounds)
+        if not self._loaded_ok:
+            # nothing to draw it on so stop now
+            self._parse_gen += 1
+            self._remove_progress()
+        self._loaded(True)
+
+    @mainthread
+    def _parse_geometry(self, gen, cuts, moves, rapids, v):
+        if gen != self._parse_gen:
+            return
+
+        self._draw_geometry(cuts, moves, rapids)
+        if self.lp is not None:
+            self.lp.value = v
+
+    def _draw_geometry(self, cuts, moves, rapids):
+        # cuts in black, moves in red and rapids in dashed red
+        self.geom.add(Color(0, 0, 0))
+        for verts, indices in cuts:
+            self.geom.add(Mesh(vertices=verts, indices=indices, mode='lines'))
+        self.geom.add(Color(1, 0, 0))
+        for verts, indices in moves:
+            self.geom.add(Mesh(vertices=verts, indices=indices, mode='lines'))
+        for verts, indices in rapids:
+            self.geom.add(Mesh(vertices=verts, indices=indices, mode='lines', texture=self._dash_texture()))
+
+    def _dash_texture(self):
+        # one opaque and one clear texel repeated along the rapids, their u is set by mesh_batches to make the dashes
+        if self._dash is None:
+            self._dash = Texture.create(size=(2, 1), colorfmt='rgba')
+            self._dash.blit_buffer(bytes((255, 255, 255, 255, 0, 0, 0, 0)), colorfmt='rgba', bufferfmt='ubyte')
+            self._dash.wrap = 'repeat'
+            self._dash.mag_filter = 'nearest'
+            self._dash.min_filter = 'nearest'
+        return self._dash
+
+    @mainthread
+    def _parse_done(self, gen, next_layer, full=None, tol=None, batches=None):
+        if gen != self._parse_gen:
+            return
+
+        self._remove_progress()
+        if batches is not None:
+            self.geom.clear()
+            self._draw_geometry(*batches)
+
+        if tol is not None:
+            self.full = full
+            self.lod = (tol, None)
+            Logger.debug('GcodeViewerScreen: {} segments drawn at {:1.4f}'.format(len(full[0]), tol))
+
+        if next_layer is not None:
+            self.layers.append(next_layer)
+            Logger.debug('Saved position: {} for layer: {}'.format(self.layers[-1], len(self.layers)))
+
+        if self.li is not None:
+            # never got started
+            Logger.info("GcodeViewerScreen: no layer found")
+            self._loaded(True)
+
+    @mainthread
+    def _preflight_ready(self, gen, t):
+        if gen == self._parse_gen:
+            self.est_time = 'est time: {}'.format(datetime.timedelta(seconds=int(t)))
+
+    @mainthread
+    def _parse_failed(self, gen):
+        if gen != self._parse_gen:
+            return
+
+        self._remove_progress()
+        if self.li is not None:
+            self._loaded(False)
+
+    @mainthread
+    def _parse_fallback(self, gen):
+        if gen != self._parse_gen:
+            return
+
+        self._remove_progress()
+        self._parse_file(False)
+
+    def _remove_progress(self):
+        if self.lp is not None:
+            self.remove_widget(self.lp)
+            self.lp = None
+
+    def cancel_load(self):
+        # stop the background parse, whatever has been drawn so far stays
+        self._parse_gen += 1
+        self._remove_progress()
+        if self.li is not None:
+            # nothing to show yet
+            self.manager.current = 'main'
+        else:
+            self.too_many = True
+
+    def _lod_max(self):
+        return self.max_vectors if self.max_vectors > 0 else LOD_MAX_SEGMENTS
+
+    def _zoomed(self, *args):
+        # redo the level of detail once the zoom or pan settles
+        Clock.unschedule(self._update_lod)
+        if self.full is not None:
+            Clock.schedule_once(self._update_lod, 0.5)
+
+    def _update_lod(self, *args):
+        if self.full is None or self.lp is not None:
+            return
+
+        tol = LOD_PIXELS / (self.scale * self.ids.surface.scale)
+        # the part of the drawing in view
+        vw = self.ids.view_window
+        x0, y0 = self.transform_to_wpos(*vw.to_window(vw.x, vw.y))
+        x1, y1 = self.transform_to_wpos(*vw.to_window(vw.right, vw.top))
+        cur_tol, cur_box = self.lod
+        inside = cur_box is None or (x0 >= cur_box[0] and y0 >= cur_box[1] and x1 <= cur_box[2] and y1 <= cur_box[3])
+        if inside and cur_tol <= tol * 2 and (cur_box is None or cur_tol >= tol / 2):
+            # still close enough
+            return
+
+        box = None
+        if self.ids.surface.scale > 1.0:
+            # zoomed in so only draw what is in view, plus the same again around it so a small pan does not need a redo
+            w = x1 - x0
+            h = y1 - y0
+            box = (x0 - w, y0 - h, x1 + w, y1 + h)
+
+        self._lod_gen += 1
+        threading.Thread(target=self._lod_thread, args=(self._lod_gen, self.full, tol, box, self._lod_max()), daemon=True).start()
+
+    def _lod_thread(self, gen, full, tol, box, max_segments):
+        try:
+            seg, kind = full
+            if box is not None:
+                seg, kind = clip(seg, kind, box)
+            seg, kind, _ = decimate(seg, kind, tol, max_segments)
+            self._lod_ready(gen, full, tol, box, view_batches(seg, kind))
+        except Exception as e:
+            Logger.error('GcodeViewerScreen: level of detail Got Exception: {}'.format(e))
+
+    @mainthread
+    def _lod_ready(self, gen, full, tol, box, batches):
+        if gen != self._lod_gen or full is not self.full:
+            return
+
+        Logger.debug('GcodeViewerScreen: redrawn at {:1.4f} in {}'.format(tol, box))
+        self.lod = (tol, box)
+        self.geom.clear()
+        self._draw_geometry(*batches)
+
+    def _finish_parse(self, min_x, min_y, min_z, max_x, max_y, max_z):
         # center the drawing and scale it
         dx = max_x - min_x
         dy = max_y - min_y
@@ -1034,25 +1308,6 @@ class GcodeViewerScreen(Screen):
         self.loading()
 
 
-# find the list of N points on the arc
-def arc_extents(cx, cy, px, py, theta, N):
-    points = []
-    dx = px - cx
-    dy = py - cy
-    ctheta = math.cos(theta / (N - 1))
-    stheta = math.sin(theta / (N - 1))
-    p = (cx + dx, cy + dy)
-    points.append(p)
-    for i in range(1, N):
-        dxtemp = ctheta * dx - stheta * dy
-        dy = stheta * dx + ctheta * dy
-        dx = dxtemp
-        p = (cx + dx, cy + dy)
-        points.append(p)
-
-    return points
-
-
 if __name__ == '__main__':
 
     Builder.load_string('''
@@ -1,5 +1,6 @@
 import socket
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
 import time
 import logging
 import traceback
@@ -13,20 +14,34 @@ main_page = '''
 <body>
 <h1>Smoopi status page</h1>
 
-<div id="statusDiv">
-<iframe src="status" height="64" width="810">
-</iframe>
-</div>
+<div id="statusDiv">Waiting for status...</div>
 
 <br/>
 
 <iframe src="camera" height="800" width="1024">
 </iframe>
 
+<script>
+// the status is pushed by the server whenever it changes
+var source = new EventSource("events");
+source.onmessage = function(e) {
+    var st = JSON.parse(e.data);
+    var txt;
+    if (st.printing) {
+        txt = st.status + " - Z: " + st.wpos[2] + ", " + st.eta + ", File: " + st.file;
+    } else {
+        txt = st.status + " - Not Printing";
+    }
+    document.getElementById("statusDiv").textContent = txt;
+};
+</script>
+
 </body>
 </html>
 '''
 
+SSE_KEEPALIVE = 15  # seconds between keep alive comments when the status has not changed
+
 
 def get_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -42,43 +57,65 @@ def get_ip():
     return IP
 
 
-def make_request_handler_class(app, ip, flipx, flipy):
+def make_request_handler_class(server, app, ip, flipx, flipy):
     class MyRequestHandler(BaseHTTPRequestHandler):
+        m_server = server
         m_app = app
         m_ip = ip
         m_flipx = flipx
         m_flipy = flipy
 
-        def _set_headers(self):
+        def _set_headers(self, content_type='text/html'):
             self.send_response(200)
-            self.send_header('Content-type', 'text/html')
+            self.send_header('Content-type', content_type)
             self.end_headers()
 
         def do_GET(self):
+            if self.path in ('/metrics', '/metrics.json'):
+                # the comms metrics for monitoring, in Prometheus text format or as JSON, from the last published copy
+                text, data = MyRequestHandler.m_server.get_metrics()
+                if self.path == '/metrics':
+                    self._set_headers('text/plain; version=0.0.4')
+                    self.wfile.write(text)
+                else:
+                    self._set_headers('application/json')
+                    self.wfile.write(data)
+                return
+
+            if self.path == '/api/status':
+                # served from the cached state, so it costs nothing no matter how many clients there are
+                _, data = MyRequestHandler.m_server.get_state()
+                self._set_headers('application/json')
+                self.wfile.write(data)
+                return
+
+            if self.path == '/events':
+                self._send_events()
+                return
+
+            if self.path == '/camera.mjpg':
+                self._send_camera()
+                return
+
             self._set_headers()
+            st = MyRequestHandler.m_server.state
             if self.path == '/status':
-                status = MyRequestHandler.m_app.status
-                if MyRequestHandler.m_app.main_window.is_printing:
-                    eta = MyRequestHandler.m_app.main_window.eta
-                    file = MyRequestHandler.m_app.gcode_file
-                    wpos = MyRequestHandler.m_app.wpos
+                # old style page for clients that can't use the events
+                if st.get('printing'):
                     self.wfile.write("<html>\r\n".encode("utf-8"))
                     self.wfile.write('<head><meta http-equiv="refresh" content="5"></head><body>\r\n'.encode("utf-8"))
 
-                    self.wfile.write("{} - Z: {}, {}, File: {}".format(status, wpos[2], eta, file).encode("utf-8"))
+                    self.wfile.write("{} - Z: {}, {}, File: {}".format(st['status'], st['wpos'][2], st['eta'], st['file']).encode("utf-8"))
                     self.wfile.write("</body></html>\r\n".encode("utf-8"))
                 else:
-                    self.wfile.write("{} - Not Printing".format(status).encode("utf-8"))
+                    self.wfile.write("{} - Not Printing".format(st.get('status', 'Not Connected')).encode("utf-8"))
 
             elif self.path == '/camera':
                 self.wfile.write("<html><body>\r\n".encode("utf-8"))
-                if MyRequestHandler.m_app.is_show_camera:
-                    camurl = MyRequestHandler.m_app.camera_url
-                    if "localhost" in camurl:
-                        # we need to replace localhost with actual ip so remote browsers can get it
-                        camurl = camurl.replace("localhost", MyRequestHandler.m_ip)
+                if MyRequestHandler.m_server.camera_relay:
+                    # the camera is relayed by us so browsers do not each open a stream to the camera
                     flipit = 'style="transform: scale({},{});"'.format(-1 if self.m_flipx else 1, -1 if self.m_flipy else 1)
-                    self.wfile.write('\r\n<center><img {} src="{}" /></center>\r\n'.format(flipit, camurl).encode("utf-8"))
+                    self.wfile.write('\r\n<center><img {} src="camera.mjpg" /></center>\r\n'.format(flipit).encode("utf-8"))
                 else:
                     self.wfile.write('camera not enabled'.encode("utf-8"))
                 self.wfile.write("</body></html>\r\n".encode("utf-8"))
@@ -86,6 +123,56 @@ def make_request_handler_class(app, ip, flipx, flipy):
             else:
                 self.wfile.write(main_page.encode("utf-8"))
 
+        def _send_events(self):
+            ''' Server-Sent Events, the status is sent when it changes, this runs in its own thread until the client goes away '''
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            server = MyRequestHandler.m_server
+            version = None
+            try:
+                while not server.stopping:
+                    v, data = server.wait_for_change(version, SSE_KEEPALIVE)
+                    if v == version:
+                        # lets us find out if the client has gone away
+                        self.wfile.write(b': keepalive\n\n')
+                    else:
+                        self.wfile.write(b'data: ' + data + b'\n\n')
+                        version = v
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def _send_camera(self):
+            ''' relays the shared camera stream, a slow client only gets the latest frame each time so skips the rest '''
+            relay = MyRequestHandler.m_server.camera_relay
+            if relay is None:
+                self.send_error(404, 'camera not enabled')
+                return
+
+            self.send_response(200)
+            self.send_header('Content-type', 'multipart/x-mixed-replace; boundary=frame')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            server = MyRequestHandler.m_server
+            relay.subscribe()
+            try:
+                seq = 0
+                while not server.stopping:
+                    n, jpg = relay.wait_frame(seq, 1.0)
+                    if n == seq or jpg is None:
+                        continue
+                    seq = n
+                    self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(jpg)).encode() + b'\r\n\r\n')
+                    self.wfile.write(jpg)
+                    self.wfile.write(b'\r\n')
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                relay.unsubscribe()
+
         def do_POST(self):
             # Doesn't do anything with posted data
             self._set_headers()
@@ -98,20 +185,71 @@ def make_request_handler_class(app, ip, flipx, flipy):
 
 
 class ProgressServer(object):
+    """ serves the status to any number of clients, each request is handled in its own thread
+
+    The UI thread publishes a snapshot of the state whenever it changes, the request threads only ever read that
+    snapshot so they never touch the Kivy objects.
+    """
+
+    def __init__(self):
+        self.camera_relay = None
+        self.state = {}
+        self.state_json = b'{}'
+        self.version = 0
+        self.metrics_text = b''
+        self.metrics_json = b'{}'
+        self.stopping = False
+        self.cond = threading.Condition()
+
+    def publish(self, state):
+        ''' called from the UI thread with the current state as a dict of plain values, wakes up any event streams '''
+        with self.cond:
+            if state == self.state:
+                return
+            self.state = state
+            self.state_json = json.dumps(state).encode('utf-8')
+            self.version += 1
+            self.cond.notify_all()
+
+    def get_state(self):
+        ''' returns (version, state as json) '''
+        with self.cond:
+            return self.version, self.state_json
+
+    def publish_metrics(self, text, data):
+        ''' called from the UI thread with the metrics in Prometheus text format and as JSON, does not wake the event streams '''
+        text = text.encode('utf-8')
+        data = data.encode('utf-8')
+        with self.cond:
+            self.metrics_text = text
+            self.metrics_json = data
+
+    def get_metrics(self):
+        ''' returns (metrics as Prometheus text, metrics as json) '''
+        with self.cond:
+            return self.metrics_text, self.metrics_json
+
+    def wait_for_change(self, version, timeout):
+        ''' wait until the state is not version or the timeout, returns (version, state as json) '''
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != version or self.stopping, timeout)
+            return self.version, self.state_json
+
     def start(self, app, port):
         self.port = port
         self.app = app
         self.myServer = None
         self.flipy = app.config.getboolean('Web', 'camera_flip_y', fallback=False)
         self.flipx = app.config.getboolean('Web', 'camera_flip_x', fallback=False)
+        self.camera_relay = getattr(app, 'camera_relay', None)
         self.t = threading.Thread(target=self._start)
         self.t.start()
 
     def _start(self):
         ip = get_ip()
         logger.info("ProgressServer: IP address is: {}".format(ip))
-        RequestHandlerClass = make_request_handler_class(self.app, ip, self.flipx, self.flipy)
-        self.myServer = HTTPServer(("", self.port), RequestHandlerClass)
+        RequestHandlerClass = make_request_handler_class(self, self.app, ip, self.flipx, self.flipy)
+        self.myServer = ThreadingHTTPServer(("", self.port), RequestHandlerClass)
         logger.info("ProgressServer: Web Server Starting - %s:%s" % ("", self.port))
 
         try:
@@ -124,6 +262,10 @@ class ProgressServer(object):
             self.myServer = None
 
     def stop(self):
+        # release any event streams
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
         if self.myServer:
             self.myServer.shutdown()
             self.t.join()
@@ -144,7 +286,6 @@ if __name__ == "__main__":
             self.is_show_camera = False
             self.main_window = MainWindow()
             self.camera_url = 'http://camipaddress:port'
-            # self.camera_realm = 'CameraServer'
             # self.camera_user = 'user'
             # self.camera_password = 'pw'
             # self.camera_singleshot = 1
@@ -152,3 +293,4 @@ if __name__ == "__main__":
     logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
     s = ProgressServer()
     s.start(MyApp(), 8000)
+    s.publish({'connected': False, 'status': 'Not Connected', 'printing': False, 'eta': 'Not Streaming', 'file': '', 'wpos': [0, 0, 0], 'camera_url': None})